@@ -0,0 +1,323 @@
+###########
+# IMPORTS #
+###########
+
+import os
+import json
+import threading
+import traceback
+from concurrent.futures import as_completed
+
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from PIL import Image
+
+import general_function as gf
+import dataset_pool as dp
+import spatial_pyramid as pyr
+
+
+# Maps of all days of a NetCDF file rendered once, in background processes, with the same color scale:
+# the interface only shows images already saved.
+#   - <BDIR>/NetCDF_files/<SERVICE>/.cache/<name>-FRAMES[-<depth>]/<YYYY-MM-DD>.png
+#   - <BDIR>/NetCDF_files/<SERVICE>/.cache/<name>-FRAMES[-<depth>]/frames.json : dates and color scale
+#   - <BDIR>/NetCDF_files/<SERVICE>/.cache/<name>-FRAMES[-<depth>]/animation.gif
+
+_JOBS = {} # key=folder of frames, value=thread rendering the frames
+_LOCK = threading.Lock()
+
+
+
+#####################
+# GENERAL FUNCTIONS #
+#####################
+
+
+def get_frames_dir(FILEPATH:str,DEPTH=None):
+    """ Folder of the frames of a NetCDF file at 1 depth (created by render_frames) """
+    suffix = "-FRAMES" if DEPTH==None else "-FRAMES-%g" % float(DEPTH)
+    return gf.get_cache_path(FILEPATH,suffix)
+
+
+
+def get_variable(FILEPATH:str):
+    """ 
+        Get id, name and unit of the variable of a NetCDF file
+
+        Returns
+        -------
+        str
+            id of the variable in the file
+        str
+            name
+        str
+            unit
+    """
+    ### EXTRACT FROM FILENAME
+    VAR = (os.path.split(str(FILEPATH))[1]).split('__')[0].split("pfx")[-1]
+    if "]" in VAR:
+        VAR = VAR.split("]")[-1]
+
+    ################ TO ADAPT ################
+    with open("./variables.json","r") as f:
+        json_dict = json.load(f)
+    if VAR in json_dict.keys():
+        return VAR,json_dict[VAR][0],json_dict[VAR][1]
+    return VAR,VAR,""
+
+
+
+def select_depth(DS,VAR:str,DEPTH=None):
+    """ Get the variable at the nearest depth level (first level if DEPTH is None) """
+    da = DS[VAR]
+    if 'depth' in da.dims:
+        da = da.isel(depth=int(np.abs(DS['depth'].values-float(DEPTH or 0.0)).argmin()))
+    return da
+
+
+
+def get_color_scale(FILEPATH:str,DEPTH=None,MAXDAYS=64):
+    """ 
+        Get limits of the colormap for all days: 2nd and 98th percentiles, computed on the coarsest level
+        of the pyramid (see spatial_pyramid) and at most MAXDAYS days spread over the file
+
+        Returns
+        -------
+        float
+            vmin
+        float
+            vmax
+    """
+    VAR,_,_ = get_variable(FILEPATH)
+    path,_ = pyr.select_level(FILEPATH,RESOLUTION=np.inf)
+    da = select_depth(dp.open_dataset(path),VAR,DEPTH)
+    step = max(1,da.sizes['time']//int(MAXDAYS))
+    values = da.isel(time=slice(None,None,step)).values
+    values = values[np.isfinite(values)]
+    if values.size==0:
+        return 0.0,1.0
+    vmin,vmax = np.percentile(values,[2,98])
+    return float(vmin),float(vmax)
+
+
+
+def render_chunk(FILEPATH:str,INDEXES:list,DEPTH,VMIN:float,VMAX:float,FOLDER:str,PIXELS=640,CMAP="viridis"):
+    """ 
+        Render the maps of several days of a NetCDF file (run in a worker process)
+        The figure is drawn once, only the values change between days
+
+        Parameters
+        ----------
+        FILEPATH : str
+            path to a NetCDF file
+        INDEXES : list (int)
+            indexes of the days in the file
+        DEPTH : float
+            nearest depth level, None for the first level
+        VMIN, VMAX : float
+            limits of the colormap
+        FOLDER : str
+            folder of the frames
+        PIXELS : int
+            width of the maps in pixels
+        CMAP : str
+            matplotlib colormap
+
+        Returns
+        -------
+        int
+            number of frames saved
+    """
+    VAR,VARNAME,VARUNIT = get_variable(FILEPATH)
+    path,_ = pyr.select_level(FILEPATH,PIXELS=PIXELS)
+    ds = dp.open_dataset(path)
+    latname,lonname = gf.get_latlon_names(ds)
+    ydim,xdim = pyr.get_grid_dims(ds)
+    da = select_depth(ds,VAR,DEPTH).transpose('time',ydim,xdim)
+    dates = ds['time'].dt.strftime('%Y-%m-%d').values
+    if (ds[latname].ndim==1) and (ds[lonname].ndim==1):
+        lon,lat = ds[lonname].values,ds[latname].values
+    else:
+        lon,lat = ds[lonname].transpose(ydim,xdim).values,ds[latname].transpose(ydim,xdim).values
+
+    fig = Figure(figsize=(PIXELS/100,PIXELS*0.75/100),dpi=100)
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    ax.set_aspect('equal')
+    ax.set_xlabel("longitude [degrees_east]")
+    ax.set_ylabel("latitude [degrees_north]")
+    mesh = ax.pcolormesh(lon,lat,np.ma.masked_invalid(da.isel(time=INDEXES[0]).values),
+                         shading='auto',vmin=VMIN,vmax=VMAX,cmap=CMAP)
+    fig.colorbar(mesh,ax=ax).set_label(VARNAME+" in "+VARUNIT)
+
+    for i in INDEXES:
+        mesh.set_array(np.ma.masked_invalid(da.isel(time=int(i)).values))
+        ax.set_title("time = "+str(dates[i]))
+        output = os.path.join(FOLDER,str(dates[i])+".png")
+        fig.savefig(output+".tmp",format="png")
+        os.replace(output+".tmp",output)
+    return len(INDEXES)
+
+
+
+def render_frames(FILEPATH:str,DEPTH=None,PIXELS=640,WORKERS=None,CHUNK=31):
+    """ 
+        Render the maps of all days of a NetCDF file with the same color scale, CHUNK days per process,
+        then assemble them in an animated GIF
+
+        Save data into :
+            - <folder of FILEPATH>/.cache/<name of FILEPATH>-FRAMES[-<DEPTH>]/
+
+        Parameters
+        ----------
+        FILEPATH : str
+            path to a NetCDF file
+        DEPTH : float
+            nearest depth level, None for the first level
+        PIXELS : int
+            width of the maps in pixels
+        WORKERS : int
+            number of processes, None for the number of cores
+        CHUNK : int
+            number of days rendered by a process at once
+
+        Returns
+        -------
+        str
+            folder of the frames
+    """
+    FOLDER = get_frames_dir(FILEPATH,DEPTH)
+    os.makedirs(FOLDER,exist_ok=True)
+    for name in os.listdir(FOLDER): # frames of an older version of the file
+        os.remove(os.path.join(FOLDER,name))
+    ds = dp.open_dataset(FILEPATH)
+    dates = [str(d) for d in ds['time'].dt.strftime('%Y-%m-%d').values]
+    vmin,vmax = get_color_scale(FILEPATH,DEPTH)
+    ################ TO ADAPT ################
+    with open("./variables.json","r") as f:
+        style = json.load(f).get(get_variable(FILEPATH)[0],[])
+    cmap = style[2] if len(style)>2 else "viridis"
+
+    meta = {"source_mtime":str(os.stat(str(FILEPATH)).st_mtime_ns),"depth":DEPTH,"pixels":int(PIXELS),
+            "vmin":vmin,"vmax":vmax,"cmap":cmap,"dates":dates,"complete":False}
+    with open(os.path.join(FOLDER,"frames.json"),"w") as f:
+        f.write(json.dumps(meta, indent = 4))
+
+    chunks = [list(range(i,min(i+int(CHUNK),len(dates)))) for i in range(0,len(dates),int(CHUNK))]
+    with gf.process_pool(min(len(chunks),WORKERS or os.cpu_count() or 1)) as pool:
+        futures = [pool.submit(render_chunk,FILEPATH,c,DEPTH,vmin,vmax,FOLDER,PIXELS,cmap) for c in chunks]
+        for future in as_completed(futures):
+            future.result()
+
+    make_animation(FOLDER,dates)
+    meta["complete"] = True
+    with open(os.path.join(FOLDER,"frames.json"),"w") as f:
+        f.write(json.dumps(meta, indent = 4))
+    return FOLDER
+
+
+
+def render_job(FILEPATH:str,DEPTH=None,PIXELS=640,WORKERS=None):
+    """ 
+        Run render_frames in a background thread: an error is saved in frames.json ("error") to be shown
+        by the interface, instead of being lost with the thread
+    """
+    try:
+        render_frames(FILEPATH,DEPTH,PIXELS,WORKERS)
+    except Exception:
+        FOLDER = get_frames_dir(FILEPATH,DEPTH)
+        os.makedirs(FOLDER,exist_ok=True)
+        try:
+            with open(os.path.join(FOLDER,"frames.json"),"r") as f:
+                meta = json.load(f)
+        except (OSError,ValueError):
+            meta = {"source_mtime":str(os.stat(str(FILEPATH)).st_mtime_ns),"depth":DEPTH,"pixels":int(PIXELS),"dates":[]}
+        meta.update({"complete":False,"error":traceback.format_exc()})
+        with open(os.path.join(FOLDER,"frames.json"),"w") as f:
+            f.write(json.dumps(meta, indent = 4))
+
+
+
+def make_animation(FOLDER:str,DATES:list,DURATION=100):
+    """ 
+        Assemble the frames in an animated GIF (FOLDER/animation.gif)
+
+        Parameters
+        ----------
+        FOLDER : str
+            folder of the frames
+        DATES : list (str)
+            days in order
+        DURATION : int
+            milliseconds per frame
+    """
+    frames = [Image.open(os.path.join(FOLDER,d+".png")).convert("P",palette=Image.ADAPTIVE) for d in DATES
+              if os.path.exists(os.path.join(FOLDER,d+".png"))]
+    if frames==[]:
+        return
+    output = os.path.join(FOLDER,"animation.gif")
+    frames[0].save(output+".tmp",format="GIF",save_all=True,append_images=frames[1:],duration=int(DURATION),loop=0)
+    os.replace(output+".tmp",output)
+
+
+
+#########################
+# FUNCTIONS - INTERFACE #
+#########################
+
+
+def get_frames(FILEPATH:str,DEPTH=None):
+    """ 
+        Get the frames of a NetCDF file already rendered from its current version
+
+        Parameters
+        ----------
+        FILEPATH : str
+            path to a NetCDF file
+        DEPTH : float
+            nearest depth level, None for the first level
+
+        Returns
+        -------
+        dict
+            frames.json (vmin, vmax, cmap, dates, complete, error if the rendering failed...), None if not rendered
+        dict
+            key=date (YYYY-MM-DD), value=path of the frame (only frames saved)
+    """
+    FOLDER = get_frames_dir(FILEPATH,DEPTH)
+    try:
+        with open(os.path.join(FOLDER,"frames.json"),"r") as f:
+            meta = json.load(f)
+    except (OSError,ValueError):
+        return None,{}
+    if meta["source_mtime"]!=str(os.stat(str(FILEPATH)).st_mtime_ns):
+        return None,{}
+    frames = {d:os.path.join(FOLDER,d+".png") for d in meta["dates"] if os.path.exists(os.path.join(FOLDER,d+".png"))}
+    return meta,frames
+
+
+
+def start(FILEPATH:str,DEPTH=None,PIXELS=640,WORKERS=None):
+    """ 
+        Render the frames of a NetCDF file in the background (see render_job), once at a time per file and depth
+
+        Returns
+        -------
+        bool
+            True if started, False if already running
+    """
+    FOLDER = get_frames_dir(FILEPATH,DEPTH)
+    with _LOCK:
+        if (FOLDER in _JOBS) and _JOBS[FOLDER].is_alive():
+            return False
+        _JOBS[FOLDER] = threading.Thread(target=render_job,args=(FILEPATH,DEPTH,PIXELS,WORKERS),daemon=True)
+        _JOBS[FOLDER].start()
+    return True
+
+
+
+def is_running(FILEPATH:str,DEPTH=None):
+    """ True if the frames of a NetCDF file are being rendered by this process """
+    job = _JOBS.get(get_frames_dir(FILEPATH,DEPTH))
+    return (job!=None) and job.is_alive()
@@ -0,0 +1,140 @@
+###########
+# IMPORTS #
+###########
+
+import os
+import sys
+import ast
+import time
+import argparse
+import subprocess
+
+
+# Measure the time of the imports done by interface.py at each start, in a new Python process (cold start)
+# Usage: python benchmark_startup.py [--budget SECONDS] [--top N] [--module NAME ...]
+# Exit code 1 if the imports take longer than the budget.
+
+INTERFACE = os.path.join(os.path.dirname(os.path.abspath(__file__)),"interface.py")
+
+BUDGET = 3.0 # seconds
+
+
+
+#####################
+# GENERAL FUNCTIONS #
+#####################
+
+
+def get_startup_code(FILEPATH=INTERFACE):
+    """ 
+        Get the statements of interface.py run before the first page: imports, working directory, lazy imports
+
+        Parameters
+        ----------
+        FILEPATH : str
+            path to interface.py
+
+        Returns
+        -------
+        str
+            python code
+    """
+    with open(FILEPATH,"r",encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+
+    statements = []
+    for node in tree.body:
+        if isinstance(node,(ast.Import,ast.ImportFrom)):
+            statements.append(node)
+        elif isinstance(node,ast.If) and ("chdir" in ast.unparse(node)):
+            statements.append(node)
+        elif isinstance(node,ast.Assign) and ("lazy_import" in ast.unparse(node.value)):
+            statements.append(node)
+    return "\n".join(ast.unparse(n) for n in statements)
+
+
+
+def measure(CODE:str,CWD:str):
+    """ 
+        Run code in a new Python process with -X importtime
+
+        Parameters
+        ----------
+        CODE : str
+            python code
+        CWD : str
+            working directory
+
+        Returns
+        -------
+        float
+            total time in seconds
+        list of tuple (str,float,float)
+            module, self time and cumulative time in seconds
+    """
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable,"-X","importtime","-c",CODE],cwd=CWD,
+                             capture_output=True,text=True)
+    total = time.perf_counter()-start
+    if process.returncode!=0:
+        raise RuntimeError(process.stderr.strip().split("\n")[-1])
+
+    modules = []
+    for line in process.stderr.split("\n"):
+        # import time:      self [us] |   cumulative | imported package
+        if not line.startswith("import time:") or ("self [us]" in line):
+            continue
+        self_us,cumul_us,name = line[len("import time:"):].split("|")
+        modules.append((name.rstrip(),int(self_us)/1e6,int(cumul_us)/1e6))
+    return total,modules
+
+
+
+def report(TOTAL:float,MODULES:list,TOP=15):
+    """ 
+        Print the slowest top-level imports and the slowest modules
+
+        Parameters
+        ----------
+        TOTAL : float
+            total time in seconds
+        MODULES : list of tuple (str,float,float)
+            module, self time and cumulative time in seconds
+        TOP : int
+            number of lines of each table
+    """
+    print("Total: %.3fs (%d modules)" % (TOTAL,len(MODULES)))
+
+    # modules imported directly (no indentation in -X importtime)
+    first = [(name.strip(),cumul) for name,_,cumul in MODULES if not name.startswith("  ")]
+    print("\nTop-level imports (cumulative):")
+    for name,cumul in sorted(first,key=lambda m: -m[1])[:int(TOP)]:
+        print("  %8.3fs  %s" % (cumul,name))
+
+    print("\nSlowest modules (self):")
+    for name,self_s,_ in sorted(MODULES,key=lambda m: -m[1])[:int(TOP)]:
+        print("  %8.3fs  %s" % (self_s,name.strip()))
+
+
+
+########
+# MAIN #
+########
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import time of interface.py at start")
+    parser.add_argument("--budget",type=float,default=BUDGET,help="maximum time in seconds")
+    parser.add_argument("--top",type=int,default=15,help="number of modules shown")
+    parser.add_argument("--module",nargs="*",default=[],help="measure these modules instead of interface.py")
+    args = parser.parse_args()
+
+    if args.module!=[]:
+        code = "\n".join("import "+m for m in args.module)
+    else:
+        code = get_startup_code()
+    total,modules = measure(code,os.path.dirname(INTERFACE))
+    report(total,modules,args.top)
+
+    if total>args.budget:
+        print("\nSlower than the budget (%.2fs)" % args.budget)
+        sys.exit(1)
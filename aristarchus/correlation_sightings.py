@@ -3,28 +3,452 @@
 ###########
 
 import os
+import json
+import warnings
+from concurrent.futures import as_completed
 
 import xarray as xr
 import pandas as pd
-import matplotlib.pyplot as plt
+import numpy as np
 import plotly.express as px
 
 import general_function as gf
+import dataset_pool as dp
+import spatial_index as si
+import occurrences_store as store
+
+
+# Columns identifying a sighting
+KEYS = ['Date','Latitude','Longitude','Occurrences']
+ID_VERSION = 2 # version of sighting_id, the merge of CORR files is done again when it changes
+
+
+#####################
+# GENERAL FUNCTIONS #
+#####################
+
+
+def get_grid_dims(DS):
+    """ 
+        Get names of the spatial dimensions of a dataset
+
+        Parameters
+        ----------
+        DS : Dataset or DataArray
+            xarray object opened from a NetCDF file
+
+        Returns
+        -------
+        tuple (str)
+            (y dimension, x dimension)
+    """
+    latname,lonname = gf.get_latlon_names(DS)
+    if si.is_curvilinear(DS):
+        return tuple(DS[latname].dims)
+    return (latname,lonname)
+
+
+
+def nearest_indices(DS,DATES,LATS,LONS,FILEPATH=None):
+    """ 
+        Get index of the nearest time and pixel of several points
+
+        Parameters
+        ----------
+        DS : Dataset
+            dataset opened from a NetCDF file
+        DATES : array (datetime)
+            date of each point
+        LATS : array (float)
+            latitude of each point
+        LONS : array (float)
+            longitude of each point
+        FILEPATH : str
+            path to the NetCDF file, used to save the spatial index of curvilinear grids
+
+        Returns
+        -------
+        dict
+            key=dimension ('time' and dimensions of get_grid_dims), value=array of indexes (int)
+        array (bool)
+            False if the nearest pixel is farther than the resolution of the grid
+    """
+    latname,lonname = gf.get_latlon_names(DS)
+    dates = pd.to_datetime(np.asarray(DATES))
+    lats = np.asarray(LATS,dtype=float)
+    lons = np.asarray(LONS,dtype=float)
+
+    # get index of nearest time
+    indexes = {'time':DS.indexes['time'].get_indexer(dates,method='nearest')}
+
+    if si.is_curvilinear(DS):
+        # get index of nearest pixel with the spatial index of the grid
+        index = si.get_spatial_index(DS,FILEPATH)
+        cell,dist,size = index.query_nearest(lats,lons)
+        valid = dist <= size*np.sqrt(2)
+        for dim,idx in zip(DS[latname].dims,index.unravel(cell)):
+            indexes[dim] = idx
+    else:
+        # get index of nearest lat and lon
+        yi = DS.indexes[latname].get_indexer(lats,method='nearest')
+        xi = DS.indexes[lonname].get_indexer(lons,method='nearest')
+        indexes[latname] = yi
+        indexes[lonname] = xi
+
+        # check if lat lon in range (resolution around the pixel found, grid can be irregular)
+        lat = DS[latname].values
+        lon = DS[lonname].values
+        lat_res = np.abs(np.gradient(lat)) if len(lat)>1 else np.full(1,np.inf)
+        lon_res = np.abs(np.gradient(lon)) if len(lon)>1 else np.full(1,np.inf)
+        valid = (np.abs(lats-lat[yi]) <= lat_res[yi]) & (np.abs(lons-lon[xi]) <= lon_res[xi])
+
+    return indexes,valid
+
+
+
+def depth_label(DEPTH:float):
+    """ 
+        Name of a depth level in columns of CORR files
+
+        Parameters
+        ----------
+        DEPTH : float
+            depth in meters
+
+        Returns
+        -------
+        str
+            ex: 0.49m
+    """
+    return "%gm" % round(float(DEPTH),2)
+
+
+
+def depth_indices(DS,DEPTHS):
+    """ 
+        Get the nearest depth level of several target depths
+
+        Parameters
+        ----------
+        DS : Dataset
+            dataset with a 'depth' coordinate
+        DEPTHS : array (float)
+            target depth of each point (NaN if unknown)
+
+        Returns
+        -------
+        array (int)
+            index of the nearest level
+        array (bool)
+            False if the target depth is unknown
+    """
+    levels = np.asarray(DS['depth'].values,dtype=float)
+    targets = np.abs(np.asarray(DEPTHS,dtype=float)) # depths are positive downward
+    known = np.isfinite(targets)
+    order = np.argsort(levels)
+    pos = np.clip(np.searchsorted(levels[order],np.where(known,targets,0)),1,max(len(levels)-1,1))
+    below = order[np.minimum(pos,len(levels)-1)]
+    above = order[pos-1]
+    idx = np.where(np.abs(levels[below]-targets) < np.abs(levels[above]-targets),below,above)
+    return idx.astype(int),known
+
+
+
+def extract_points(DS,VAR:str,DATES,LATS,LONS,FILEPATH=None,DEPTH=None):
+    """ 
+        Get values of a variable at the nearest pixel of several points, in one vectorized selection
+
+        Parameters
+        ----------
+        DS : Dataset
+            dataset opened from a NetCDF file
+        VAR : str
+            name of the variable
+        DATES : array (datetime)
+            date of each point
+        LATS : array (float)
+            latitude of each point
+        LONS : array (float)
+            longitude of each point
+        FILEPATH : str
+            path to the NetCDF file, used to save the spatial index of curvilinear grids
+        DEPTH : None, "levels" or array (float)
+            only for variables with depth:
+            None for the mean over depth, "levels" for all levels, array for the nearest level of a target depth of each point
+
+        Returns
+        -------
+        array (float)
+            value at each point (mean over depth if available),
+            NaN if the nearest pixel is farther than the resolution of the grid
+            shape (points,levels) if DEPTH="levels"
+    """
+    if len(LATS)==0:
+        return np.array([],dtype=float)
+    indexes,valid = nearest_indices(DS,DATES,LATS,LONS,FILEPATH)
+
+    has_depth = 'depth' in DS[VAR].dims
+    if has_depth and (DEPTH is not None) and (not isinstance(DEPTH,str)):
+        # 1 level per point, selected with the other dimensions
+        indexes['depth'],known = depth_indices(DS,DEPTH)
+        valid = valid & known
+
+    # gather all points at once
+    points = DS[VAR].isel({dim:xr.DataArray(idx,dims='points') for dim,idx in indexes.items()})
+    if has_depth and isinstance(DEPTH,str) and (DEPTH=="levels"):
+        values = points.transpose('points','depth').values.astype(float)
+        values[~valid,:] = np.nan
+        return values
+
+    values = points.values.astype(float)
+    if 'depth' in points.dims:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning) # mean of empty slice
+            values = np.nanmean(values,axis=points.get_axis_num('depth'))
+
+    values[~valid] = np.nan
+    return values
+
+
+
+def get_summed_area_tables(DS,VAR:str,FILEPATH=None):
+    """ 
+        Get 3D summed-area tables (cumulative sums over time, y and x) of a variable,
+        used to compute mean and variance of any box in O(1)
+        The variable is averaged over depth if available
+        Sums are computed on values minus their global mean (offset), to keep the precision of the variance
+
+        Save tables into (if FILEPATH):
+            - <folder of FILEPATH>/.cache/<name of FILEPATH>-SAT-<VAR>.npy
+            - <folder of FILEPATH>/.cache/<name of FILEPATH>-SAT-<VAR>.json : offset
+
+        Parameters
+        ----------
+        DS : Dataset
+            dataset opened from a NetCDF file
+        VAR : str
+            name of the variable
+        FILEPATH : str
+            path to the NetCDF file, None to not save the tables
+
+        Returns
+        -------
+        array (float)
+            shape (3,time+1,y+1,x+1): sum of values, sum of squared values, number of values
+        float
+            offset subtracted from the values (see box_statistics)
+    """
+    if FILEPATH!=None:
+        path = gf.get_cache_path(FILEPATH,"-SAT-"+str(VAR)+".npy")
+        path_offset = gf.get_cache_path(FILEPATH,"-SAT-"+str(VAR)+".json")
+        if os.path.exists(path) and os.path.exists(path_offset) and (os.path.getmtime(path_offset)>=os.path.getmtime(FILEPATH)):
+            with open(path_offset,"r") as f:
+                offset = json.load(f)["offset"]
+            return np.load(path,mmap_mode='r'),offset
+
+    da = DS[VAR]
+    if 'depth' in da.dims:
+        da = da.mean('depth',skipna=True)
+    cube = da.transpose('time',*get_grid_dims(DS)).values.astype(float)
+
+    valid = np.isfinite(cube)
+    offset = float(cube[valid].mean()) if valid.any() else 0.0
+    cube -= offset
+    cube[~valid] = 0
+    sat = np.zeros((3,)+tuple(n+1 for n in cube.shape))
+    sat[0,1:,1:,1:] = cube
+    sat[1,1:,1:,1:] = cube**2
+    sat[2,1:,1:,1:] = valid
+    for axis in (1,2,3):
+        np.cumsum(sat,axis=axis,out=sat)
+
+    if FILEPATH!=None:
+        np.save(path,sat)
+        with open(path_offset,"w") as f: # written last: tables are valid if the offset is newer than the file
+            f.write(json.dumps({"offset":offset}, indent = 4))
+    return sat,offset
+
+
+
+def box_statistics(SAT,INDEXES,RADIUS:int,DAYS:int,OFFSET=0.0):
+    """ 
+        Get mean, standard deviation and number of values in boxes around several pixels
+
+        Parameters
+        ----------
+        SAT : array (float)
+            summed-area tables from get_summed_area_tables
+        INDEXES : list of array (int)
+            index of time, y and x of each pixel
+        RADIUS : int
+            half size of the box in pixels (y and x)
+        DAYS : int
+            half size of the box in days
+        OFFSET : float
+            offset subtracted from the values in the tables, added back to the mean
+
+        Returns
+        -------
+        array (float)
+            mean
+        array (float)
+            standard deviation
+        array (int)
+            number of values
+    """
+    lo = []
+    hi = []
+    for idx,half,n in zip(INDEXES,(DAYS,RADIUS,RADIUS),SAT.shape[1:]):
+        idx = np.asarray(idx,dtype=int)
+        lo.append(np.clip(idx-half,0,n-1))
+        hi.append(np.clip(idx+half+1,0,n-1))
+
+    # inclusion-exclusion on the 8 corners of each box
+    total = 0
+    for ct in (0,1):
+        for cy in (0,1):
+            for cx in (0,1):
+                sign = -1 if (ct+cy+cx)%2==0 else 1
+                corner = ((hi if ct else lo)[0],(hi if cy else lo)[1],(hi if cx else lo)[2])
+                total = total + sign*SAT[:,corner[0],corner[1],corner[2]]
+    s1,s2,count = total
+    count = np.rint(count).astype(int)
+
+    with np.errstate(invalid='ignore',divide='ignore'):
+        mean = s1/count
+        var = np.maximum(s2/count-mean**2,0)
+    return mean+OFFSET,np.sqrt(var),count
+
+
 
 #########################
 # FUNCTIONS - INTERFACE #
 #########################
 
 
-def correlation(BDIR:str,CSVPATH:str,SERVICE:str,SAVE=True):
+def correlation_product(BDIR:str,CSVPATH:str,SERVICE:str,PRODUCT:str,PTS:pd.DataFrame,DATES,SAVE=True,BUFFER_PIXELS=0,BUFFER_DAYS=0,DEPTH="mean",DEPTH_COL="Depth",LAYOUT="wide"):
+    """ 
+        Correlation an environmental variable of 1 NetCDF file with sightings of the same year
+
+        Save data into :
+            - <BDIR>/Results/<SERVICE>/<PRODUCT>__<CSVFILE>-CORR.csv
+
+        Parameters
+        ----------
+        BDIR : str
+            path to the backup folder
+        CSVPATH : str
+            path of the csv file containing sightings
+        SERVICE : str
+            name of the service
+        PRODUCT : str
+            name of the NetCDF file
+        PTS : DataFrame
+            sightings of the year of PRODUCT
+        DATES : Series (datetime)
+            parsed dates of PTS
+        BUFFER_PIXELS : int
+            radius (in pixels) of the buffer around each sighting, 0 for no buffer
+        BUFFER_DAYS : int
+            number of days before and after each sighting in the buffer
+        DEPTH : str
+            only for variables with depth, the mean over depth is always saved in <var>
+            "mean", "levels" (value at each level) or "target" (value at the nearest level of the depth of each sighting)
+        DEPTH_COL : str
+            column of PTS with the depth of each sighting (DEPTH="target")
+        LAYOUT : str
+            DEPTH="levels" only, "wide" (1 column per level) or "long" (1 row per level)
+
+        Returns
+        -------
+        DataFrame
+            empty if PRODUCT is a monthly file
+    """
+    # Sample the raster at every point location and store values in DataFrame
+    path_to_file = os.path.join(str(BDIR),'NetCDF_files',str(SERVICE),PRODUCT)
+    ds = dp.open_dataset(path_to_file)
+
+    # Check if this is a monthly file
+    if ds.sizes['time']<13:
+        return pd.DataFrame()
+
+    ### EXTRACT FROM FILENAME
+    VAR_FULL = PRODUCT.split('__')[0]
+    VAR = VAR_FULL.split("pfx")[-1]
+    D = ""
+    if "]" in VAR:
+        D = VAR.split("]")[0]
+        D = D.replace("[","")
+        VAR = VAR.split("]")[-1]
+
+    pts = PTS.reset_index(drop=True)
+    data = extract_points(ds,VAR,DATES,
+                          pts['Latitude'].astype(float),
+                          pts['Longitude'].astype(float),
+                          path_to_file)
+    pts[VAR] = data
+
+    # Buffer around sightings
+    if (int(BUFFER_PIXELS)>0) or (int(BUFFER_DAYS)>0):
+        indexes,valid = nearest_indices(ds,DATES,pts['Latitude'].astype(float),pts['Longitude'].astype(float),path_to_file)
+        sat,offset = get_summed_area_tables(ds,VAR,path_to_file)
+        mean,std,count = box_statistics(sat,[indexes[d] for d in ('time',)+get_grid_dims(ds)],int(BUFFER_PIXELS),int(BUFFER_DAYS),offset)
+        suf = "_"+str(int(BUFFER_PIXELS))+"px_"+str(int(BUFFER_DAYS))+"d"
+        pts[VAR+"_mean"+suf] = np.where(valid,mean,np.nan)
+        pts[VAR+"_std"+suf] = np.where(valid,std,np.nan)
+        pts[VAR+"_n"+suf] = np.where(valid,count,0)
+
+    # Values along depth
+    if ('depth' in ds[VAR].dims) and (DEPTH=="target") and (DEPTH_COL in pts.columns):
+        targets = pd.to_numeric(pts[DEPTH_COL],errors='coerce').to_numpy(dtype=float)
+        pts[VAR+"_target"] = extract_points(ds,VAR,DATES,
+                                            pts['Latitude'].astype(float),
+                                            pts['Longitude'].astype(float),
+                                            path_to_file,DEPTH=targets)
+        idx,known = depth_indices(ds,targets)
+        pts[VAR+"_target_depth"] = np.where(known,ds['depth'].values[idx],np.nan)
+    elif ('depth' in ds[VAR].dims) and (DEPTH=="levels"):
+        levels = extract_points(ds,VAR,DATES,
+                                pts['Latitude'].astype(float),
+                                pts['Longitude'].astype(float),
+                                path_to_file,DEPTH="levels")
+        depths = ds['depth'].values
+        if LAYOUT=="long":
+            # repeat each sighting for each level
+            pts = pts.loc[pts.index.repeat(len(depths))].reset_index(drop=True)
+            pts["level_depth"] = np.tile(depths,len(levels))
+            pts[VAR+"_level"] = levels.ravel()
+        else:
+            wide = pd.DataFrame(levels,columns=[VAR+"_"+depth_label(d) for d in depths],index=pts.index)
+            pts = pd.concat([pts,wide],axis=1)
+
+    pts = pts.loc[:, ~pts.columns.str.contains('^Unnamed')]
+
+    ################ TO ADAPT ################
+    # Save in file
+    if SAVE == True:
+        path = os.path.join(str(BDIR),"Results",str(SERVICE))
+        os.makedirs(path,exist_ok=True)
+        output_file = os.path.join(path,PRODUCT+"__"+(os.path.split(str(CSVPATH))[1]).replace(".csv","")+"-CORR.csv")
+        pts.to_csv(output_file, sep=',', encoding='utf-8')
+
+    return pts
+
+
+
+def correlation(BDIR:str,CSVPATH:str,SERVICE:str,SAVE=True,WORKERS=None,BUFFER_PIXELS=0,BUFFER_DAYS=0,DEPTH="mean",DEPTH_COL="Depth",LAYOUT="wide"):
     """ 
         Correlation an environmental variable with sightings
+        NetCDF files are processed in parallel, each file is saved as soon as it is finished
 
         Save data into :
             - <BDIR>/Results/<SERVICE>/<PRODUCT>__<CSVFILE>-CORR.csv
 
         With data (sep=,):
             Latitude, Longitude, Date, Occurrences, <var>
+            + if buffer: <var>_mean_<BUFFER_PIXELS>px_<BUFFER_DAYS>d, <var>_std_..., <var>_n_...
+            + if DEPTH="target": <var>_target, <var>_target_depth
+            + if DEPTH="levels": <var>_<depth>m for each level (wide), or level_depth, <var>_level (long)
 
         Parameters
         ----------
@@ -34,120 +458,399 @@ def correlation(BDIR:str,CSVPATH:str,SERVICE:str,SAVE=True):
             path of the csv file containing sightings, columns names 'Latitude', 'Longitude', 'Date', 'Occurrences'
         SERVICE : str
             name of the service
+        WORKERS : int
+            number of processes, None for the number of cores
+        BUFFER_PIXELS : int
+            radius (in pixels) of the buffer around each sighting, 0 for no buffer
+        BUFFER_DAYS : int
+            number of days before and after each sighting in the buffer
+        DEPTH : str
+            "mean", "levels" or "target" (see correlation_product)
+        DEPTH_COL : str
+            column of the csv file with the depth of each sighting (DEPTH="target")
+        LAYOUT : str
+            "wide" or "long" (DEPTH="levels")
 
         Returns
         -------
         list of DataFrame
+            1 per NetCDF file, empty if no sighting this year
     """
-    result = []
     # Read points from csv
-    all_pts = pd.read_csv(str(CSVPATH))
-    # get time range occurrences
-    pts_miny =  pd.to_datetime(all_pts[['Date']].min().Date, format='mixed').year
-    pts_maxy =  pd.to_datetime(all_pts[['Date']].max().Date, format='mixed').year
-
+    all_pts = store.read_occurrences(CSVPATH)
+    # partition sightings by year (dates already parsed in the store)
+    all_dates = all_pts['Date']
+    years = {int(y):idx for y,idx in all_pts.groupby('Year').groups.items()}
+    all_pts = all_pts.drop(columns=['Year'])
 
     prods = gf.show_available_files_simple(BDIR+"/NetCDF_files",SERVICE)
+    jobs = {}
     for product in prods:
         # verif if year present in occurrence file
         YEAR = product.split('__')[-1] ### EXTRACT FROM FILENAME
-        if (int(YEAR) < pts_miny) or (int(YEAR) > pts_maxy):
-            result.append(pd.DataFrame())
-            pass
+        if int(YEAR) in years:
+            idx = years[int(YEAR)]
+            jobs[product] = (all_pts.loc[idx],all_dates.loc[idx])
+
+    result = {}
+    if len(jobs)==1:
+        for product,(pts,dates) in jobs.items():
+            result[product] = correlation_product(BDIR,CSVPATH,SERVICE,product,pts,dates,SAVE,BUFFER_PIXELS,BUFFER_DAYS,DEPTH,DEPTH_COL,LAYOUT)
+    elif len(jobs)>1:
+        with gf.process_pool(min(len(jobs),WORKERS or os.cpu_count() or 1)) as pool:
+            futures = {pool.submit(correlation_product,BDIR,CSVPATH,SERVICE,product,pts,dates,SAVE,BUFFER_PIXELS,BUFFER_DAYS,DEPTH,DEPTH_COL,LAYOUT):product
+                       for product,(pts,dates) in jobs.items()}
+            for future in as_completed(futures):
+                result[futures[future]] = future.result()
+
+    return [result.get(product,pd.DataFrame()) for product in prods]
+
+
+
+def get_valid_mask(DS,VAR:str,FILEPATH=None):
+    """ 
+        Get valid pixels of a variable (at least 1 value over the year: ocean pixels)
+
+        Save mask into (if FILEPATH):
+            - <folder of FILEPATH>/.cache/<name of FILEPATH>-MASK-<VAR>.npy
+
+        Parameters
+        ----------
+        DS : Dataset
+            dataset opened from a NetCDF file
+        VAR : str
+            name of the variable
+        FILEPATH : str
+            path to the NetCDF file, None to not save the mask
+
+        Returns
+        -------
+        array (bool)
+            shape of the grid (see get_grid_dims)
+    """
+    if FILEPATH!=None:
+        path = gf.get_cache_path(FILEPATH,"-MASK-"+str(VAR)+".npy")
+        if os.path.exists(path) and (os.path.getmtime(path)>=os.path.getmtime(FILEPATH)):
+            return np.load(path)
+
+    grid_dims = get_grid_dims(DS)
+    da = DS[VAR].notnull()
+    mask = da.any([d for d in da.dims if d not in grid_dims]).transpose(*grid_dims).values
+
+    if FILEPATH!=None:
+        np.save(path,mask)
+    return mask
+
+
+
+def stratified_sample(CELLS,N:int,DAYS:int,RNG):
+    """ 
+        Stratified sampling of pixels: for each day, 1 pixel in each of the N strata of CELLS
+        (stratum k = CELLS[k*len(CELLS)/N:(k+1)*len(CELLS)/N])
+
+        Parameters
+        ----------
+        CELLS : array (int)
+            flat index of the valid pixels, in order
+        N : int
+            number of points per day
+        DAYS : int
+            number of days
+        RNG : numpy Generator
+
+        Returns
+        -------
+        array (int)
+            shape (DAYS,N), pixels of CELLS
+    """
+    k = np.arange(int(N))
+    pick = np.floor((k+RNG.random((int(DAYS),int(N))))*len(CELLS)/int(N)).astype(int)
+    return np.asarray(CELLS)[np.minimum(pick,len(CELLS)-1)]
+
+
+
+def background_sampling(BDIR:str,CSVPATH:str,SERVICE:str,N=1000,SEED=0,SAVE=True):
+    """ 
+        Sample random background points (pseudo-absences) for each day with sightings,
+        on valid pixels inside the coordinates of the backup folder, and get all variables of the service at these points
+        Points are stratified over the valid pixels (1 point per stratum of pixels)
+
+        Save data into :
+            - <BDIR>/Results/<SERVICE>/<YEAR>__<CSVFILE>-BACKGROUND.csv
+
+        With data (sep=,):
+            Latitude, Longitude, Date, <fullvar>
+
+        Parameters
+        ----------
+        BDIR : str
+            path to the backup folder
+        CSVPATH : str
+            path of the csv file containing sightings
+        SERVICE : str
+            name of the service
+        N : int
+            number of points per day
+        SEED : int
+            seed of the random generator (same points for the same seed)
+
+        Returns
+        -------
+        list of DataFrame
+            1 per year
+    """
+    path_coord = os.path.join(str(BDIR),"coordinates.json")
+    with open(path_coord,"r") as f:
+        json_dict = json.load(f)
+    LONG = [float(l) for l in json_dict["LONG"]]
+    LAT = [float(l) for l in json_dict["LAT"]]
+
+    # Get days with sightings
+    all_days = store.read_occurrences(CSVPATH)['Date'].dt.normalize()
+
+    # Get files of each year
+    prods = gf.show_available_files_simple(BDIR+"/NetCDF_files",SERVICE)
+    years = {}
+    for product in prods:
+        YEAR = product.split('__')[-1] ### EXTRACT FROM FILENAME
+        years.setdefault(int(YEAR),[]).append(product)
+
+    rng = np.random.default_rng(SEED)
+    result = []
+    for YEAR in sorted(years.keys()):
+        days = np.sort(all_days[all_days.dt.year==YEAR].unique())
+        if len(days)==0:
+            continue
+
+        # valid pixels inside coordinates, on the grid of the first file
+        path_to_file = os.path.join(str(BDIR),'NetCDF_files',str(SERVICE),years[YEAR][0])
+        ds = dp.open_dataset(path_to_file)
+        VAR = years[YEAR][0].split('__')[0].split("pfx")[-1].split("]")[-1] ### EXTRACT FROM FILENAME
+        latname,lonname = gf.get_latlon_names(ds)
+        lat = ds[latname].values
+        lon = ds[lonname].values
+        curvilinear = si.is_curvilinear(ds)
+        if not curvilinear:
+            lat_res = np.abs(np.gradient(lat)) if len(lat)>1 else np.zeros(1)
+            lon_res = np.abs(np.gradient(lon)) if len(lon)>1 else np.zeros(1)
+            lon2d,lat2d = np.meshgrid(lon,lat)
         else:
-            # filter by year
-            pts = all_pts[(all_pts['Date'].str.contains(YEAR))].reset_index()
+            lat2d,lon2d = lat,lon
+        mask = get_valid_mask(ds,VAR,path_to_file)
+        mask = mask & (lat2d>=min(LAT)) & (lat2d<=max(LAT)) & (lon2d>=min(LONG)) & (lon2d<=max(LONG))
+        cells = np.flatnonzero(mask)
+        if len(cells)==0:
+            continue
+
+        cell = stratified_sample(cells,int(N),len(days),rng).ravel()
+        yi,xi = np.unravel_index(cell,mask.shape)
+        if curvilinear:
+            lats = lat2d[yi,xi]
+            lons = lon2d[yi,xi]
+        else: # random position inside the pixel
+            lats = lat[yi]+(rng.random(len(cell))-0.5)*lat_res[yi]
+            lons = lon[xi]+(rng.random(len(cell))-0.5)*lon_res[xi]
+        dates = np.repeat(days,int(N))
+        pts = pd.DataFrame({'Latitude':lats,'Longitude':lons,'Date':pd.to_datetime(dates)})
 
-            # Sample the raster at every point location and store values in DataFrame
+        # get all variables of the year at once for each file
+        for product in years[YEAR]:
             path_to_file = os.path.join(str(BDIR),'NetCDF_files',str(SERVICE),product)
-            ds = xr.open_dataset(path_to_file)
-            df = ds.to_dataframe().reset_index()
-
-            # Check if this is a monthly file
-            all_dates = df['time'].unique()
-            if len(all_dates)<13:
-                return pd.DataFrame()
-
-            # Get lat and lon names
-            latname = "lat"
-            lonname = "lon"
-            for c in df.columns:
-                if 'lat' in c.lower():
-                    latname = c
-                if 'lon' in c.lower():
-                    lonname = c
-                    
-            if'depth' in df.columns:
-                colsearch = ['time',latname,lonname,'depth']
-            else:
-                colsearch = ['time',latname,lonname]
-            
-            # get resolution
-            lat = ds[latname] 
-            lon = ds[lonname] 
-            lat_res = abs(lat[1] - lat[0]).values 
-            lon_res = abs(lon[1] - lon[0]).values 
-        
+            ds = dp.open_dataset(path_to_file)
+            if ds.sizes['time']<13: # monthly file
+                continue
+            VAR_FULL = product.split('__')[0] ### EXTRACT FROM FILENAME
+            VAR = VAR_FULL.split("pfx")[-1].split("]")[-1]
+            pts[VAR_FULL] = extract_points(ds,VAR,pts['Date'],pts['Latitude'],pts['Longitude'],path_to_file)
+
+        ################ TO ADAPT ################
+        # Save in file
+        if SAVE == True:
+            path = os.path.join(str(BDIR),"Results",str(SERVICE))
+            os.makedirs(path,exist_ok=True)
+            output_file = os.path.join(path,str(YEAR)+"__"+(os.path.split(str(CSVPATH))[1]).replace(".csv","")+"-BACKGROUND.csv")
+            pts.to_csv(output_file, sep=',', encoding='utf-8')
 
-            ### EXTRACT FROM FILENAME
-            VAR_FULL = product.split('__')[0]
-            VAR = VAR_FULL.split("pfx")[-1]
-            D = ""
-            if "]" in VAR:
-                D = VAR.split("]")[0]
-                D = D.replace("[","")
-                VAR = VAR.split("]")[-1]
-
-
-            data = []
-            for i in range(len(pts)):
-                # get date of occ
-                _date = pd.to_datetime(pts.at[i,'Date'], format='mixed')
-                
-                # get lat and lon of occ
-                _lat = float(pts.at[i,'Latitude'])
-                _long = float(pts.at[i,'Longitude'])
-
-                # search at lat and lon in netcdf
-                try :
-                    closest_point = ds.sel(time=_date,lon=_long, lat=_lat, method='nearest')
-                except :
-                    closest_point = ds.sel(time=_date,longitude=_long, latitude=_lat, method='nearest')
-                if len(closest_point.dims)==0:
-                    closest_point = closest_point.expand_dims(VAR)
-                df_CP = closest_point.to_dataframe().reset_index()
-                
-                # check if lat lon in range
-                lat_found = df_CP[latname][0]
-                lon_found = df_CP[lonname][0]
-                if (abs(_lat-lat_found) > lat_res) or (abs(_long-lon_found) > lon_res):
-                    data_mean = None
-                    pass
-                else :
-                    df_CP = df_CP.drop(colsearch,axis=1)
-                    if len(df_CP)>1:
-                        data_mean = df_CP[VAR].dropna(how='any').mean()
-                    else :
-                        data_mean = df_CP.at[0,VAR]
-
-                data.append(data_mean)
-            pts[VAR] = data
-            pts = pts.loc[:, ~pts.columns.str.contains('^Unnamed')].drop("index",axis=1)
-
-            ################ TO ADAPT ################
-            # Save in file
-            if SAVE == True:
-                path = os.path.join(str(BDIR),"Results",str(SERVICE))
-                if not os.path.exists(path):
-                    os.mkdir(path)
-                output_file = os.path.join(path,product+"__"+(os.path.split(str(CSVPATH))[1]).replace(".csv","")+"-CORR.csv")
-                pts.to_csv(output_file, sep=',', encoding='utf-8')
-            
-            result.append(pts)
+        result.append(pts)
     return result
 
 
 
+def preference_product(BDIR:str,SERVICE:str,PRODUCT:str,CSVFILE:str,N_PERM=1000,SEED=0):
+    """ 
+        Permutations of the preference test for 1 NetCDF file: values at sightings are compared to 
+        values drawn at random among all valid pixels of the same day
+
+        Parameters
+        ----------
+        BDIR : str
+            path to the backup folder
+        SERVICE : str
+            name of the service
+        PRODUCT : str
+            name of the NetCDF file
+        CSVFILE : str
+            name of the csv file containing sightings
+        N_PERM : int
+            number of permutations
+        SEED : int or list (int)
+            seed of the random generator
+
+        Returns
+        -------
+        dict
+            key=occurrences (and 'all'), value=dict of sums: n, obs, exp, var, null (array, 1 per permutation)
+    """
+    ### EXTRACT FROM FILENAME
+    VAR = PRODUCT.split('__')[0].split("pfx")[-1].split("]")[-1]
+
+    path_corr = os.path.join(str(BDIR),"Results",str(SERVICE),PRODUCT+"__"+str(CSVFILE).replace(".csv","")+"-CORR.csv")
+    df = pd.read_csv(path_corr,index_col=0,sep=",")
+    if "level_depth" in df.columns: # long layout, 1 row per depth level
+        df = df.drop_duplicates(subset=['Date','Latitude','Longitude','Occurrences'])
+    df = df[df[VAR].notna()]
+    if df.empty:
+        return {}
+
+    # values available on each day with sightings
+    path_to_file = os.path.join(str(BDIR),'NetCDF_files',str(SERVICE),PRODUCT)
+    ds = dp.open_dataset(path_to_file)
+    ti = ds.indexes['time'].get_indexer(pd.to_datetime(df['Date'], format='mixed'),method='nearest')
+    days,day_of_pt = np.unique(ti,return_inverse=True)
+    da = ds[VAR].isel(time=days)
+    if 'depth' in da.dims:
+        da = da.mean('depth',skipna=True)
+    values = da.values.reshape(len(days),-1).astype(float)
+
+    # ragged array of valid values: values of day d = avail[offset[d]:offset[d]+count[d]]
+    valid = np.isfinite(values)
+    count = valid.sum(axis=1)
+    offset = np.concatenate(([0],np.cumsum(count)[:-1]))
+    avail = values[valid]
+    with np.errstate(invalid='ignore',divide='ignore'):
+        day_mean = np.nansum(values,axis=1)/count
+        day_var = np.nansum(values**2,axis=1)/count-day_mean**2
+
+    # sightings without available value this day are not tested
+    keep = count[day_of_pt]>0
+    df = df[keep]
+    day_of_pt = day_of_pt[keep]
+    if df.empty:
+        return {}
+    obs = df[VAR].to_numpy(dtype=float)
+
+    # categories as an indicator matrix (sightings x categories), 'all' first
+    categories = ['all']+list(df['Occurrences'].astype(str).unique())
+    indicator = np.zeros((len(df),len(categories)))
+    indicator[:,0] = 1
+    for j,c in enumerate(categories[1:]):
+        indicator[:,j+1] = (df['Occurrences'].astype(str)==c).to_numpy()
+
+    # permutations by batches of bounded size
+    rng = np.random.default_rng(SEED)
+    null = np.zeros((int(N_PERM),len(categories)))
+    batch = max(1,int(1e7//len(df)))
+    for start in range(0,int(N_PERM),batch):
+        size = min(batch,int(N_PERM)-start)
+        idx = offset[day_of_pt]+np.floor(rng.random((size,len(df)))*count[day_of_pt]).astype(int)
+        null[start:start+size] = avail[idx] @ indicator
+
+    result = {}
+    for j,c in enumerate(categories):
+        sel = indicator[:,j]==1
+        result[c] = {'n':int(sel.sum()),
+                     'obs':float(obs[sel].sum()),
+                     'exp':float(day_mean[day_of_pt][sel].sum()),
+                     'var':float(day_var[day_of_pt][sel].sum()),
+                     'null':null[:,j]}
+    return result
+
+
+
+def preference_test(BDIR:str,CSVFILE:str,SERVICE:str,N_PERM=1000,SEED=0,WORKERS=None):
+    """ 
+        Randomization test of environmental preference: are values at sightings different from 
+        the values available (all valid pixels) on the same days?
+
+        Save data into :
+            - <BDIR>/<CSVFILE>-PREFERENCE.csv
+
+        With data (sep=,):
+            variable, Occurrences, n, mean_sightings, mean_available, effect_size, z, p_value
+            - effect_size : (mean_sightings-mean_available)/standard deviation of available values
+            - z : (mean_sightings-mean_available)/standard deviation of permutations
+            - p_value : two-sided, from permutations
+
+        Parameters
+        ----------
+        BDIR : str
+            path to the backup folder
+        CSVFILE : str
+            name of the csv file containing sightings (correlation already done)
+        SERVICE : str
+            name of the service
+        N_PERM : int
+            number of permutations
+        SEED : int
+            seed of the random generator
+        WORKERS : int
+            number of processes, None for the number of cores
+
+        Returns
+        -------
+        DataFrame
+    """
+    end = "__"+str(CSVFILE).replace(".csv","")+"-CORR.csv"
+    prods = [p for p in gf.show_available_files_simple(BDIR+"/NetCDF_files",SERVICE)
+             if os.path.exists(os.path.join(str(BDIR),"Results",str(SERVICE),p+end))]
+
+    # permutations of each file, sums of years are added by variable
+    results = {}
+    if len(prods)==1:
+        results[prods[0]] = preference_product(BDIR,SERVICE,prods[0],CSVFILE,N_PERM,[SEED,0])
+    elif len(prods)>1:
+        with gf.process_pool(min(len(prods),WORKERS or os.cpu_count() or 1)) as pool:
+            futures = {pool.submit(preference_product,BDIR,SERVICE,p,CSVFILE,N_PERM,[SEED,i]):p for i,p in enumerate(prods)}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+
+    sums = {}
+    for product in prods:
+        VAR_FULL = product.split('__')[0] ### EXTRACT FROM FILENAME
+        for c,r in results[product].items():
+            if (VAR_FULL,c) not in sums:
+                sums[(VAR_FULL,c)] = {'n':0,'obs':0.0,'exp':0.0,'var':0.0,'null':np.zeros(int(N_PERM))}
+            for k in r:
+                sums[(VAR_FULL,c)][k] = sums[(VAR_FULL,c)][k]+r[k]
+
+    data = {'variable':[],'Occurrences':[],'n':[],'mean_sightings':[],'mean_available':[],'effect_size':[],'z':[],'p_value':[]}
+    for (VAR_FULL,c),r in sums.items():
+        n = r['n']
+        obs = r['obs']/n
+        exp = r['exp']/n
+        null = r['null']/n
+        with np.errstate(invalid='ignore',divide='ignore'):
+            effect = (obs-exp)/np.sqrt(r['var']/n)
+            z = (obs-exp)/null.std()
+        p = (1+np.sum(np.abs(null-exp) >= abs(obs-exp)))/(len(null)+1)
+        data['variable'].append(VAR_FULL)
+        data['Occurrences'].append(c)
+        data['n'].append(n)
+        data['mean_sightings'].append(obs)
+        data['mean_available'].append(exp)
+        data['effect_size'].append(effect)
+        data['z'].append(z)
+        data['p_value'].append(p)
+    df = pd.DataFrame(data)
+
+    # save in file
+    output_file = os.path.join(str(BDIR),str(CSVFILE).split(".")[0]+"-PREFERENCE.csv")
+    df.to_csv(output_file,sep=',')
+
+    return df
+
+
+
 def get_occ_infos(CSVPATH:str):
     """
         Get available years and occurrences name in the csv file.
@@ -162,22 +865,76 @@ def get_occ_infos(CSVPATH:str):
         list(int)
         list(str)
     """
-    df = pd.read_csv(str(CSVPATH))
-    
-    all_y = []
-    for d in df['Date']:
-        year = pd.to_datetime(str(d), format='mixed').year
-        if year not in all_y:
-            all_y.append(year)
+    meta = store.read_metadata(CSVPATH)
+    return meta["years"],meta["categories"]
 
-    occ = df['Occurrences'].unique()
-    return all_y,occ
 
 
+def aggregate_points(DF:pd.DataFrame,CELL:float,HEX=False):
+    """ 
+        Count sightings of each occurrences type in cells of a grid (Web Mercator), vectorized
+
+        Parameters
+        ----------
+        DF : DataFrame
+            columns 'Latitude', 'Longitude', 'Occurrences'
+        CELL : float
+            size of a cell in degrees of longitude
+        HEX : bool
+            hexagonal cells instead of squares
+
+        Returns
+        -------
+        DataFrame
+            columns 'Latitude', 'Longitude' (center of the cell), 'Occurrences', 'count'
+    """
+    x = DF['Longitude'].to_numpy(dtype=float)
+    lat = np.radians(np.clip(DF['Latitude'].to_numpy(dtype=float),-85,85))
+    y = np.degrees(np.log(np.tan(np.pi/4+lat/2))) # mercator y in degrees, cells look square on the map
+    occ,occ_code = np.unique(DF['Occurrences'].astype(str).to_numpy(),return_inverse=True)
 
-def create_map_occ(CSVPATH:str,YEARS:list,OCC:list,W:int,H:int,Z:int):
+    if HEX:
+        # 2 offset rectangular grids, each point goes to the nearest center
+        dx = CELL
+        dy = CELL*np.sqrt(3)
+        i1 = np.rint(x/dx)
+        j1 = np.rint(y/dy)
+        i2 = np.floor(x/dx)+0.5
+        j2 = np.floor(y/dy)+0.5
+        d1 = (x-i1*dx)**2+(y-j1*dy)**2
+        d2 = (x-i2*dx)**2+(y-j2*dy)**2
+        first = d1<=d2
+        cx = np.where(first,i1,i2)*dx
+        cy = np.where(first,j1,j2)*dy
+        ix = np.rint(cx/dx*2).astype(np.int64)
+        iy = np.rint(cy/dy*2).astype(np.int64)
+    else:
+        ix = np.floor(x/CELL).astype(np.int64)
+        iy = np.floor(y/CELL).astype(np.int64)
+        cx = (ix+0.5)*CELL
+        cy = (iy+0.5)*CELL
+
+    # 1 key per (cell,occurrences), counted with bincount
+    ix0 = ix-ix.min()
+    iy0 = iy-iy.min()
+    nx = int(ix0.max())+1
+    ny = int(iy0.max())+1
+    flat = (occ_code.astype(np.int64)*ny+iy0)*nx+ix0
+    keys,first_idx,inverse = np.unique(flat,return_index=True,return_inverse=True)
+    counts = np.bincount(inverse.ravel())
+
+    return pd.DataFrame({
+        'Latitude':np.degrees(2*np.arctan(np.exp(np.radians(cy[first_idx])))-np.pi/2),
+        'Longitude':cx[first_idx],
+        'Occurrences':occ[occ_code[first_idx]],
+        'count':counts})
+
+
+
+def create_map_occ(CSVPATH:str,YEARS:list,OCC:list,W:int,H:int,Z:int,AGG="auto",MAXPOINTS=5000,CELL=20):
     """ 
         Create a map of occurrences for all years
+        Large datasets are aggregated in cells (counts), so the size of the map does not depend on the number of sightings
 
         Parameters
         ----------
@@ -193,27 +950,32 @@ def create_map_occ(CSVPATH:str,YEARS:list,OCC:list,W:int,H:int,Z:int):
             height of the map
         Z : int
             zoom of the map
+        AGG : str
+            "points" (no aggregation), "grid", "hexagons", or "auto" (grid if more than MAXPOINTS sightings)
+        MAXPOINTS : int
+            maximum number of sightings shown as points in "auto"
+        CELL : int
+            size of a cell in pixels of the map at zoom Z
 
         Returns
         -------
         matplotlib figure
     """
-    # Open and Read the file
-    df = pd.read_csv(str(CSVPATH))
-
-    data_map = pd.DataFrame()
-    for year in YEARS:
-        df_year = df[(df['Date'].str.contains(str(year)))]
-        data_map = pd.concat([data_map,df_year])
-    data_map = data_map.reset_index()
-
-    i = 0
-    for o in data_map['Occurrences']:
-        if o not in OCC:
-            data_map = data_map.drop(i)
-        i+=1
-
-    fig1, ax1 = plt.subplots()
+    # Read only the years and occurrences to show
+    data_map = store.read_occurrences(CSVPATH,YEARS,OCC)
+
+    if (AGG=="auto") and (len(data_map)>MAXPOINTS):
+        AGG = "grid"
+    if (AGG in ["grid","hexagons"]) and (not data_map.empty):
+        # degrees of longitude per pixel at zoom Z (tiles of 256 pixels)
+        cell = CELL*360/(256*2**int(Z))
+        data_map = aggregate_points(data_map,cell,HEX=(AGG=="hexagons"))
+        fig1 = px.scatter_mapbox(data_map,lat="Latitude",lon="Longitude",color="Occurrences",
+                                size="count",size_max=CELL,hover_data=["count"],
+                                mapbox_style="stamen-terrain",
+                                width=W, height=H,zoom = Z)
+        return fig1
+
     fig1 = px.scatter_mapbox(data_map,lat="Latitude",lon="Longitude",color="Occurrences",
                             mapbox_style="stamen-terrain",
                             width=W, height=H,zoom = Z)
@@ -222,15 +984,83 @@ def create_map_occ(CSVPATH:str,YEARS:list,OCC:list,W:int,H:int,Z:int):
 
 
 
+def sighting_id(DF:pd.DataFrame):
+    """ 
+        Get a stable ID for each sighting, hash of Date, Latitude, Longitude and Occurrences
+        Keys are normalized first (date YYYY-MM-DD, coordinates with 6 decimals): the same sighting has the same ID
+        in CORR files written with different formats
+
+        Parameters
+        ----------
+        DF : DataFrame
+            sightings
+
+        Returns
+        -------
+        array (uint64)
+    """
+    keys = pd.DataFrame({
+        'Date':pd.to_datetime(DF['Date'].astype(str), format='mixed').dt.strftime('%Y-%m-%d').to_numpy(),
+        'Latitude':["%.6f" % v for v in DF['Latitude'].astype(float)],
+        'Longitude':["%.6f" % v for v in DF['Longitude'].astype(float)],
+        'Occurrences':DF['Occurrences'].astype(str).str.strip().to_numpy()})
+    return pd.util.hash_pandas_object(keys,index=False).values
+
+
+
+def read_CORR_variable(FILEPATHS:list,FULLVAR:str):
+    """ 
+        Read all CORR files of a variable (all years) in one table keyed by sighting ID
+
+        Parameters
+        ----------
+        FILEPATHS : list (str)
+            path of CORR files
+        FULLVAR : str
+            name of the variable with pfx and depth
+
+        Returns
+        -------
+        DataFrame
+            index=ID, columns=Date, Latitude, Longitude, Occurrences, <FULLVAR>(, <FULLVAR>_<buffer stats>)
+    """
+    VARID = FULLVAR.split("pfx")[-1]
+    VARID = VARID.split("]")[-1]
+
+    all_data = pd.concat([pd.read_csv(f,index_col=0,sep=",") for f in FILEPATHS])
+    # column of the variable renamed with the full name, other columns are not merged
+    columns = {}
+    for c in all_data.columns:
+        if c == VARID:
+            columns[c] = FULLVAR
+        elif str(c).startswith(VARID+"_") and (c != VARID+"_level"):
+            columns[c] = FULLVAR+str(c)[len(VARID):]
+
+    all_data.index = pd.Index(sighting_id(all_data),name="ID")
+    merged = all_data[KEYS+list(columns.keys())].rename(columns=columns)
+    merged = merged[~merged.index.duplicated(keep='first')]
+
+    # long layout (1 row per depth level) turned into 1 column per level
+    if ("level_depth" in all_data.columns) and (VARID+"_level" in all_data.columns):
+        levels = all_data.reset_index().pivot_table(index="ID",columns="level_depth",values=VARID+"_level",aggfunc="first",dropna=False)
+        levels.columns = [FULLVAR+"_"+depth_label(d) for d in levels.columns]
+        merged = merged.join(levels)
+    return merged
+
+
+
 def merge_all_CORR(BDIR:str,CSVFILE:str):
     """ 
         Merge correlations of all the csv files of all variables
+        Only variables whose CORR files changed since the last merge are read again
 
         Save data into:
             - <BDIR>/<CSVFILE>-ALLCORR.csv
+            - <BDIR>/.cache/<CSVFILE>-ALLCORR/ : columnar table (ALLCORR.parquet), state of CORR files (manifest.json)
+              and sightings of each variable (<fullvar>-ids.parquet)
 
         With data (sep=,):
-            Latitude, Longitude, Date, Occurrences, <fullvar>
+            ID, Date, Latitude, Longitude, Occurrences, <fullvar>
 
         Parameters
         ----------
@@ -245,51 +1075,80 @@ def merge_all_CORR(BDIR:str,CSVFILE:str):
     """
     filelist = gf.show_available_files(BDIR,'Results')
     end = "__"+str(CSVFILE).split(".")[0]+"-CORR.csv"
-
-    # TURN INTO DATAFRAME
-    all_data = pd.DataFrame()
-    var_names = []
     path_to_results = os.path.join(str(BDIR),'Results')
+
+    # GET CORR FILES OF EACH VARIABLE
+    variables = {}
     for service in list(filelist.keys()):
-        all_data_1var = pd.DataFrame()
         for file in filelist[service]:
             if file.endswith(end): # GET CORR ONLY
                 path_to_file = os.path.join(path_to_results,service,file)
-                df = pd.read_csv(path_to_file,index_col=0,sep=",") 
-                all_data_1var = pd.concat([all_data_1var,df])
-
                 varname = file.split("__")[0]
-                if varname not in var_names:
-                    var_names.append(varname)
-
-        if not all_data_1var.empty:
-            all_data_1var.replace("", float('nan'), inplace=True)
-            colonnes = list(all_data_1var.columns)
-            colonnes.remove("Date")
-            colonnes.remove("Latitude")
-            colonnes.remove("Longitude")
-            colonnes.remove("Occurrences")
-            aggf = {}
-            for c in colonnes:
-                aggf[c]='sum'
-            all_data_1var = all_data_1var.groupby(['Date', 'Latitude', 'Longitude', 'Occurrences']).agg(aggf).reset_index()
-            #all_data_1var.replace(0.0, "", inplace=True)
-
-            if all_data.empty:
-                all_data = all_data_1var
-            else:
-                all_data = pd.merge(all_data, all_data_1var,on=["Date","Latitude","Longitude","Occurrences"],how="outer") # on=["Date","Latitude","Longitude","Occurrences"]
-
-            colonnes = list(all_data.columns)
-            colonnes.remove("Date")
-            colonnes.remove("Latitude")
-            colonnes.remove("Longitude")
-            colonnes.remove("Occurrences")
-            for i in range(len(colonnes)):
-                c = i+1
-                all_data = all_data.rename(columns={colonnes[-c]:var_names[-c]})
-
-    all_data = all_data.sort_values(by=['Date'])
+                if varname not in variables:
+                    variables[varname] = {}
+                variables[varname][os.path.join(service,file)] = os.stat(path_to_file).st_mtime_ns
+
+    # PREVIOUS MERGE
+    path_store = os.path.join(str(BDIR),".cache",str(CSVFILE).split(".")[0]+"-ALLCORR")
+    os.makedirs(path_store,exist_ok=True)
+    path_manifest = os.path.join(path_store,"manifest.json")
+    path_table = os.path.join(path_store,"ALLCORR.parquet")
+    def path_ids(varname):
+        return os.path.join(path_store,varname+"-ids.parquet")
+    manifest = {}
+    all_data = None
+    if os.path.exists(path_manifest) and os.path.exists(path_table):
+        with open(path_manifest,"r") as f:
+            manifest = json.load(f)
+        all_data = pd.read_parquet(path_table)
+        if any(m.get("id")!=ID_VERSION for m in manifest.values()): # IDs computed differently, merge again
+            manifest = {}
+            all_data = None
+
+    # UPDATE CHANGED VARIABLES
+    changed = False
+    for varname in list(manifest.keys()):
+        if varname not in variables: # all CORR files removed
+            all_data = all_data.drop(columns=manifest.pop(varname)["columns"],errors='ignore')
+            if os.path.exists(path_ids(varname)):
+                os.remove(path_ids(varname))
+            changed = True
+
+    for varname,files in variables.items():
+        if (varname in manifest) and (manifest[varname]["files"]==files) and os.path.exists(path_ids(varname)):
+            continue
+        if varname in manifest:
+            all_data = all_data.drop(columns=manifest[varname]["columns"],errors='ignore')
+
+        df = read_CORR_variable([os.path.join(path_to_results,f) for f in files],varname)
+        cols = [c for c in df.columns if c not in KEYS]
+        if all_data is None:
+            all_data = df[KEYS]
+        else:
+            all_data = pd.concat([all_data,df.loc[df.index.difference(all_data.index),KEYS]])
+        all_data = all_data.join(df[cols])
+        pd.DataFrame(index=df.index).to_parquet(path_ids(varname))
+        manifest[varname] = {"files":files,"columns":cols,"id":ID_VERSION}
+        changed = True
+
+    if all_data is None:
+        all_data = pd.DataFrame(columns=KEYS,index=pd.Index([],dtype=np.uint64))
+    elif changed: # sightings of CORR files removed
+        covered = [pd.read_parquet(path_ids(varname)).index for varname in manifest]
+        covered = covered[0].append(covered[1:]) if covered!=[] else pd.Index([],dtype=np.uint64)
+        all_data = all_data[all_data.index.isin(covered)]
+
+    # sightings without any value (outside the grids) are kept
+    value_cols = sorted([c for c in all_data.columns if c not in KEYS])
+    all_data = all_data[KEYS+value_cols]
+    all_data.index.name = "ID"
+
+    # save merge
+    all_data.to_parquet(path_table)
+    with open(path_manifest,"w") as f:
+        f.write(json.dumps(manifest, indent = 4))
+
+    all_data = all_data.sort_values(by=['Date']).reset_index()
 
     # save in file
     output_file = os.path.join(str(BDIR),str(CSVFILE).split(".")[0]+"-ALLCORR.csv")
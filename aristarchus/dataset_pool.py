@@ -0,0 +1,156 @@
+###########
+# IMPORTS #
+###########
+
+import os
+import threading
+from collections import OrderedDict
+
+import xarray as xr
+import rioxarray
+
+
+# Streamlit runs the script again at every user interaction, but modules are imported once:
+# datasets opened here stay open between reruns and are shared by all modules of the process.
+
+MAX_HANDLES = 32 # maximum number of open files
+MAX_BYTES = 2*1024**3 # maximum size of data loaded in memory by the datasets of the pool
+
+_POOL = OrderedDict() # key=(path,opener,options), value=(stamp,dataset), least recently used first
+_LOCK = threading.RLock()
+
+
+
+#####################
+# GENERAL FUNCTIONS #
+#####################
+
+
+def _stamp(FILEPATH:str):
+    """ Modification time and size of a file, used to detect a new version """
+    stat = os.stat(str(FILEPATH))
+    return (stat.st_mtime_ns,stat.st_size)
+
+
+def _loaded_bytes(DS):
+    """ Size of the data of a dataset already loaded in memory """
+    if isinstance(DS,xr.DataArray):
+        variables = [DS.variable]+[DS[c].variable for c in DS.coords]
+    else:
+        variables = list(DS.variables.values())
+    return sum(v.nbytes for v in variables if getattr(v,"_in_memory",False))
+
+
+def _close(DS):
+    try:
+        DS.close()
+    except Exception:
+        pass
+
+
+def _evict(KEEP):
+    """ Close least recently used datasets until the pool respects MAX_HANDLES and MAX_BYTES """
+    total = sum(_loaded_bytes(ds) for _,ds in _POOL.values())
+    while len(_POOL)>1:
+        if (len(_POOL)<=MAX_HANDLES) and (total<=MAX_BYTES):
+            break
+        key = next(iter(_POOL))
+        if key==KEEP:
+            break
+        _,ds = _POOL.pop(key)
+        total -= _loaded_bytes(ds)
+        _close(ds)
+
+
+def _get(FILEPATH:str,OPENER:str,OPTIONS:dict):
+    path = os.path.abspath(str(FILEPATH))
+    key = (path,OPENER,tuple(sorted(OPTIONS.items())))
+    stamp = _stamp(path)
+    with _LOCK:
+        if key in _POOL:
+            old_stamp,ds = _POOL[key]
+            if old_stamp==stamp:
+                _POOL.move_to_end(key)
+                return ds
+            # file changed since opening
+            del _POOL[key]
+            _close(ds)
+
+        if OPENER=="rasterio":
+            ds = rioxarray.open_rasterio(path,**OPTIONS)
+        else:
+            ds = xr.open_dataset(path,**OPTIONS)
+        _POOL[key] = (stamp,ds)
+        _evict(key)
+        return ds
+
+
+
+#########################
+# FUNCTIONS - INTERFACE #
+#########################
+
+
+def open_dataset(FILEPATH:str,**OPTIONS):
+    """ 
+        Get an open NetCDF dataset from the pool (opened if needed)
+        Do not close it, it is shared with other calls
+
+        Parameters
+        ----------
+        FILEPATH : str
+            path to a NetCDF file
+        OPTIONS : 
+            options of xarray.open_dataset
+
+        Returns
+        -------
+        Dataset
+    """
+    return _get(FILEPATH,"netcdf",OPTIONS)
+
+
+
+def open_rasterio(FILEPATH:str,**OPTIONS):
+    """ 
+        Get an open raster (GeoTIFF) from the pool (opened if needed)
+        Do not close it, it is shared with other calls
+
+        Parameters
+        ----------
+        FILEPATH : str
+            path to a raster file
+        OPTIONS : 
+            options of rioxarray.open_rasterio
+
+        Returns
+        -------
+        DataArray
+    """
+    return _get(FILEPATH,"rasterio",OPTIONS)
+
+
+
+def close(FILEPATH:str):
+    """ 
+        Close all datasets of a file (before deleting or replacing it)
+
+        Parameters
+        ----------
+        FILEPATH : str
+            path to a file
+    """
+    path = os.path.abspath(str(FILEPATH))
+    with _LOCK:
+        for key in [k for k in _POOL if k[0]==path]:
+            _,ds = _POOL.pop(key)
+            _close(ds)
+
+
+
+def clear():
+    """ Close all datasets of the pool """
+    with _LOCK:
+        while _POOL:
+            _,(_,ds) = _POOL.popitem()
+            _close(ds)
@@ -1,4 +1,14 @@
 import os
+import sys
+import types
+import threading
+import importlib
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+
+_LAZY_LOCK = threading.Lock() # first import of the lazy modules
 
 
 def show_available_files(BDIR:str,FOLDER:str):
@@ -77,3 +87,117 @@ def show_available_files_simple(BDIR:str,FOLDER:str):
 			filelist.append(filename.replace(".tif",""))
 	
 	return filelist
+
+
+
+def get_latlon_names(DS):
+	""" 
+        Get names of latitude and longitude coordinates of a dataset
+
+        Parameters
+        ----------
+		DS : Dataset or DataArray
+			xarray object opened from a NetCDF file
+
+        Returns
+        -------
+        str
+			latitude name ("lat" if not found)
+        str
+			longitude name ("lon" if not found)
+    """
+	latname = "lat"
+	lonname = "lon"
+	for c in list(DS.coords)+list(DS.dims):
+		if 'lat' in str(c).lower():
+			latname = str(c)
+		if 'lon' in str(c).lower():
+			lonname = str(c)
+	return latname,lonname
+
+
+
+def get_cache_path(FILEPATH:str,SUFFIX:str):
+	""" 
+        Get path of a cache file saved next to a file, in a hidden .cache folder
+		(folders are not listed by show_available_files)
+
+        Parameters
+        ----------
+		FILEPATH : str
+			path to the original file
+		SUFFIX : str
+			added to the name of the original file
+
+        Returns
+        -------
+        str
+			<folder of FILEPATH>/.cache/<name of FILEPATH><SUFFIX>
+    """
+	folder,name = os.path.split(str(FILEPATH))
+	path = os.path.join(folder,".cache")
+	if not os.path.exists(path):
+		os.makedirs(path,exist_ok=True)
+	return os.path.join(path,name+str(SUFFIX))
+
+
+
+def process_pool(WORKERS=None):
+	""" 
+        Create a pool of worker processes
+		Processes are spawned (not forked) to not share open NetCDF files with the parent process
+
+        Parameters
+        ----------
+		WORKERS : int
+			number of processes, None for the number of cores
+
+        Returns
+        -------
+        ProcessPoolExecutor
+    """
+	if WORKERS==None:
+		WORKERS = os.cpu_count() or 1
+	return ProcessPoolExecutor(max_workers=int(WORKERS),mp_context=multiprocessing.get_context("spawn"))
+
+
+
+class LazyModule(types.ModuleType):
+	""" 
+        Module imported at the first read of one of its attributes, the first read is serialized by a lock
+		(importlib.util.LazyLoader is not thread-safe before Python 3.12, Streamlit sessions run in threads)
+    """
+	def __init__(self,NAME:str):
+		super().__init__(NAME)
+		self.__dict__["_module"] = None
+
+	def __getattr__(self,ATTR:str):
+		module = self.__dict__["_module"]
+		if module==None:
+			with _LAZY_LOCK:
+				if self.__dict__["_module"]==None:
+					self.__dict__["_module"] = importlib.import_module(self.__name__)
+				module = self.__dict__["_module"]
+		return getattr(module,ATTR)
+
+
+
+def lazy_import(NAME:str):
+	""" 
+        Import a module at its first use: the module is loaded when one of its attributes is read
+		(reduce the start time of the interface, each page loads only what it uses)
+
+        Parameters
+        ----------
+		NAME : str
+			name of the module
+
+        Returns
+        -------
+        module
+    """
+	if NAME in sys.modules:
+		return sys.modules[NAME]
+	if importlib.util.find_spec(NAME)==None:
+		raise ModuleNotFoundError("No module named "+NAME)
+	return LazyModule(NAME)
@@ -4,37 +4,42 @@
 
 import streamlit as st
 from streamlit_option_menu import option_menu
-import mpld3
 import streamlit.components.v1 as components
-import pydeck as pdk
 from PIL import Image
 
 
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 import json
 import os
 import re
 
 from datetime import date
-import pymannkendall as mk
 
 ################ TO ADAPT ################
 # Set working directory
 if "aristarchus" not in os.getcwd():
     os.chdir("./aristarchus")
 
-import script_motuclient as motu
 import general_function as gf
-import seasonnal_adjustment as sa
-import correlation_sightings as corr
-try:
-    import script_qgis_software as soft
-except:
-    qgis_imported = False
-else:
-    qgis_imported = True
+import qgis_worker as qw # QGIS runs in a separate process, started when needed
+
+# Heavy modules are loaded at their first use, each page loads only what it needs (see benchmark_startup.py)
+mpld3 = gf.lazy_import("mpld3")
+pdk = gf.lazy_import("pydeck")
+plt = gf.lazy_import("matplotlib.pyplot")
+mk = gf.lazy_import("pymannkendall")
+motu = gf.lazy_import("script_motuclient")
+sa = gf.lazy_import("seasonnal_adjustment")
+corr = gf.lazy_import("correlation_sightings")
+store = gf.lazy_import("occurrences_store")
+ps = gf.lazy_import("pixel_statistics")
+ts = gf.lazy_import("tile_server")
+pyr = gf.lazy_import("spatial_pyramid")
+anim = gf.lazy_import("animation")
+
+# Layers names: <NetCDF file>_<statistic><month number or season, nothing for a year>
+LAYER_PATTERN = re.compile(r"_(avg|std|min|max|anom|p\d{2})(\d{0,2}|spring|summer|autumn|winter)$")
 
 
 ####################
@@ -121,6 +126,15 @@ def get_occ(CSVPATH):
 # INTERFACE FUNCTIONS #
 #######################
 
+def get_layer_suffix(prod:str):
+    """ Get statistic (avg,std,min,max,anom,pNN) and time range suffix of a layer """
+    m = LAYER_PATTERN.search(os.path.split(prod)[1])
+    if m==None:
+        return "",""
+    return m.group(1),m.group(2)
+
+
+
 def filter_layers(all_prod:list,suffix:list):
     prodlist = []
     fullvariable = ""
@@ -130,7 +144,7 @@ def filter_layers(all_prod:list,suffix:list):
     for p in all_prod:
         # Get suffix
         prod = os.path.split(p)[1]
-        suf = (((prod.split("avg")[-1]).split("std")[-1]).split("min")[-1]).split("max")[-1]
+        suf = get_layer_suffix(prod)[1]
         if suf in suffix:
             prodlist.append(p)
             # Get variable name
@@ -153,13 +167,6 @@ def filter_layers(all_prod:list,suffix:list):
     return prodlist,all_years,variables
 
 
-def is_column_float(column):
-    for item in column:
-        if not isinstance(item, float):
-            return False
-    return True
-
-
 
 ########
 # MAIN #
@@ -443,15 +450,13 @@ elif (choose == "Set options"):
                     f.write(json_dict)
                 st.success('New path saved!', icon="✅")
             
-                # Import qgis module
+                # Restart QGIS with the new paths
                 try:
-                    import script_qgis_software as soft
-                except:
-                    qgis_imported = False
-                    st.error("Wrong path")
+                    with st.spinner("Starting QGIS..."):
+                        qw.start()
+                except Exception as e:
+                    st.error("Wrong path: "+str(e))
                     st.stop()
-                else:
-                    qgis_imported = True
      
 
 
@@ -606,6 +611,7 @@ elif choose == "Spatial analysis":
                     user = st.text_input('Enter your username:')
                     pwd = st.text_input('Enter your password:',type='password')
                                 
+                    pyramid = st.checkbox('Build coarser levels for maps',value=True,help="Block means of 2x2, 4x4 and 8x8 pixels, read instead of the file when the map is smaller than the grid")
                     create = st.button('Create NetCDF file')
 
                     if create:
@@ -628,6 +634,9 @@ elif choose == "Spatial analysis":
                             st.success('Other file(s) .nc saved in: '+bdir+'/NetCDF_files', icon="✅")
                         else :                
                             st.success('File(s) .nc saved in: '+bdir+'/NetCDF_files', icon="✅")
+                        if pyramid:
+                            with st.spinner("Building coarser levels..."):
+                                pyr.build_all(bdir)
           
 
     ######################
@@ -758,15 +767,17 @@ elif choose == "Spatial analysis":
 
         # Create Layer
         with tab2_layer:
-            if qgis_imported==False:
-                # Import qgis module
+            engine = st.radio("Compute with",["NumPy","QGIS"],horizontal=True,
+                              help="NumPy does not need QGIS (regular grids only)")
+            if engine=="QGIS":
+                # Start QGIS once (worker process)
                 try:
-                    import script_qgis_software as soft
-                except:
-                    st.error("QGIS path not found, please set in Set options")
+                    with st.spinner("Starting QGIS..."):
+                        qgis_status = qw.start()
+                except Exception as e:
+                    st.error("QGIS could not be started, please set path in Set options ("+str(e)+")")
                     st.stop()
-                else:
-                    qgis_imported = True
+                st.caption("QGIS ready ("+str(qgis_status["queued"])+" job(s) waiting)")
 
             try:
                 dirlist_nc = gf.show_available_files(bdir,"NetCDF_files")
@@ -782,31 +793,83 @@ elif choose == "Spatial analysis":
             if dirlist_nc=={}:
                 st.warning('No NetCDF file found', icon="⚠️")
             else : 
-                stats = st.multiselect("Choose statistics to compute",["average","standard deviation","min and max"])
+                stats = st.multiselect("Choose statistics to compute",["average","standard deviation","min and max","anomaly","percentiles"],
+                                       help="anomaly: difference with the normal (climatology of all years, computed once)")
+                if "percentiles" in stats:
+                    pct_lay = st.multiselect("Percentiles",[1,5,10,25,50,75,90,95,99],default=[10,90,99])
                 timer = st.selectbox("Choose time range",["year","season","month"])
                 service_nc_lay = st.selectbox('Choose the service', dirlist_nc.keys(),key="s2")
                 if dirlist_nc[service_nc_lay]==[]:
                     st.warning('No NetCDF file found', icon="⚠️")
                 else :
-                    nb = st.radio("Time range",("over one year","over several years"))
+                    nb = st.radio("Time range",("over one year","over several years","climatology (all years together)"))
                     if nb=="over one year":
                         product_nc_lay = st.selectbox('Choose the dataset', dirlist_nc[service_nc_lay])
-                    elif nb=="over several years":
+                    else:
                         product_nc_lay = st.multiselect('Choose the datasets', dirlist_nc[service_nc_lay])
+                    if (nb=="climatology (all years together)") and (engine=="QGIS"):
+                        st.warning('Climatologies are computed with NumPy only', icon="⚠️")
+                        st.stop()
+                    if ("percentiles" in stats) and (engine=="QGIS"):
+                        st.warning('Percentiles are computed with NumPy only', icon="⚠️")
+                        st.stop()
+                    if "anomaly" in stats:
+                        if engine=="QGIS":
+                            st.warning('Anomalies are computed with NumPy only', icon="⚠️")
+                            st.stop()
+                        ### EXTRACT FROM FILENAME
+                        years_ref = sorted(set(p.split("__")[-1] for p in dirlist_nc[service_nc_lay]))
+                        col1_anom,col2_anom = st.columns(2)
+                        bins_anom = col1_anom.radio("Normal of each",["day","month"],horizontal=True)
+                        years_anom = col2_anom.multiselect("Reference years of the normal",years_ref,default=years_ref)
+                        if len(years_anom)==0:
+                            st.error("Choose at least one reference year for the normal")
+                            st.stop()
                         
                     create_tif = st.button('Save .tif files')
                                 
-                    if create_tif:
+                    if create_tif and (nb=="climatology (all years together)"):
+                        # 1 climatology per variable, named <variable>__<first year>-<last year>
+                        clim_lay = {}
+                        for p in product_nc_lay:
+                            ### EXTRACT FROM FILENAME
+                            clim_lay.setdefault(p.split("__")[0],[]).append(int(p.split("__")[-1]))
                         with st.spinner("Please wait..."):
-                            if type(product_nc_lay)!=list:
-                                # Path to NetCDF
-                                path_file_lay = os.path.join(bdir,"NetCDF_files",service_nc_lay,product_nc_lay)
-                                soft.run_qgis_analysis(bdir,path_file_lay,stats,timer)
-                            else:
-                                for p in product_nc_lay:
-                                    path_file_lay = os.path.join(bdir,"NetCDF_files",service_nc_lay,p)
-                                    soft.run_qgis_analysis(bdir,path_file_lay,stats,timer)
-                        st.success('File(s) .tif saved in '+os.path.split(path_file_lay)[0], icon="✅")
+                            for var_lay,years_lay in clim_lay.items():
+                                ps.climatology(bdir,service_nc_lay,var_lay,years_lay,stats,timer)
+                                if "percentiles" in stats:
+                                    ps.percentiles(bdir,service_nc_lay,var_lay,years_lay,timer,pct_lay)
+                        st.success('File(s) .tif saved in '+os.path.join(bdir,"Layers",service_nc_lay), icon="✅")
+
+                    elif create_tif:
+                        if engine=="QGIS":
+                            run_analysis = qw.run_qgis_analysis
+                        else:
+                            run_analysis = ps.run_analysis
+                        try:
+                            with st.spinner("Please wait..."):
+                                if type(product_nc_lay)!=list:
+                                    # Path to NetCDF
+                                    path_file_lay = os.path.join(bdir,"NetCDF_files",service_nc_lay,product_nc_lay)
+                                    run_analysis(bdir,path_file_lay,stats,timer)
+                                    if "anomaly" in stats:
+                                        ps.anomaly(bdir,path_file_lay,timer,years_anom,bins_anom)
+                                    if "percentiles" in stats:
+                                        ### EXTRACT FROM FILENAME
+                                        ps.percentiles(bdir,service_nc_lay,product_nc_lay.split("__")[0],[int(product_nc_lay.split("__")[-1])],timer,pct_lay)
+                                else:
+                                    for p in product_nc_lay:
+                                        path_file_lay = os.path.join(bdir,"NetCDF_files",service_nc_lay,p)
+                                        run_analysis(bdir,path_file_lay,stats,timer)
+                                        if "anomaly" in stats:
+                                            ps.anomaly(bdir,path_file_lay,timer,years_anom,bins_anom)
+                                        if "percentiles" in stats:
+                                            ### EXTRACT FROM FILENAME
+                                            ps.percentiles(bdir,service_nc_lay,p.split("__")[0],[int(p.split("__")[-1])],timer,pct_lay)
+                        except ValueError as e: # ex: curvilinear grid with NumPy
+                            st.error(str(e)+(" (choose QGIS in 'Compute with')" if engine=="NumPy" else ""))
+                        else:
+                            st.success('File(s) .tif saved in '+os.path.split(path_file_lay)[0], icon="✅")
 
 
     ##############################
@@ -829,6 +892,7 @@ elif choose == "Spatial analysis":
                 suppr = st.button("Delete file")
                 if suppr :
                     ################ TO ADAPT ################
+                    store.delete_store(os.getcwd()+"/../Occurrences/"+_file)
                     os.remove(os.getcwd()+"/../Occurrences/"+_file)
                     st.success('File deleted: '+_file, icon="✅")
                     st.experimental_rerun()
@@ -836,46 +900,32 @@ elif choose == "Spatial analysis":
             st.info("Presence data only")
 
             with st.expander("File must contain"):
-                st.write("**Columns (other accepted name):**")  
+                st.write("**Columns (other accepted name, in upper or lower case):**")  
                 st.write("""
-                - Latitude (latitude, lat, LAT, LATITUDE)
-                - Longitude (longitude, lon, long, LON, LONG, LONGITUDE)
-                - Date (date, day, Day, Timestamp, DATE, DAY, TIMESTAMP)""")
+                - Latitude (lat, decimalLatitude)
+                - Longitude (lon, long, lng, decimalLongitude)
+                - Date (day, timestamp, datetime, eventDate)
+                - optional: Depth (diveDepth, targetDepth), used for variables with depth""")
+            st.info("Rows with invalid coordinates or dates are removed")
 
 
         # Upload file
         with col1_upload :
             uploaded_file = st.file_uploader('Upload a CSV',type="csv")
             if uploaded_file:
-                dataframe = pd.read_csv(uploaded_file,sep=",")
-                    
-                data = {}
-                other = []
-                for col in list(dataframe.columns):
-                    if col in ['Latitude','latitude','lat','LAT','LATITUDE']:
-                        # verify if all floats
-                        if is_column_float(dataframe[col])==True:
-                            data['Latitude']=dataframe[col]
-                        else:
-                            st.warning('Column '+col+' contains non-floats values', icon="⚠️")
-                            st.stop()
-                    elif col in ['Longitude','longitude','lon','long','LON','LONG','LONGITUDE']:
-                        # verify if all floats
-                        if is_column_float(dataframe[col])==True:
-                            data['Longitude']=dataframe[col]
-                        else:
-                            st.warning('Column '+col+' contains non-floats values', icon="⚠️")
-                            st.stop()
-                    elif col in ['Date','date','day','Day','Timestamp','DATE','DAY','TIMESTAMP']:
-                        data['Date']=dataframe[col]
-                    else : 
-                        other.append(col)
-                    
+                # read only the first rows, the file is read by chunks when saved
+                dataframe = pd.read_csv(uploaded_file,sep=",",nrows=1000)
+                uploaded_file.seek(0)
+
+                data = store.find_columns(list(dataframe.columns))
+                other = [col for col in list(dataframe.columns) if col not in data.values()]
+
                 # check if necessary cols are presents
-                if ('Latitude' or 'Longitude' or'Date') not in data.keys():
+                if not all(k in data.keys() for k in ['Latitude','Longitude','Date']):
                     st.warning('Necessary column absent, please reupload updated file', icon="⚠️")
                     st.stop()
-                
+                st.write(dataframe.head())
+
                 # ask for date format
                 _dayfirst = st.radio("Day before month?",[True,False])
 
@@ -891,12 +941,14 @@ elif choose == "Spatial analysis":
 
                 check_occ = st.button("Save file")
                 if check_occ:
-                    data['Occurrences']=dataframe[col_occ]
-                    data['Date']=pd.to_datetime(data['Date'], dayfirst=_dayfirst,format='mixed')
-                    # data['Year'] = data['Year'].astype(int).astype(str)
                     ################ TO ADAPT ################
                     OUTPUT_FILE = os.getcwd()+'/../Occurrences/'+name_occ+'.csv'
-                    pd.DataFrame(data).to_csv(OUTPUT_FILE, sep=',', encoding='utf-8')
+                    progress_occ = st.progress(0.0,text="Reading file...")
+                    meta_occ,invalid_occ = store.ingest_csv(uploaded_file,OUTPUT_FILE,data,col_occ,_dayfirst,
+                                                            PROGRESS=lambda f,n: progress_occ.progress(f,text=str(n)+" rows saved"))
+                    for k,v in invalid_occ.items():
+                        if v>0:
+                            st.warning(str(v)+' rows removed: invalid '+k, icon="⚠️")
                     st.success('File saved in: '+OUTPUT_FILE, icon="✅")
 
 
@@ -964,18 +1016,55 @@ elif choose == "Spatial analysis":
                     st.warning('No NetCDF file found', icon="⚠️")
                     st.stop()
             
+                with st.expander("Buffer around sightings (GPS error, animal movement)"):
+                    col1_buffer,col2_buffer = st.columns(2)
+                    buffer_px = col1_buffer.number_input("Radius (in pixels)", min_value=0, max_value=50, value=0, step=1)
+                    buffer_days = col2_buffer.number_input("Days before and after", min_value=0, max_value=30, value=0, step=1)
+                    st.info("Mean, standard deviation and number of values in the buffer are added to the correlation files")
+
+                with st.expander("Depth (variables with depth levels)"):
+                    depth_mode = st.radio("Values along depth",["mean","levels","target"],horizontal=True,
+                                          help="mean: mean over depth, levels: value at each level, target: value at the nearest level of the 'Depth' column of the sightings")
+                    depth_layout = st.radio("Levels saved as",["wide","long"],horizontal=True,
+                                            help="wide: 1 column per level, long: 1 row per level",disabled=(depth_mode!="levels"))
+
                 create = st.button('Correlation with occurrences',use_container_width=True)
                 st.info("Rerun correlation replace created files")
 
                 if create:
                     ################ TO ADAPT ################
                     csvpath = os.path.join(os.getcwd()+"/..",'Occurrences',csvfile)
-                
+
                     with st.spinner("Please wait..."):
-                        df=corr.correlation(bdir,csvpath,service_nc_CORR)
+                        df=corr.correlation(bdir,csvpath,service_nc_CORR,BUFFER_PIXELS=int(buffer_px),BUFFER_DAYS=int(buffer_days),
+                                            DEPTH=depth_mode,LAYOUT=depth_layout)
                     OUTPUT_FILE = bdir+"/Results/"+service_nc_CORR
                     st.success('File saved in: '+OUTPUT_FILE, icon="✅")
 
+                # Background points (pseudo-absences)
+                with st.expander("Background points (pseudo-absences) for habitat modelling"):
+                    nb_bg = st.number_input("Number of points per day with sightings", min_value=10, max_value=100000, value=1000, step=10)
+                    create_bg = st.button('Sample background points',use_container_width=True)
+                    if create_bg:
+                        ################ TO ADAPT ################
+                        csvpath = os.path.join(os.getcwd()+"/..",'Occurrences',csvfile)
+
+                        with st.spinner("Please wait..."):
+                            df_bg=corr.background_sampling(bdir,csvpath,service_nc_CORR,int(nb_bg))
+                        OUTPUT_FILE = bdir+"/Results/"+service_nc_CORR
+                        st.success('File(s) <year>__'+csvfile.split(".")[0]+'-BACKGROUND.csv saved in: '+OUTPUT_FILE, icon="✅")
+
+                # Preference test
+                with st.expander("Environmental preference (permutation test)"):
+                    st.write("Compare values at sightings with values available on the same days (correlation must be done first)")
+                    nb_perm = st.number_input("Number of permutations", min_value=100, max_value=100000, value=1000, step=100)
+                    create_pref = st.button('Run preference test',use_container_width=True)
+                    if create_pref:
+                        with st.spinner("Please wait..."):
+                            df_pref=corr.preference_test(bdir,csvfile,service_nc_CORR,int(nb_perm))
+                        st.write(df_pref)
+                        st.success('File saved in: '+os.path.join(bdir,csvfile.split(".")[0]+'-PREFERENCE.csv'), icon="✅")
+
 
 
 ##########################################################################################################
@@ -1171,6 +1260,27 @@ elif choose == "Meta-analysis":
         x1.margins(0, marg)   
         x2.margins(0, marg)     
         st.write(mw)
+
+        # Lagged cross-correlation
+        st.subheader("Lagged cross-correlation")
+        col1_xcf,col2_xcf = st.columns([1,3])
+        with col1_xcf:
+            maxlag = st.number_input("Maximum lag (in days)", min_value=1, max_value=365, value=60, step=1)
+            df_xcf,band_xcf,fig_xcf = sa.cross_correlation(bdir,service_comp,variable_comp,service_compb,variable_compb,int(maxlag))
+            if fig_xcf==None:
+                st.warning('No common time range between the 2 datasets', icon="⚠️")
+            else:
+                best_xcf = df_xcf.loc[df_xcf['ccf'].abs().idxmax()]
+                st.write(f"strongest correlation: {best_xcf['ccf']:.3f} at lag {int(best_xcf['lag'])} days")
+                st.write(f"95% significance band: +/- {band_xcf:.3f}")
+            all_xcf = st.button("Cross-correlation of all variables of service 1",use_container_width=True)
+        with col2_xcf:
+            if fig_xcf!=None:
+                st.pyplot(fig_xcf)
+            if all_xcf:
+                with st.spinner("Please wait..."):
+                    st.write(sa.all_cross_correlation(bdir,service_comp,int(maxlag)))
+                st.success('File saved in: '+os.path.join(bdir,service_comp+"-XCF.csv"), icon="✅")
             
 
 
@@ -1238,8 +1348,13 @@ elif choose == "Show map":
             y,o = get_occ(occ_path)
             _years = st.multiselect('Years',y,default=y)
             _occs = st.multiselect('Occurrences',o,default=o)
+            col1_occ,col2_occ = st.columns(2)
+            with col1_occ:
+                _agg = st.selectbox('Aggregation',["auto","points","grid","hexagons"],help="auto: sightings are counted in cells when there are more than 5000 points")
+            with col2_occ:
+                _zoom = st.slider('Zoom',1,12,7)
             
-            ds_occ = corr.create_map_occ(occ_path,_years,_occs,800,600,7)
+            ds_occ = corr.create_map_occ(occ_path,_years,_occs,800,600,_zoom,AGG=_agg)
             st.write(ds_occ)
 
 
@@ -1274,9 +1389,57 @@ elif choose == "Show map":
                 else :
                     choice_depth_day = 0.0
 
+                tiles_day = st.checkbox('Raster tiles',key="t1",help="Tiles rendered on demand by a local server, for large datasets (reachable from this machine only, see HOST in tile_server.py)")
+                animation_day = st.checkbox('Animation',key="a1",help="Maps of all days rendered once in the background, with the same color scale")
+
         if 'product_daymap' in locals():
-            ds = motu.create_map_1d(path_file_day,str(date_choice.month),str(date_choice.day),choice_depth_day)
-            st.pyplot(ds)
+            if animation_day:
+                depth_anim = float(choice_depth_day) if depth_day!=[] else None
+                meta,frames = anim.get_frames(path_file_day,depth_anim)
+                running = anim.is_running(path_file_day,depth_anim)
+                if (meta==None) or (not meta["complete"]):
+                    if (meta!=None) and ("error" in meta) and (not running):
+                        st.error("Rendering failed: "+meta["error"])
+                    if running:
+                        st.progress(len(frames)/max(1,len(meta["dates"]) if meta!=None else 1),text="Rendering maps...")
+                        if st.button('Refresh',key="r1"):
+                            st.experimental_rerun()
+                    elif st.button('Render all days',key="b1"):
+                        anim.start(path_file_day,depth_anim)
+                        st.experimental_rerun()
+                if frames!={}:
+                    if (meta["complete"]) and st.checkbox('Play',key="pl1"):
+                        st.image(os.path.join(os.path.dirname(next(iter(frames.values()))),"animation.gif"))
+                    else:
+                        day_anim = st.select_slider('Day',options=list(frames.keys()),key="d1")
+                        st.image(frames[day_anim])
+            elif tiles_day:
+                ts.start(bdir)
+                try:
+                    info = ts.get_tile_info(bdir,"nc",service_daymap,product_daymap,date_choice.isoformat(),float(choice_depth_day))
+                except KeyError:
+                    st.warning('No data on '+date_choice.isoformat(), icon="⚠️")
+                else:
+                    st.subheader(info["name"]+" in "+info["unit"])
+                    z_day = st.slider('Zoom', min_value=0, max_value=20,step=1,value=5,key="z1")
+                    url = ts.tile_url("nc",service_daymap,product_daymap,date=date_choice.isoformat(),depth=float(choice_depth_day))
+                    st.plotly_chart(ts.create_tile_map(url,info["extent"],800,600,z_day,TITLE=date_choice.isoformat()))
+                    st.caption("Color scale: %.3g to %.3g %s (%s)" % (info["vmin"],info["vmax"],info["unit"],info["cmap"]))
+            else:
+                ds = motu.create_map_1d(path_file_day,str(date_choice.month),str(date_choice.day),choice_depth_day)
+                st.pyplot(ds)
+
+            with st.expander('Regional mean over the year'):
+                col1_reg,col2_reg = st.columns(2)
+                lat_reg = col1_reg.slider('Latitude',float(lat[0]),float(lat[1]),(float(lat[0]),float(lat[1])),key="lat1")
+                lon_reg = col2_reg.slider('Longitude',float(lon[0]),float(lon[1]),(float(lon[0]),float(lon[1])),key="lon1")
+                fast_reg = st.checkbox('Fast (coarser levels)',value=True,key="f1",
+                                       help="Read blocks of pixels (at least 100 blocks across the region): pixels on the edges of the region may be added or missed")
+                if st.button('Compute',key="c1"):
+                    resolution = (lon_reg[1]-lon_reg[0])/100 if fast_reg else None
+                    serie_reg = pyr.regional_mean(path_file_day,lat_reg[0],lat_reg[1],lon_reg[0],lon_reg[1],resolution,
+                                                  float(choice_depth_day) if depth_day!=[] else None)
+                    st.line_chart(serie_reg)
     
 
     # Check if statistics created
@@ -1308,22 +1471,20 @@ elif choose == "Show map":
                     with c2 :
                         years_variable = all_years[variable_monthmap]
                         year_monthmap = st.selectbox('Choose the year',years_variable,key="y3")
-                        prodlist_monthmap = [p for p in prodlist_monthmap if year_monthmap in p]
+                        prodlist_monthmap = [p for p in prodlist_monthmap if "__"+year_monthmap+"_" in p]
                     with c3 :
-                        stat_monthmap = st.selectbox('Choose the statistics',['avg','std','min','max'],key="st3")
-                        prodlist_monthmap = [p for p in prodlist_monthmap if stat_monthmap in p]
+                        stat_monthmap = st.selectbox('Choose the statistics',sorted(set(get_layer_suffix(p)[0] for p in prodlist_monthmap)),key="st3")
+                        prodlist_monthmap = [p for p in prodlist_monthmap if get_layer_suffix(p)[0]==stat_monthmap]
 
                     if prodlist_monthmap==[]:
                         st.warning('No file available, choose another statistic', icon="⚠️")
                     else:
                         # Path to Layer
-                        i = 1
                         pathfiles = {}
-                        for p in prodlist_monthmap:
-                            pathfiles[i] = os.path.join(bdir,"Layers",service_monthmap,p)
-                            i+=1
+                        for p in sorted(prodlist_monthmap,key=lambda p: int(get_layer_suffix(p)[1])):
+                            pathfiles[int(get_layer_suffix(p)[1])] = os.path.join(bdir,"Layers",service_monthmap,p)
 
-                        depth_month = motu.get_depths(pathfiles[1],geotiff=True)
+                        depth_month = motu.get_depths(list(pathfiles.values())[0],geotiff=True)
                         if depth_month !=[]:
                             choice_depth_month = st.selectbox('Choose depth', depth_month)
                         else :
@@ -1333,14 +1494,12 @@ elif choose == "Show map":
             z = st.slider('Zoom', min_value=0, max_value=20,step=1,value=7,key="z3")
 
             # Create maps
-            i = 1
             maps_month = {}
-            for path in pathfiles.values():
+            for i,path in pathfiles.items():
                 maps_month[i] = motu.create_map(path,float(choice_depth_month),800,600,z)
-                i+=1
 
             ### EXTRACT FROM FILENAME
-            VAR_FULL = (os.path.split(pathfiles[1])[1]).split('__')[0]
+            VAR_FULL = (os.path.split(list(pathfiles.values())[0])[1]).split('__')[0]
             VAR = VAR_FULL.split("pfx")[-1]
             if "]" in VAR:
                 VAR = VAR.split("]")[-1]
@@ -1357,7 +1516,10 @@ elif choose == "Show map":
             choose = st.select_slider('Choose a month', ['January','February','March','April','Mai','June','July','August','September','October','November','December'])
             months = {'January':1,'February':2,'March':3,'April':4,'Mai':5,'June':6,'July':7,'August':8,'September':9,'October':10,'November':11,'December':12}
             st.subheader(VARNAME+" in "+VARUNIT)
-            st.write(maps_month[months[choose]])
+            if months[choose] in maps_month:
+                st.write(maps_month[months[choose]])
+            else:
+                st.warning('No file available for this month', icon="⚠️")
 
     
 
@@ -1382,12 +1544,13 @@ elif choose == "Show map":
                     with c2 :
                         years_variable = all_years[variable_seasonmap]
                         year_seasonmap = st.selectbox('Choose the year',years_variable,key="y4")
-                        prodlist_seasonmap = [p for p in prodlist_seasonmap if year_seasonmap in p]
+                        prodlist_seasonmap = [p for p in prodlist_seasonmap if "__"+year_seasonmap+"_" in p]
                     with c3 :
-                        stat_seasonmap = st.selectbox('Choose the statistics',['avg','std','min','max'],key="st4")
-                        prodlist_seasonmap = [p for p in prodlist_seasonmap if stat_seasonmap in p]
+                        stat_seasonmap = st.selectbox('Choose the statistics',sorted(set(get_layer_suffix(p)[0] for p in prodlist_seasonmap)),key="st4")
+                        prodlist_seasonmap = [p for p in prodlist_seasonmap if get_layer_suffix(p)[0]==stat_seasonmap]
+                        prodlist_seasonmap = sorted(prodlist_seasonmap,key=lambda p: ["spring","summer","autumn","winter"].index(get_layer_suffix(p)[1]))
 
-                    if prodlist_seasonmap==[]:
+                    if len(prodlist_seasonmap)<4:
                         st.warning('No file available, choose another statistic', icon="⚠️")
                     else:
                         # Path to Layer
@@ -1446,7 +1609,7 @@ elif choose == "Show map":
             prodlist_yearmap = []
             for p in dirlist_lay[service_yearmap]:
                 prod = os.path.split(p)[1]
-                suf = (((prod.split("avg")[-1]).split("std")[-1]).split("min")[-1]).split("max")[-1]
+                suf = get_layer_suffix(prod)[1]
                 if suf not in ["spring","summer","autumn","winter","1","2","3","4","5","6","7","8","9","10","11","12"]:
                     prodlist_yearmap.append(p)
             if prodlist_yearmap == []:
@@ -1464,6 +1627,8 @@ elif choose == "Show map":
             else :
                 choice_depth_year = 0.0
 
+            tiles_year = st.checkbox('Raster tiles',key="t5",help="Tiles rendered on demand by a local server, for large layers (reachable from this machine only, see HOST in tile_server.py)")
+
         ### EXTRACT FROM FILENAME
         VAR_FULL = (os.path.split(path_file_year)[1]).split('__')[0]
         VAR = VAR_FULL.split("pfx")[-1]
@@ -1479,6 +1644,18 @@ elif choose == "Show map":
             VARUNIT = json_dict[VAR][1]
 
         st.subheader(VARNAME+" in "+VARUNIT)
-        ds_year = motu.create_map(path_file_year,float(choice_depth_year),800,600,7)
-        st.write(ds_year)
+        z = st.slider('Zoom', min_value=0, max_value=20,step=1,value=7,key="z5")
+        if tiles_year:
+            ts.start(bdir)
+            try:
+                info = ts.get_tile_info(bdir,"layer",service_yearmap,product_yearmap,DEPTH=float(choice_depth_year))
+            except KeyError:
+                st.warning('No data at depth '+str(choice_depth_year), icon="⚠️")
+            else:
+                url = ts.tile_url("layer",service_yearmap,product_yearmap,depth=float(choice_depth_year))
+                st.plotly_chart(ts.create_tile_map(url,info["extent"],800,600,z,TITLE=path_file_year.split('__')[-1]))
+            st.caption("Color scale: %.3g to %.3g %s (%s)" % (info["vmin"],info["vmax"],info["unit"],info["cmap"]))
+        else:
+            ds_year = motu.create_map(path_file_year,float(choice_depth_year),800,600,z)
+            st.write(ds_year)
 
@@ -0,0 +1,378 @@
+###########
+# IMPORTS #
+###########
+
+import os
+import json
+import shutil
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as pds
+
+import general_function as gf
+
+
+# Occurrences files are uploaded as csv, then converted once in a typed columnar store:
+#   - <folder>/.cache/<CSVFILE>-STORE/ : parquet files partitioned by Year and Occurrences
+#   - <folder>/.cache/<CSVFILE>-STORE.json : metadata (years, categories, extent)
+
+PARTITIONING = pds.partitioning(pa.schema([('Year',pa.int32()),('Occurrences',pa.string())]),flavor='hive')
+
+# Accepted names of columns (case, spaces and _ are ignored)
+ALIASES = {
+    'Latitude':['latitude','lat','decimallatitude'],
+    'Longitude':['longitude','lon','long','lng','decimallongitude'],
+    'Date':['date','day','timestamp','datetime','eventdate'],
+    'Depth':['depth','divedepth','targetdepth','depthm'] # optional
+}
+
+
+
+#####################
+# GENERAL FUNCTIONS #
+#####################
+
+
+def get_store_paths(CSVPATH:str):
+    """ 
+        Get paths of the store of an occurrences file
+
+        Parameters
+        ----------
+        CSVPATH : str
+            path of the csv file containing sightings
+
+        Returns
+        -------
+        str
+            folder of the parquet files
+        str
+            metadata file
+    """
+    return gf.get_cache_path(CSVPATH,"-STORE"),gf.get_cache_path(CSVPATH,"-STORE.json")
+
+
+def typed_occurrences(DF:pd.DataFrame,DAYFIRST=False):
+    """ 
+        Convert columns of sightings to their types
+
+        Parameters
+        ----------
+        DF : DataFrame
+            columns 'Latitude', 'Longitude', 'Date', 'Occurrences'
+        DAYFIRST : bool
+            day before month in dates (only for dates not already parsed)
+
+        Returns
+        -------
+        DataFrame
+            with 'Year' column
+    """
+    df = DF.loc[:, ~DF.columns.str.contains('^Unnamed')].copy()
+    df['Latitude'] = pd.to_numeric(df['Latitude'],errors='coerce').astype(float)
+    df['Longitude'] = pd.to_numeric(df['Longitude'],errors='coerce').astype(float)
+    if not pd.api.types.is_datetime64_any_dtype(df['Date']):
+        df['Date'] = pd.to_datetime(df['Date'],dayfirst=DAYFIRST,format='mixed',errors='coerce')
+    df['Occurrences'] = df['Occurrences'].astype(str)
+    df['Year'] = df['Date'].dt.year.astype('Int32')
+    return df
+
+
+
+def find_columns(COLUMNS:list):
+    """ 
+        Find columns of latitude, longitude and date with their accepted names
+
+        Parameters
+        ----------
+        COLUMNS : list (str)
+            columns of a csv file
+
+        Returns
+        -------
+        dict
+            key='Latitude','Longitude','Date'(,'Depth'), value=column found (missing key if not found)
+    """
+    found = {}
+    for col in COLUMNS:
+        name = str(col).strip().lower().replace(" ","").replace("_","")
+        for k,aliases in ALIASES.items():
+            if (k not in found) and (name in aliases):
+                found[k] = col
+    return found
+
+
+def validate_chunk(CHUNK:pd.DataFrame,COLUMNS:dict,OCC_COL:str,DAYFIRST=False):
+    """ 
+        Convert and check a chunk of an uploaded csv file, vectorized on each column
+
+        Parameters
+        ----------
+        CHUNK : DataFrame
+            rows of the uploaded file
+        COLUMNS : dict
+            columns of latitude, longitude, date and optional depth (see find_columns)
+        OCC_COL : str
+            column of occurrences
+        DAYFIRST : bool
+            day before month in dates
+
+        Returns
+        -------
+        DataFrame
+            valid sightings, typed, with 'Year' column
+        dict
+            number of rows removed for each reason
+    """
+    df = pd.DataFrame({
+        'Latitude':CHUNK[COLUMNS['Latitude']],
+        'Longitude':CHUNK[COLUMNS['Longitude']],
+        'Date':CHUNK[COLUMNS['Date']],
+        'Occurrences':CHUNK[OCC_COL]})
+    if 'Depth' in COLUMNS:
+        df['Depth'] = pd.to_numeric(CHUNK[COLUMNS['Depth']],errors='coerce').astype(float)
+    df = typed_occurrences(df,DAYFIRST)
+
+    # coordinates sanity checks
+    lat_ok = df['Latitude'].between(-90,90)
+    lon_ok = df['Longitude'].between(-180,360)
+    not_zero = ~((df['Latitude']==0) & (df['Longitude']==0)) # (0,0) is a missing position
+    date_ok = df['Date'].notna()
+    invalid = {
+        'latitude':int((~lat_ok).sum()),
+        'longitude':int((~lon_ok).sum()),
+        'position (0,0)':int((~not_zero).sum()),
+        'date':int((~date_ok).sum())}
+    return df[lat_ok & lon_ok & not_zero & date_ok],invalid
+
+
+
+#########################
+# FUNCTIONS - INTERFACE #
+#########################
+
+
+def ingest_csv(FILE,CSVPATH:str,COLUMNS:dict,OCC_COL:str,DAYFIRST=False,CHUNKSIZE=100000,PROGRESS=None):
+    """ 
+        Read an uploaded csv file by chunks, check and convert each chunk, 
+        write valid rows in the occurrences csv file and in its store as soon as they are read
+
+        Save data into :
+            - <CSVPATH>, columns 'Latitude', 'Longitude', 'Date', 'Occurrences'(, 'Depth')
+            - store of CSVPATH (see read_occurrences)
+
+        Parameters
+        ----------
+        FILE : str or file-like object
+            uploaded csv file (sep=,)
+        CSVPATH : str
+            path of the occurrences csv file to create
+        COLUMNS : dict
+            columns of latitude, longitude, date and optional depth (see find_columns)
+        OCC_COL : str
+            column of occurrences
+        DAYFIRST : bool
+            day before month in dates
+        CHUNKSIZE : int
+            number of rows read at once
+        PROGRESS : function(float,int)
+            called after each chunk with the fraction of the rows read and the number of rows saved
+
+        Returns
+        -------
+        dict
+            metadata of the store
+        dict
+            number of rows removed for each reason
+    """
+    close = False
+    if isinstance(FILE,str):
+        FILE = open(FILE,"rb")
+        close = True
+    # number of rows of the file (lines after the header), the parser reads ahead so its position is not the progress
+    total = 0
+    block = FILE.read(1<<20)
+    while block:
+        total += block.count(b"\n" if isinstance(block,bytes) else "\n")
+        block = FILE.read(1<<20)
+    FILE.seek(0)
+
+    path_store,path_meta = get_store_paths(CSVPATH)
+    if os.path.exists(path_store):
+        shutil.rmtree(path_store)
+    if os.path.exists(path_meta):
+        os.remove(path_meta)
+
+    columns = ['Latitude','Longitude','Date','Occurrences']+(['Depth'] if 'Depth' in COLUMNS else [])
+    usecols = list(dict.fromkeys([COLUMNS[c] for c in columns if c!='Occurrences']+[OCC_COL]))
+    rows = 0
+    read = 0
+    years = set()
+    categories = set()
+    extent = {"LAT":[None,None],"LONG":[None,None]}
+    invalid = {}
+    try:
+        for chunk in pd.read_csv(FILE,sep=",",usecols=usecols,chunksize=int(CHUNKSIZE)):
+            read += len(chunk)
+            df,inv = validate_chunk(chunk,COLUMNS,OCC_COL,DAYFIRST)
+            for k,v in inv.items():
+                invalid[k] = invalid.get(k,0)+v
+
+            if not df.empty:
+                # append to csv file and write new files in the store
+                df.index = pd.RangeIndex(rows,rows+len(df))
+                df[columns].to_csv(CSVPATH,sep=',',encoding='utf-8',mode='w' if rows==0 else 'a',header=(rows==0))
+                df.to_parquet(path_store,partition_cols=['Year','Occurrences'],index=False)
+
+                rows += len(df)
+                years.update(int(y) for y in df['Year'].unique())
+                categories.update(df['Occurrences'].unique().tolist())
+                for k,c in (("LAT",'Latitude'),("LONG",'Longitude')):
+                    vmin = float(df[c].min())
+                    vmax = float(df[c].max())
+                    extent[k] = [vmin if extent[k][0]==None else min(vmin,extent[k][0]),
+                                 vmax if extent[k][1]==None else max(vmax,extent[k][1])]
+
+            if PROGRESS!=None:
+                PROGRESS(min(read/max(total-1,1),1.0),rows)
+    finally:
+        if close:
+            FILE.close()
+
+    if rows==0:
+        pd.DataFrame(columns=columns).to_csv(CSVPATH,sep=',',encoding='utf-8')
+        return build_store(CSVPATH),invalid
+
+    meta = {
+        "source_mtime":os.stat(str(CSVPATH)).st_mtime_ns,
+        "rows":int(rows),
+        "columns":columns+['Year'],
+        "years":sorted(years),
+        "categories":sorted(categories),
+        "extent":extent
+    }
+    with open(path_meta,"w") as f:
+        f.write(json.dumps(meta, indent = 4))
+    if PROGRESS!=None:
+        PROGRESS(1.0,rows)
+    return meta,invalid
+
+
+def build_store(CSVPATH:str):
+    """ 
+        Convert an occurrences csv file in a typed columnar store
+
+        Parameters
+        ----------
+        CSVPATH : str
+            path of the csv file containing sightings, columns names 'Latitude', 'Longitude', 'Date', 'Occurrences'
+
+        Returns
+        -------
+        dict
+            metadata of the store
+    """
+    path_store,path_meta = get_store_paths(CSVPATH)
+    df = typed_occurrences(pd.read_csv(str(CSVPATH)))
+    columns = list(df.columns)
+    df = df.dropna(subset=['Year'])
+
+    if os.path.exists(path_store):
+        shutil.rmtree(path_store)
+    df.to_parquet(path_store,partition_cols=['Year','Occurrences'],index=False)
+
+    meta = {
+        "source_mtime":os.stat(str(CSVPATH)).st_mtime_ns,
+        "rows":int(len(df)),
+        "columns":columns,
+        "years":sorted(int(y) for y in df['Year'].unique()),
+        "categories":sorted(df['Occurrences'].unique().tolist()),
+        "extent":{"LAT":[float(df['Latitude'].min()),float(df['Latitude'].max())],
+                  "LONG":[float(df['Longitude'].min()),float(df['Longitude'].max())]}
+    }
+    with open(path_meta,"w") as f:
+        f.write(json.dumps(meta, indent = 4))
+    return meta
+
+
+
+def read_metadata(CSVPATH:str):
+    """ 
+        Get metadata of the store of an occurrences file (built if missing or older than the csv file)
+
+        Parameters
+        ----------
+        CSVPATH : str
+            path of the csv file containing sightings
+
+        Returns
+        -------
+        dict
+            - source_mtime : modification time of the csv file
+            - rows : number of sightings
+            - columns : list of columns
+            - years : list of years (int)
+            - categories : list of occurrences (str)
+            - extent : LAT=[min,max], LONG=[min,max]
+    """
+    path_store,path_meta = get_store_paths(CSVPATH)
+    if os.path.exists(path_meta) and os.path.exists(path_store):
+        with open(path_meta,"r") as f:
+            meta = json.load(f)
+        if meta["source_mtime"]==os.stat(str(CSVPATH)).st_mtime_ns:
+            return meta
+    return build_store(CSVPATH)
+
+
+
+def read_occurrences(CSVPATH:str,YEARS=None,OCC=None):
+    """ 
+        Read sightings from the store of an occurrences file, only the partitions needed are read
+
+        Parameters
+        ----------
+        CSVPATH : str
+            path of the csv file containing sightings
+        YEARS : list
+            years to read (str,int), None for all
+        OCC : list
+            occurrences to read (str), None for all
+
+        Returns
+        -------
+        DataFrame
+            columns of the csv file (typed, 'Date' parsed) and 'Year'
+    """
+    meta = read_metadata(CSVPATH)
+    path_store,_ = get_store_paths(CSVPATH)
+
+    filters = []
+    if YEARS!=None:
+        filters.append(('Year','in',[int(y) for y in YEARS]))
+    if OCC!=None:
+        filters.append(('Occurrences','in',[str(o) for o in OCC]))
+    if ((YEARS!=None) and (len(YEARS)==0)) or ((OCC!=None) and (len(OCC)==0)) or (meta["rows"]==0): # no parquet file
+        return pd.DataFrame(columns=meta["columns"])
+
+    df = pd.read_parquet(path_store,partitioning=PARTITIONING,filters=filters if filters!=[] else None)
+    df['Year'] = df['Year'].astype(int)
+    df['Occurrences'] = df['Occurrences'].astype(str)
+    return df[meta["columns"]].sort_values(by=['Date']).reset_index(drop=True)
+
+
+
+def delete_store(CSVPATH:str):
+    """ 
+        Delete the store of an occurrences file
+
+        Parameters
+        ----------
+        CSVPATH : str
+            path of the csv file containing sightings
+    """
+    path_store,path_meta = get_store_paths(CSVPATH)
+    if os.path.exists(path_store):
+        shutil.rmtree(path_store)
+    if os.path.exists(path_meta):
+        os.remove(path_meta)
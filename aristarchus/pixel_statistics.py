@@ -0,0 +1,1036 @@
+###########
+# IMPORTS #
+###########
+
+import os
+import json
+import hashlib
+import warnings
+from concurrent.futures import as_completed
+
+import xarray as xr
+import numpy as np
+import rioxarray
+import rasterio
+from rasterio.enums import Resampling
+
+import general_function as gf
+import dataset_pool as dp
+import spatial_index as si
+
+
+# First day (month*100+day) of each season, the winter ends at the next spring
+SEASONS = {"spring":(321,621),"summer":(621,921),"autumn":(921,1221),"winter":(1221,321)}
+
+# Creation options of the layers (GDAL COG driver)
+COG_OPTIONS = {"compress":"DEFLATE","predictor":"YES","blocksize":256,"overviews":"AUTO","resampling":"AVERAGE"}
+
+# Number of bins of the cached climatologies used for anomalies
+CLIM_BINS = {"day":366,"month":12}
+
+# Day of a leap year before the 1st of each month: a date has the same day bin every year (29 February = bin 59)
+MONTH_STARTS = np.cumsum([0,31,29,31,30,31,30,31,31,30,31,30])
+
+
+
+#####################
+# GENERAL FUNCTIONS #
+#####################
+
+
+def get_variable(FILEPATH:str):
+    """ 
+        Get the name of the variable and the year of a NetCDF file from its name
+
+        Parameters
+        ----------
+        FILEPATH : str
+            NetCDF file path
+
+        Returns
+        -------
+        str
+            name of the variable
+        int
+            year
+    """
+    ### EXTRACT FROM FILENAME
+    NAME = os.path.split(str(FILEPATH))[1]
+    YEAR = int(NAME.split("__")[-1])
+    VAR = NAME.split('__')[0].split("pfx")[-1]
+    if "]" in VAR:
+        VAR = VAR.split("]")[-1]
+    return VAR,YEAR
+
+
+
+def open_variable(FILEPATH:str,TIMERANGE=None):
+    """ 
+        Open the variable of a NetCDF file, with the next year for seasons (the winter ends in the next year)
+
+        Parameters
+        ----------
+        FILEPATH : str
+            NetCDF file path
+        TIMERANGE : str
+            name of timerange:year/season/month
+
+        Returns
+        -------
+        DataArray
+        int
+            year of the file
+    """
+    S,NAME = os.path.split(str(FILEPATH))
+    VAR,YEAR = get_variable(FILEPATH)
+    da = dp.open_dataset(FILEPATH)[VAR]
+    if TIMERANGE == 'season':
+        FILEPATH2 = os.path.join(S,NAME[:-len(str(YEAR))]+str(YEAR+1))
+        if os.path.exists(FILEPATH2):
+            da = xr.concat([da,dp.open_dataset(FILEPATH2)[VAR]],dim="time")
+    return da,YEAR
+
+
+
+def get_time_ranges(TIMES,TIMERANGE:str,YEAR=None):
+    """ 
+        Divide the time axis of a file in years, seasons or months
+
+        Parameters
+        ----------
+        TIMES : DataArray
+            time coordinate (datetime or cftime)
+        TIMERANGE : str
+            name of timerange:year/season/month
+        YEAR : int
+            year of the file, the winter ends in YEAR+1 if TIMES contains the next year
+            None for climatologies (days of any year)
+
+        Returns
+        -------
+        list of tuple (str,array (bool))
+            suffix of the layers and days of each range
+    """
+    year = TIMES.dt.year.values
+    md = TIMES.dt.month.values*100+TIMES.dt.day.values
+    if YEAR!=None:
+        this_year = (year==YEAR)
+        next_year = (year==YEAR+1)
+    else:
+        this_year = np.ones(len(year),dtype=bool)
+        next_year = this_year
+
+    if TIMERANGE == 'year':
+        return [("",this_year)]
+
+    elif TIMERANGE == 'month':
+        month = TIMES.dt.month.values
+        return [(str(m),this_year & (month==m)) for m in range(1,13)]
+
+    elif TIMERANGE == 'season':
+        ranges = []
+        for season,(start,end) in SEASONS.items():
+            if start<end:
+                ranges.append((season,this_year & (md>=start) & (md<end)))
+            else:
+                ranges.append((season,(this_year & (md>=start)) | (next_year & (md<end))))
+        return ranges
+
+    raise ValueError("Unknown time range: "+str(TIMERANGE))
+
+
+
+class PixelAccumulator:
+    """ 
+        Streaming statistics of each pixel: count, mean and sum of squared deviations (Welford/Chan), min and max
+        Days are added by chunks with bounded memory, partial accumulators (other years, other processes) can be merged
+
+        Parameters
+        ----------
+        SHAPE : tuple
+            shape of a day, (depth,) lat, lon
+    """
+    def __init__(self,SHAPE):
+        self.count = np.zeros(SHAPE,dtype=np.int64)
+        self.mean = np.zeros(SHAPE,dtype=np.float64)
+        self.m2 = np.zeros(SHAPE,dtype=np.float64)
+        self.min = np.full(SHAPE,np.inf)
+        self.max = np.full(SHAPE,-np.inf)
+
+    def _combine(self,N,MEAN,M2,MIN,MAX):
+        """ Chan et al. pairwise update of count, mean and M2 """
+        total = self.count+N
+        safe = np.maximum(total,1)
+        delta = MEAN-self.mean
+        self.mean = self.mean+delta*(N/safe)
+        self.m2 = self.m2+M2+delta**2*(self.count*(N/safe))
+        self.count = total
+        np.minimum(self.min,MIN,out=self.min)
+        np.maximum(self.max,MAX,out=self.max)
+
+    def update(self,VALUES,AXIS=0):
+        """ 
+            Add several days, NaN are ignored
+
+            Parameters
+            ----------
+            VALUES : array
+                days along AXIS, other axes of shape SHAPE
+            AXIS : int
+                time axis
+
+            Returns
+            -------
+            PixelAccumulator
+        """
+        values = np.asarray(VALUES,dtype=np.float64)
+        valid = np.isfinite(values)
+        n = valid.sum(axis=AXIS)
+        mean = np.divide(np.where(valid,values,0).sum(axis=AXIS),n,out=np.zeros(n.shape),where=n>0)
+        dev = np.where(valid,values-np.expand_dims(mean,AXIS),0)
+        self._combine(n,mean,(dev**2).sum(axis=AXIS),
+                      np.where(valid,values,np.inf).min(axis=AXIS),
+                      np.where(valid,values,-np.inf).max(axis=AXIS))
+        return self
+
+    def merge(self,OTHER):
+        """ 
+            Add the days of another accumulator of the same shape
+
+            Parameters
+            ----------
+            OTHER : PixelAccumulator
+
+            Returns
+            -------
+            PixelAccumulator
+        """
+        self._combine(OTHER.count,OTHER.mean,OTHER.m2,OTHER.min,OTHER.max)
+        return self
+
+    def result(self,STATS:list):
+        """ 
+            Get statistics of each pixel, NaN if no value
+
+            Parameters
+            ----------
+            STATS : list (str)
+                name of analysis:average/standard deviation/min and max
+
+            Returns
+            -------
+            dict
+                key=suffix of the statistic (avg,std,min,max), value=array of shape SHAPE
+        """
+        empty = self.count==0
+        result = {}
+        if "average" in STATS:
+            result["avg"] = np.where(empty,np.nan,self.mean)
+        if "standard deviation" in STATS:
+            result["std"] = np.where(empty,np.nan,np.sqrt(self.m2/np.maximum(self.count,1)))
+        if "min and max" in STATS:
+            result["min"] = np.where(empty,np.nan,self.min)
+            result["max"] = np.where(empty,np.nan,self.max)
+        return result
+
+
+
+def accumulate_file(FILEPATH:str,TIMERANGE:str,CHUNK=31,CLIM=True):
+    """ 
+        Read a NetCDF file by chunks of days and accumulate statistics of each time range
+
+        Parameters
+        ----------
+        FILEPATH : str
+            NetCDF file path
+        TIMERANGE : str
+            name of timerange:year/season/month
+        CHUNK : int
+            number of days loaded at once
+        CLIM : bool
+            True for days of any year (climatologies), False for the year of the file (and the winter in the next year)
+
+        Returns
+        -------
+        dict
+            key=suffix of the time range, value=PixelAccumulator
+    """
+    if CLIM:
+        da,_ = open_variable(FILEPATH)
+        ranges = get_time_ranges(da['time'],TIMERANGE)
+    else:
+        da,YEAR = open_variable(FILEPATH,TIMERANGE)
+        ranges = get_time_ranges(da['time'],TIMERANGE,YEAR)
+    axis = da.get_axis_num('time')
+    shape = da.isel(time=0).shape
+
+    acc = {suffix:PixelAccumulator(shape) for suffix,_ in ranges}
+    for t0 in range(0,da.sizes['time'],int(CHUNK)):
+        days = slice(t0,t0+int(CHUNK))
+        values = None
+        for suffix,mask in ranges:
+            sel = mask[days]
+            if sel.any():
+                if values is None:
+                    values = da.isel(time=days).values
+                acc[suffix].update(np.compress(sel,values,axis=axis),AXIS=axis)
+    return acc
+
+
+
+class PixelHistogram:
+    """ 
+        Histogram of the values of each pixel between known limits, to estimate percentiles with bounded memory
+        (NBINS counts of 2 bytes per pixel, error lower than (VMAX-VMIN)/NBINS), used on 1 spatial tile at a time
+
+        Parameters
+        ----------
+        VMIN : array
+            minimum of each pixel
+        VMAX : array
+            maximum of each pixel
+        NBINS : int
+            number of bins between VMIN and VMAX
+    """
+    def __init__(self,VMIN,VMAX,NBINS=256):
+        self.vmin = np.asarray(VMIN,dtype=np.float64)
+        self.width = np.maximum(np.asarray(VMAX,dtype=np.float64)-self.vmin,0)/int(NBINS)
+        self.nbins = int(NBINS)
+        self.counts = np.zeros((self.nbins,)+self.vmin.shape,dtype=np.uint16) # at most 1 value per day and pixel
+
+    def update(self,VALUES,AXIS=0):
+        """ 
+            Add several days, NaN are ignored
+
+            Parameters
+            ----------
+            VALUES : array
+                days along AXIS, other axes of the shape of VMIN
+            AXIS : int
+                time axis
+
+            Returns
+            -------
+            PixelHistogram
+        """
+        values = np.moveaxis(np.asarray(VALUES,dtype=np.float64),AXIS,0).reshape(-1,self.vmin.size)
+        valid = np.isfinite(values)
+        vmin = self.vmin.reshape(1,-1)
+        width = self.width.reshape(1,-1)
+        with np.errstate(invalid="ignore",divide="ignore"):
+            b = np.floor(np.where(width>0,(values-vmin)/width,0))
+        b = np.clip(np.nan_to_num(b),0,self.nbins-1).astype(np.int64)
+        # index in the flat counts = bin*pixels+pixel, added in place (no temporary array of the size of counts)
+        flat = b*self.vmin.size+np.arange(self.vmin.size)[None,:]
+        np.add.at(self.counts.reshape(-1),flat[valid],1)
+        return self
+
+    def merge(self,OTHER):
+        """ 
+            Add the counts of another histogram with the same limits
+
+            Parameters
+            ----------
+            OTHER : PixelHistogram
+
+            Returns
+            -------
+            PixelHistogram
+        """
+        self.counts += OTHER.counts
+        return self
+
+    def percentiles(self,PERCENTILES:list):
+        """ 
+            Estimate percentiles of each pixel (linear interpolation in the bin)
+
+            Parameters
+            ----------
+            PERCENTILES : list (int)
+                between 0 and 100
+
+            Returns
+            -------
+            dict
+                key=percentile, value=array of the shape of VMIN, NaN if no value
+        """
+        cum = np.cumsum(self.counts,axis=0,dtype=np.int64)
+        total = cum[-1]
+        result = {}
+        for q in PERCENTILES:
+            target = total*float(q)/100
+            k = np.minimum((cum<target[None,...]).sum(axis=0),self.nbins-1) # first bin reaching the target
+            before = np.where(k>0,np.take_along_axis(cum,np.maximum(k-1,0)[None,...],axis=0)[0],0)
+            inside = np.take_along_axis(self.counts,k[None,...],axis=0)[0]
+            frac = np.divide(target-before,inside,out=np.zeros(target.shape),where=inside>0)
+            result[q] = np.where(total>0,self.vmin+(k+np.clip(frac,0,1))*self.width,np.nan)
+        return result
+
+
+
+def histogram_file(FILEPATH:str,TIMERANGE:str,LIMITS:dict,NBINS=256,CHUNK=31,CLIM=True,TILE=None):
+    """ 
+        Read 1 tile of a NetCDF file by chunks of days and count values of each time range in histograms
+
+        Parameters
+        ----------
+        FILEPATH : str
+            NetCDF file path
+        TIMERANGE : str
+            name of timerange:year/season/month
+        LIMITS : dict
+            key=suffix of the time range, value=(min,max) of each pixel of the tile
+        NBINS : int
+            number of bins of the histograms
+        CHUNK : int
+            number of days loaded at once
+        CLIM : bool
+            True for days of any year (climatologies), False for the year of the file (and the winter in the next year)
+        TILE : tuple
+            (first latitude, last latitude+1, first longitude, last longitude+1), None for the whole grid
+
+        Returns
+        -------
+        dict
+            key=suffix of the time range, value=PixelHistogram
+    """
+    if CLIM:
+        da,_ = open_variable(FILEPATH)
+        ranges = get_time_ranges(da['time'],TIMERANGE)
+    else:
+        da,YEAR = open_variable(FILEPATH,TIMERANGE)
+        ranges = get_time_ranges(da['time'],TIMERANGE,YEAR)
+    if TILE!=None:
+        latname,lonname = gf.get_latlon_names(da)
+        da = da.isel({latname:slice(TILE[0],TILE[1]),lonname:slice(TILE[2],TILE[3])})
+    axis = da.get_axis_num('time')
+
+    hist = {suffix:PixelHistogram(vmin,vmax,NBINS) for suffix,(vmin,vmax) in LIMITS.items()}
+    for t0 in range(0,da.sizes['time'],int(CHUNK)):
+        days = slice(t0,t0+int(CHUNK))
+        values = None
+        for suffix,mask in ranges:
+            sel = mask[days]
+            if (suffix in hist) and sel.any():
+                if values is None:
+                    values = da.isel(time=days).values
+                hist[suffix].update(np.compress(sel,values,axis=axis),AXIS=axis)
+    return hist
+
+
+
+def get_bins(TIMES,BINS:str):
+    """ 
+        Get the climatology bin of each day
+
+        Parameters
+        ----------
+        TIMES : DataArray
+            time coordinate (datetime or cftime)
+        BINS : str
+            "day" (month and day, counted as in a leap year) or "month"
+
+        Returns
+        -------
+        array (int)
+            from 0 to CLIM_BINS[BINS]-1
+    """
+    if BINS == "month":
+        return TIMES.dt.month.values-1
+    elif BINS == "day":
+        return MONTH_STARTS[TIMES.dt.month.values-1]+TIMES.dt.day.values-1
+    raise ValueError("Unknown climatology bins: "+str(BINS))
+
+
+
+def accumulate_bins(FILEPATH:str,BINS:str,CHUNK=31,TILE=None):
+    """ 
+        Read 1 tile of a NetCDF file by chunks of days and sum values of each climatology bin
+
+        Parameters
+        ----------
+        FILEPATH : str
+            NetCDF file path
+        BINS : str
+            "day" or "month"
+        CHUNK : int
+            number of days loaded at once
+        TILE : tuple
+            (first latitude, last latitude+1, first longitude, last longitude+1), None for the whole grid
+
+        Returns
+        -------
+        array (float32)
+            sum of each bin, shape (bins,(depth,) lat, lon) of the tile
+        array (int32)
+            number of values of each bin
+    """
+    VAR,_ = get_variable(FILEPATH)
+    da = dp.open_dataset(FILEPATH)[VAR]
+    if TILE!=None:
+        latname,lonname = gf.get_latlon_names(da)
+        da = da.isel({latname:slice(TILE[0],TILE[1]),lonname:slice(TILE[2],TILE[3])})
+    axis = da.get_axis_num('time')
+    bins = get_bins(da['time'],BINS)
+    shape = (CLIM_BINS[BINS],)+da.isel(time=0).shape
+
+    sums = np.zeros(shape,dtype=np.float32)
+    counts = np.zeros(shape,dtype=np.int32)
+    for t0 in range(0,da.sizes['time'],int(CHUNK)):
+        days = slice(t0,t0+int(CHUNK))
+        values = np.moveaxis(np.asarray(da.isel(time=days).values,dtype=np.float32),axis,0)
+        valid = np.isfinite(values)
+        # several days of a chunk can fall in the same bin (months)
+        np.add.at(sums,bins[days],np.where(valid,values,0))
+        np.add.at(counts,bins[days],valid)
+    return sums,counts
+
+
+
+def climatology_tile(FILES:list,BINS:str,TILE:tuple,CHUNK=31):
+    """ 
+        Compute the climatology of 1 tile over several NetCDF files (run in a worker process)
+
+        Returns
+        -------
+        tuple
+            TILE
+        array (float32)
+            mean of each bin, shape (bins,(depth,) lat, lon) of the tile, NaN if no value
+    """
+    sums,counts = None,None
+    for f in FILES:
+        part_sums,part_counts = accumulate_bins(f,BINS,CHUNK,TILE)
+        sums = part_sums if sums is None else sums+part_sums
+        counts = part_counts if counts is None else counts+part_counts
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning) # bins without value
+        return TILE,sums/counts
+
+
+
+def get_tiles(SHAPE,TILE=256):
+    """ 
+        Divide a grid in square tiles
+
+        Parameters
+        ----------
+        SHAPE : tuple
+            number of latitudes, number of longitudes
+        TILE : int
+            size of a tile in pixels
+
+        Returns
+        -------
+        list of tuple
+            (first latitude, last latitude+1, first longitude, last longitude+1) of each tile
+    """
+    return [(y0,min(y0+int(TILE),SHAPE[0]),x0,min(x0+int(TILE),SHAPE[1]))
+            for y0 in range(0,SHAPE[0],int(TILE)) for x0 in range(0,SHAPE[1],int(TILE))]
+
+
+
+def tile_statistics(FILEPATH:str,TIMERANGE:str,SUFFIX:str,STATS:list,TILE:tuple,CHUNK=31):
+    """ 
+        Compute statistics of 1 tile over 1 time range of a file, reading CHUNK days at once
+        (memory bounded by CHUNK*depth*TILE*TILE)
+
+        Parameters
+        ----------
+        FILEPATH : str
+            NetCDF file path
+        TIMERANGE : str
+            name of timerange:year/season/month
+        SUFFIX : str
+            time range of TIMERANGE to compute (see get_time_ranges)
+        STATS : list (str)
+            name of analysis:average/standard deviation/min and max
+        TILE : tuple
+            (first latitude, last latitude+1, first longitude, last longitude+1)
+        CHUNK : int
+            number of days loaded at once
+
+        Returns
+        -------
+        str
+            SUFFIX
+        tuple
+            TILE
+        dict
+            key=suffix of the statistic (avg,std,min,max), value=array of the tile
+    """
+    da,YEAR = open_variable(FILEPATH,TIMERANGE)
+    latname,lonname = gf.get_latlon_names(da)
+    days = np.flatnonzero(dict(get_time_ranges(da['time'],TIMERANGE,YEAR))[SUFFIX])
+    da = da.isel({latname:slice(TILE[0],TILE[1]),lonname:slice(TILE[2],TILE[3])})
+    axis = da.get_axis_num('time')
+
+    acc = PixelAccumulator(da.isel(time=0).shape)
+    for t0 in range(0,len(days),int(CHUNK)):
+        acc.update(da.isel(time=days[t0:t0+int(CHUNK)]).values,AXIS=axis)
+    return SUFFIX,TILE,acc.result(STATS)
+
+
+
+def layer_path(BDIR:str,SERVICE:str,NAME:str,STAT:str,SUFFIX:str):
+    """ 
+        Path of a layer: <BDIR>/Layers/<SERVICE>/<NAME>_<STAT><SUFFIX> (GeoTIFF without extension)
+
+        Parameters
+        ----------
+        BDIR : str
+            path to the backup folder
+        SERVICE : str
+            name of the service
+        NAME : str
+            name of the NetCDF file
+        STAT : str
+            avg/std/min/max
+        SUFFIX : str
+            ""(year), month number or season name
+
+        Returns
+        -------
+        str
+    """
+    path = os.path.join(str(BDIR),"Layers",str(SERVICE))
+    os.makedirs(path,exist_ok=True)
+    return os.path.join(path,str(NAME)+"_"+str(STAT)+str(SUFFIX))
+
+
+
+def write_layer(VALUES,TEMPLATE,FILEPATH:str):
+    """ 
+        Write a statistic as a Cloud-Optimized GeoTIFF (float32, tiled, overviews), 1 band per depth level
+
+        Parameters
+        ----------
+        VALUES : array
+            shape (depth,) lat, lon
+        TEMPLATE : DataArray
+            data of the NetCDF file without the time axis, gives coordinates
+        FILEPATH : str
+            path of the layer
+    """
+    latname,lonname = gf.get_latlon_names(TEMPLATE)
+    da = xr.DataArray(np.asarray(VALUES,dtype=np.float32),dims=TEMPLATE.dims,coords={d:TEMPLATE[d] for d in TEMPLATE.dims})
+    da = da.rename({latname:"y",lonname:"x"}).sortby("y",ascending=False) # north up
+    da = da.transpose(*[d for d in da.dims if d not in ("y","x")],"y","x")
+
+    tags = {}
+    if "depth" in da.dims:
+        # read back as a depth coordinate by rioxarray (see script_motuclient.get_depths)
+        depths = da["depth"].values
+        tags = {"NETCDF_DIM_EXTRA":"{depth}",
+                "NETCDF_DIM_depth_DEF":"{"+str(len(depths))+",6}",
+                "NETCDF_DIM_depth_VALUES":"{"+",".join(str(float(d)) for d in depths)+"}"}
+        da = da.drop_vars("depth")
+
+    da = da.rio.set_spatial_dims(x_dim="x",y_dim="y").rio.write_crs("EPSG:4326").rio.write_nodata(np.nan)
+    dp.close(FILEPATH) # a previous version may be open
+    with rasterio.Env() as env:
+        cog = "COG" in env.drivers()
+    if cog:
+        # Cloud-Optimized GeoTIFF: tiled, compressed, with overviews read by script_motuclient.create_map
+        da.rio.to_raster(str(FILEPATH),driver="COG",tags=tags,**COG_OPTIONS)
+    else:
+        # GDAL < 3.1 (no COG driver): tiled GeoTIFF, then overviews
+        da.rio.to_raster(str(FILEPATH),driver="GTiff",tags=tags,tiled=True,blockxsize=256,blockysize=256,compress="deflate",predictor=3)
+        with rasterio.open(str(FILEPATH),"r+") as dst:
+            factors = [2**i for i in range(1,8) if max(dst.width,dst.height)/2**i>=256]
+            dst.build_overviews(factors,Resampling.average)
+
+
+
+#########################
+# FUNCTIONS - INTERFACE #
+#########################
+
+
+def run_analysis(BDIR:str,FILEPATH:str,STATS:list,TIMERANGE:str,WORKERS=None,TILE=256,CHUNK=31):
+    """ 
+        Compute statistics over a NetCDF file with NumPy, without QGIS
+        Same layers as script_qgis_software.run_qgis_analysis, for regular grids only
+        The grid is divided in tiles, each tile and time range is computed by a process, then tiles are stitched
+
+        Save data into :
+            - <BDIR>/Layers/<SERVICE>/<NAME>_<avg/std/min/max><suffix>
+
+        Parameters
+        ----------
+        BDIR : str
+            path to the backup folder
+        FILEPATH : str
+            NetCDF file path
+        STATS : list (str)
+            name of analysis:average/standard deviation/min and max
+        TIMERANGE : str
+            name of timerange:year/season/month
+        WORKERS : int
+            number of processes, None for the number of cores
+        TILE : int
+            size of the tiles in pixels
+        CHUNK : int
+            number of days loaded at once by each process
+
+        Returns
+        -------
+        list (str)
+            path of the layers created
+    """
+    S,NAME = os.path.split(str(FILEPATH))
+    SERVICE = os.path.split(S)[1]
+
+    if not any(stat in STATS for stat in ["average","standard deviation","min and max"]): # only anomaly/percentiles
+        return []
+    if si.is_curvilinear(dp.open_dataset(FILEPATH)):
+        raise ValueError("Statistics on each pixel need a regular grid: "+NAME)
+    da,YEAR = open_variable(FILEPATH,TIMERANGE)
+    latname,lonname = gf.get_latlon_names(da)
+
+    template = da.isel(time=0,drop=True)
+    suffixes = [suffix for suffix,days in get_time_ranges(da['time'],TIMERANGE,YEAR) if days.any()]
+    tiles = get_tiles((da.sizes[latname],da.sizes[lonname]),TILE)
+    jobs = [(suffix,tile) for suffix in suffixes for tile in tiles]
+
+    # stitch tiles in the layers
+    lat_axis = template.get_axis_num(latname)
+    lon_axis = template.get_axis_num(lonname)
+    layers = {}
+    def stitch(SUFFIX,TILE,RESULT):
+        index = [slice(None)]*template.ndim
+        index[lat_axis] = slice(TILE[0],TILE[1])
+        index[lon_axis] = slice(TILE[2],TILE[3])
+        for stat,values in RESULT.items():
+            if (SUFFIX,stat) not in layers:
+                layers[(SUFFIX,stat)] = np.full(template.shape,np.nan,dtype=np.float32)
+            layers[(SUFFIX,stat)][tuple(index)] = values
+
+    if (len(jobs)==1) or (WORKERS==1):
+        for suffix,tile in jobs:
+            stitch(*tile_statistics(FILEPATH,TIMERANGE,suffix,STATS,tile,CHUNK))
+    elif len(jobs)>1:
+        with gf.process_pool(min(len(jobs),WORKERS or os.cpu_count() or 1)) as pool:
+            futures = [pool.submit(tile_statistics,FILEPATH,TIMERANGE,suffix,STATS,tile,CHUNK) for suffix,tile in jobs]
+            for future in as_completed(futures):
+                stitch(*future.result())
+
+    created = []
+    for (suffix,stat),values in layers.items():
+        output = layer_path(BDIR,SERVICE,NAME,stat,suffix)
+        write_layer(values,template,output)
+        created.append(output)
+    return created
+
+
+
+def climatology(BDIR:str,SERVICE:str,VAR_FULL:str,YEARS:list,STATS:list,TIMERANGE:str,WORKERS=None,CHUNK=31):
+    """ 
+        Compute statistics of each pixel over several years (ex: mean of July 1993-2023)
+        Each year is read by chunks of days in parallel, partial statistics are merged
+
+        Save data into :
+            - <BDIR>/Layers/<SERVICE>/<VAR_FULL>__<YEARMIN>-<YEARMAX>_<avg/std/min/max><suffix>
+
+        Parameters
+        ----------
+        BDIR : str
+            path to the backup folder
+        SERVICE : str
+            name of the service
+        VAR_FULL : str
+            name of the NetCDF files without the year
+        YEARS : list (int)
+            years to use, missing files are ignored
+        STATS : list (str)
+            name of analysis:average/standard deviation/min and max
+        TIMERANGE : str
+            name of timerange:year/season/month
+        WORKERS : int
+            number of processes, None for the number of cores
+        CHUNK : int
+            number of days loaded at once by each process
+
+        Returns
+        -------
+        list (str)
+            path of the layers created
+    """
+    path = os.path.join(str(BDIR),"NetCDF_files",str(SERVICE))
+    files = {int(y):os.path.join(path,str(VAR_FULL)+"__"+str(y)) for y in YEARS}
+    files = {y:f for y,f in files.items() if os.path.exists(f)}
+    if files == {}:
+        return []
+
+    total = {}
+    if len(files)==1:
+        parts = [accumulate_file(f,TIMERANGE,CHUNK) for f in files.values()]
+    else:
+        with gf.process_pool(min(len(files),WORKERS or os.cpu_count() or 1)) as pool:
+            parts = pool.map(accumulate_file,files.values(),[TIMERANGE]*len(files),[CHUNK]*len(files))
+            parts = list(parts)
+    for part in parts:
+        for suffix,acc in part.items():
+            total[suffix] = acc if suffix not in total else total[suffix].merge(acc)
+
+    VAR,_ = get_variable(next(iter(files.values())))
+    template = dp.open_dataset(next(iter(files.values())))[VAR].isel(time=0,drop=True)
+    NAME = str(VAR_FULL)+"__"+str(min(files))+"-"+str(max(files))
+    created = []
+    for suffix,acc in total.items():
+        if not (acc.count>0).any():
+            continue
+        for stat,values in acc.result(STATS).items():
+            output = layer_path(BDIR,SERVICE,NAME,stat,suffix)
+            write_layer(values,template,output)
+            created.append(output)
+    return created
+
+
+
+def get_climatology(BDIR:str,SERVICE:str,VAR_FULL:str,YEARS=None,BINS="day",WORKERS=None,TILE=64,CHUNK=31):
+    """ 
+        Get the mean of each pixel for each day of year or month over several years
+        Computed once, 1 spatial tile per process written in the cache file, then read from the cache
+        until a NetCDF file of these years changes
+
+        Save data into :
+            - <BDIR>/NetCDF_files/<SERVICE>/.cache/<VAR_FULL>-CLIM-<BINS>-<YEARMIN>-<YEARMAX>-<hash of years>.npy (and .json)
+
+        Parameters
+        ----------
+        BDIR : str
+            path to the backup folder
+        SERVICE : str
+            name of the service
+        VAR_FULL : str
+            name of the NetCDF files without the year
+        YEARS : list (int)
+            reference years, None for all the files of the variable
+        BINS : str
+            "day" (month and day) or "month"
+        WORKERS : int
+            number of processes, None for the number of cores
+        TILE : int
+            size of the tiles in pixels, memory = bins*depth*TILE*TILE*8 bytes for each process
+        CHUNK : int
+            number of days loaded at once by each process
+
+        Returns
+        -------
+        array (float32)
+            shape (bins,(depth,) lat, lon), NaN if no value (read only)
+    """
+    path = os.path.join(str(BDIR),"NetCDF_files",str(SERVICE))
+    if YEARS==None:
+        ### EXTRACT FROM FILENAME
+        YEARS = [p.split("__")[-1] for p in gf.show_available_files_simple(path,"") if p.split("__")[0]==str(VAR_FULL)]
+    files = {int(y):os.path.join(path,str(VAR_FULL)+"__"+str(y)) for y in YEARS}
+    files = {y:f for y,f in sorted(files.items()) if os.path.exists(f)}
+    if files == {}:
+        raise FileNotFoundError("No NetCDF file for "+str(VAR_FULL))
+
+    years = hashlib.md5(",".join(str(y) for y in files).encode()).hexdigest()[:8] # same limits, other years
+    suffix = "-CLIM-"+str(BINS)+"-"+str(min(files))+"-"+str(max(files))+"-"+years
+    path_clim = gf.get_cache_path(os.path.join(path,str(VAR_FULL)),suffix+".npy")
+    path_meta = gf.get_cache_path(os.path.join(path,str(VAR_FULL)),suffix+".json")
+    stamps = {os.path.split(f)[1]:os.stat(f).st_mtime_ns for f in files.values()}
+
+    if os.path.exists(path_clim) and os.path.exists(path_meta):
+        with open(path_meta,"r") as f:
+            if json.load(f)==stamps:
+                return np.load(path_clim,mmap_mode='r')
+
+    VAR,_ = get_variable(next(iter(files.values())))
+    template = dp.open_dataset(next(iter(files.values())))[VAR].isel(time=0,drop=True)
+    latname,lonname = gf.get_latlon_names(template)
+    lat_axis = template.get_axis_num(latname)+1 # first axis: bins
+    lon_axis = template.get_axis_num(lonname)+1
+    tiles = get_tiles((template.sizes[latname],template.sizes[lonname]),TILE)
+
+    # the climatology is written on disk tile by tile, never loaded in memory at once
+    clim = np.lib.format.open_memmap(path_clim+".tmp",mode="w+",dtype=np.float32,shape=(CLIM_BINS[BINS],)+template.shape)
+    def stitch(TILE,VALUES):
+        index = [slice(None)]*clim.ndim
+        index[lat_axis] = slice(TILE[0],TILE[1])
+        index[lon_axis] = slice(TILE[2],TILE[3])
+        clim[tuple(index)] = VALUES
+
+    paths = list(files.values())
+    if (len(tiles)==1) or (WORKERS==1):
+        for tile in tiles:
+            stitch(*climatology_tile(paths,BINS,tile,CHUNK))
+    else:
+        with gf.process_pool(min(len(tiles),WORKERS or os.cpu_count() or 1)) as pool:
+            futures = [pool.submit(climatology_tile,paths,BINS,tile,CHUNK) for tile in tiles]
+            for future in as_completed(futures):
+                stitch(*future.result())
+    clim.flush()
+    del clim
+    os.replace(path_clim+".tmp",path_clim)
+    with open(path_meta,"w") as f:
+        f.write(json.dumps(stamps, indent = 4))
+    return np.load(path_clim,mmap_mode='r')
+
+
+
+def anomaly(BDIR:str,FILEPATH:str,TIMERANGE:str,YEARS=None,BINS="day",CHUNK=31):
+    """ 
+        Compute the anomaly of each pixel against the climatology (average of the differences with the normal of each day)
+        The climatology is read from the cache (see get_climatology)
+
+        Save data into :
+            - <BDIR>/Layers/<SERVICE>/<NAME>_anom<suffix>
+
+        Parameters
+        ----------
+        BDIR : str
+            path to the backup folder
+        FILEPATH : str
+            NetCDF file path
+        TIMERANGE : str
+            name of timerange:year/season/month
+        YEARS : list (int)
+            reference years of the climatology, None for all the files of the variable
+        BINS : str
+            "day" (month and day) or "month" climatology
+        CHUNK : int
+            number of days loaded at once
+
+        Returns
+        -------
+        list (str)
+            path of the layers created
+    """
+    S,NAME = os.path.split(str(FILEPATH))
+    SERVICE = os.path.split(S)[1]
+    VAR_FULL = NAME.split("__")[0] ### EXTRACT FROM FILENAME
+
+    clim = get_climatology(BDIR,SERVICE,VAR_FULL,YEARS,BINS)
+
+    da,YEAR = open_variable(FILEPATH,TIMERANGE)
+    axis = da.get_axis_num('time')
+    bins = get_bins(da['time'],BINS)
+    ranges = get_time_ranges(da['time'],TIMERANGE,YEAR)
+    template = da.isel(time=0,drop=True)
+
+    acc = {suffix:PixelAccumulator(template.shape) for suffix,days in ranges if days.any()}
+    for t0 in range(0,da.sizes['time'],int(CHUNK)):
+        days = slice(t0,t0+int(CHUNK))
+        sel = {suffix:mask[days] for suffix,mask in ranges if (suffix in acc) and mask[days].any()}
+        if sel == {}:
+            continue
+        # difference with the normal of each day
+        values = np.moveaxis(np.asarray(da.isel(time=days).values,dtype=np.float64),axis,0)-clim[bins[days]]
+        for suffix,mask in sel.items():
+            acc[suffix].update(values[mask],AXIS=0)
+
+    created = []
+    for suffix,a in acc.items():
+        output = layer_path(BDIR,SERVICE,NAME,"anom",suffix)
+        write_layer(a.result(["average"])["avg"],template,output)
+        created.append(output)
+    return created
+
+
+
+def percentiles(BDIR:str,SERVICE:str,VAR_FULL:str,YEARS:list,TIMERANGE:str,PERCENTILES=[10,90,99],NBINS=256,WORKERS=None,TILE=256,CHUNK=31):
+    """ 
+        Estimate percentiles of each pixel over 1 year or several years with bounded memory:
+        a first pass gets min and max of each pixel, a second pass counts values in NBINS bins between them,
+        1 spatial tile at a time
+
+        Save data into :
+            - <BDIR>/Layers/<SERVICE>/<VAR_FULL>__<YEAR>_p<PP><suffix> (1 year)
+            - <BDIR>/Layers/<SERVICE>/<VAR_FULL>__<YEARMIN>-<YEARMAX>_p<PP><suffix> (several years)
+
+        Parameters
+        ----------
+        BDIR : str
+            path to the backup folder
+        SERVICE : str
+            name of the service
+        VAR_FULL : str
+            name of the NetCDF files without the year
+        YEARS : list (int)
+            years to use, missing files are ignored
+        TIMERANGE : str
+            name of timerange:year/season/month
+        PERCENTILES : list (int)
+            between 1 and 99, written with 2 digits (p05, p90)
+        NBINS : int
+            number of bins of the histograms, memory = NBINS*TILE*TILE*2 bytes for each time range and tile
+        WORKERS : int
+            number of processes, None for the number of cores
+        TILE : int
+            size of the tiles in pixels
+        CHUNK : int
+            number of days loaded at once by each process
+
+        Returns
+        -------
+        list (str)
+            path of the layers created
+    """
+    path = os.path.join(str(BDIR),"NetCDF_files",str(SERVICE))
+    files = {int(y):os.path.join(path,str(VAR_FULL)+"__"+str(y)) for y in YEARS}
+    files = {y:f for y,f in sorted(files.items()) if os.path.exists(f)}
+    if files == {}:
+        return []
+    clim = len(files)>1
+    n = len(files)
+
+    # 1 process per file, results merged in order, the same processes for all tiles
+    pool = gf.process_pool(min(n,WORKERS or os.cpu_count() or 1)) if n>1 else None
+    def run(function,*args):
+        if pool==None:
+            return [function(f,*args) for f in files.values()]
+        return list(pool.map(function,files.values(),*[[a]*n for a in args]))
+
+    VAR,_ = get_variable(next(iter(files.values())))
+    template = dp.open_dataset(next(iter(files.values())))[VAR].isel(time=0,drop=True)
+    latname,lonname = gf.get_latlon_names(template)
+    lat_axis = template.get_axis_num(latname)
+    lon_axis = template.get_axis_num(lonname)
+    layers = {}
+    def tile_index(TILE):
+        index = [slice(None)]*template.ndim
+        index[lat_axis] = slice(TILE[0],TILE[1])
+        index[lon_axis] = slice(TILE[2],TILE[3])
+        return tuple(index)
+
+    try:
+        # first pass: limits of each pixel
+        limits = {}
+        for part in run(accumulate_file,TIMERANGE,CHUNK,clim):
+            for suffix,acc in part.items():
+                limits[suffix] = acc if suffix not in limits else limits[suffix].merge(acc)
+        limits = {suffix:(acc.min,acc.max) for suffix,acc in limits.items() if (acc.count>0).any()}
+
+        # second pass: histograms of 1 tile at a time (all files), percentiles stitched in the layers
+        for tile in get_tiles((template.sizes[latname],template.sizes[lonname]),TILE):
+            index = tile_index(tile)
+            tile_limits = {suffix:(vmin[index],vmax[index]) for suffix,(vmin,vmax) in limits.items()}
+            hist = {}
+            for part in run(histogram_file,TIMERANGE,tile_limits,NBINS,CHUNK,clim,tile):
+                for suffix,h in part.items():
+                    hist[suffix] = h if suffix not in hist else hist[suffix].merge(h)
+            for suffix,h in hist.items():
+                for q,values in h.percentiles([int(q) for q in PERCENTILES]).items():
+                    if (suffix,q) not in layers:
+                        layers[(suffix,q)] = np.full(template.shape,np.nan,dtype=np.float32)
+                    layers[(suffix,q)][index] = values
+    finally:
+        if pool!=None:
+            pool.shutdown()
+
+    if clim:
+        NAME = str(VAR_FULL)+"__"+str(min(files))+"-"+str(max(files))
+    else:
+        NAME = str(VAR_FULL)+"__"+str(min(files))
+    created = []
+    for (suffix,q),values in layers.items():
+        output = layer_path(BDIR,SERVICE,NAME,"p%02d" % q,suffix)
+        write_layer(values,template,output)
+        created.append(output)
+    return created
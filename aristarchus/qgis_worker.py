@@ -0,0 +1,268 @@
+###########
+# IMPORTS #
+###########
+
+import os
+import sys
+import json
+import time
+import queue
+import secrets
+import threading
+import traceback
+import subprocess
+from multiprocessing.connection import Listener, Client
+
+import general_function as gf
+
+
+# QGIS is started once in a separate process (the worker), which receives statistics jobs on a local socket:
+# the Streamlit process never imports QGIS and is not affected if QGIS fails.
+#   - ./.cache/options.json-QGIS.json : address and key of the running worker
+#   - ./.cache/options.json-QGIS.log : output of the worker
+
+################ TO ADAPT ################
+OPTIONS = "./options.json"
+
+START_TIMEOUT = 120 # seconds to wait for QGIS initialization
+
+_JOBS = queue.Queue() # jobs waiting in the worker process, run one by one (QGIS processing is not thread safe)
+_STATUS = {"running":None,"done":0,"failed":0}
+
+
+
+#####################
+# GENERAL FUNCTIONS #
+#####################
+
+
+def get_state_path():
+    """ Path of the file with the address of the worker """
+    return gf.get_cache_path(OPTIONS,"-QGIS.json")
+
+
+def read_state():
+    """ 
+        Read address and key of the worker
+
+        Returns
+        -------
+        dict
+            None if no worker was started
+    """
+    try:
+        with open(get_state_path(),"r") as f:
+            return json.load(f)
+    except (OSError,ValueError):
+        return None
+
+
+def request(MESSAGE:dict,TIMEOUT=None):
+    """ 
+        Send a message to the worker and wait for the answer
+
+        Parameters
+        ----------
+        MESSAGE : dict
+            key "cmd": ping/run/stop
+        TIMEOUT : float
+            seconds to wait for the answer, None to wait until the end of the job
+
+        Returns
+        -------
+        dict
+    """
+    state = read_state()
+    if state==None:
+        raise ConnectionError("QGIS worker not started")
+    conn = Client(tuple(state["address"]),authkey=bytes.fromhex(state["authkey"]))
+    try:
+        conn.send(MESSAGE)
+        if (TIMEOUT!=None) and (not conn.poll(TIMEOUT)):
+            raise TimeoutError("QGIS worker does not answer")
+        return conn.recv()
+    finally:
+        conn.close()
+
+
+
+##########
+# WORKER #
+##########
+
+
+def _run_jobs(soft):
+    """ Run jobs of the queue one by one, in the worker process """
+    while True:
+        args,answer,done = _JOBS.get()
+        _STATUS["running"] = args[1]
+        try:
+            soft.run_qgis_analysis(*args)
+        except Exception:
+            _STATUS["failed"] += 1
+            answer.update({"ok":False,"error":traceback.format_exc()})
+        else:
+            _STATUS["done"] += 1
+            answer.update({"ok":True})
+        finally:
+            soft.QgsProject.instance().removeAllMapLayers() # layers of the job, the worker lives for many jobs
+        _STATUS["running"] = None
+        done.set()
+
+
+def _handle(conn,started:float,options_mtime:int):
+    """ Answer 1 message of a client, in the worker process """
+    try:
+        message = conn.recv()
+        cmd = message.get("cmd")
+        if cmd == "ping":
+            conn.send({"ok":True,"pid":os.getpid(),"uptime":time.time()-started,"options_mtime":options_mtime,
+                       "queued":_JOBS.qsize(),**_STATUS})
+        elif cmd == "run":
+            answer = {}
+            done = threading.Event()
+            _JOBS.put((message["args"],answer,done))
+            done.wait()
+            conn.send(answer)
+        elif cmd == "stop":
+            conn.send({"ok":True})
+            conn.close()
+            os._exit(0)
+        else:
+            conn.send({"ok":False,"error":"Unknown command: "+str(cmd)})
+    except (EOFError,OSError):
+        pass # client gone
+    finally:
+        conn.close()
+
+
+def serve():
+    """ 
+        Start QGIS, then answer clients until the command stop (run in the worker process)
+        Each client is served in a thread, jobs are queued
+    """
+    import script_qgis_software as soft # QGIS initialization, once
+
+    authkey = secrets.token_bytes(16)
+    listener = Listener(("127.0.0.1",0),authkey=authkey)
+    state = {"address":list(listener.address),"authkey":authkey.hex(),"pid":os.getpid()}
+    path = get_state_path()
+    with open(path+".tmp","w") as f:
+        f.write(json.dumps(state, indent = 4))
+    os.replace(path+".tmp",path)
+
+    threading.Thread(target=_run_jobs,args=(soft,),daemon=True).start()
+    started = time.time()
+    options_mtime = os.stat(OPTIONS).st_mtime_ns
+    while True:
+        try:
+            conn = listener.accept()
+        except Exception:
+            continue # wrong key or broken connection
+        threading.Thread(target=_handle,args=(conn,started,options_mtime),daemon=True).start()
+
+
+
+#########################
+# FUNCTIONS - INTERFACE #
+#########################
+
+
+def ping(TIMEOUT=2):
+    """ 
+        Health check of the worker
+
+        Parameters
+        ----------
+        TIMEOUT : float
+            seconds to wait for the answer
+
+        Returns
+        -------
+        dict
+            pid, uptime, options_mtime, queued, running, done, failed
+            None if the worker is not running
+    """
+    try:
+        return request({"cmd":"ping"},TIMEOUT)
+    except (OSError,EOFError,TimeoutError,ConnectionError,ValueError):
+        return None
+
+
+def start(TIMEOUT=START_TIMEOUT):
+    """ 
+        Start the worker if it is not running, restart it if QGIS paths changed in options.json
+
+        Parameters
+        ----------
+        TIMEOUT : float
+            seconds to wait for QGIS initialization
+
+        Returns
+        -------
+        dict
+            status of the worker (see ping)
+    """
+    status = ping()
+    if status!=None:
+        if status["options_mtime"]==os.stat(OPTIONS).st_mtime_ns:
+            return status
+        stop()
+
+    if os.path.exists(get_state_path()):
+        os.remove(get_state_path())
+    log = open(gf.get_cache_path(OPTIONS,"-QGIS.log"),"w")
+    if os.name=="posix":
+        detach = {"start_new_session":True}
+    else:
+        detach = {"creationflags":subprocess.CREATE_NEW_PROCESS_GROUP|subprocess.DETACHED_PROCESS}
+    # the worker survives Streamlit reruns
+    process = subprocess.Popen([sys.executable,os.path.abspath(__file__),"--serve"],cwd=os.getcwd(),
+                               stdout=log,stderr=subprocess.STDOUT,stdin=subprocess.DEVNULL,**detach)
+    log.close()
+
+    end = time.time()+TIMEOUT
+    while time.time()<end:
+        if process.poll()!=None:
+            raise RuntimeError("QGIS could not be started, see "+gf.get_cache_path(OPTIONS,"-QGIS.log"))
+        status = ping()
+        if status!=None:
+            return status
+        time.sleep(0.5)
+    raise TimeoutError("QGIS worker not ready after "+str(TIMEOUT)+"s")
+
+
+def stop():
+    """ Stop the worker if it is running """
+    try:
+        request({"cmd":"stop"},5)
+    except (OSError,EOFError,TimeoutError,ConnectionError,ValueError):
+        pass
+
+
+def run_qgis_analysis(BDIR:str,FILEPATH:str,STATS:list,TIMERANGE:str):
+    """ 
+        Compute statistics over a raster layer in the QGIS worker (see script_qgis_software.run_qgis_analysis)
+        Jobs of several sessions are queued, this function returns at the end of the job
+
+        Parameters
+        ----------
+        BDIR : str
+            path to the backup folder
+        FILEPATH : str
+            NetCDF file path
+        STATS : list (str)
+            name of analysis:average/standard deviation/min and max
+        TIMERANGE : str
+            name of timerange:year/season/month
+    """
+    start()
+    answer = request({"cmd":"run","args":[str(BDIR),str(FILEPATH),list(STATS),str(TIMERANGE)]})
+    if not answer.get("ok"):
+        raise RuntimeError(answer.get("error","QGIS job failed"))
+
+
+
+if __name__ == "__main__":
+    if "--serve" in sys.argv:
+        serve()
@@ -3,18 +3,27 @@
 ###########
 
 import motuclient
-import xarray as xr
-import rioxarray
 import matplotlib.pyplot as plt
 import plotly.express as px
 import os
 import re
 import json
+import threading
+from collections import OrderedDict
 
 import requests
+import rasterio
 from bs4 import BeautifulSoup
 
 import general_function as gf
+import dataset_pool as dp
+import spatial_pyramid as pyr
+
+
+# Maps of 1 day already rendered, key=(path,modification time,month,day,depth), least recently used first
+MAX_FIGURES = 32
+_FIGURES = OrderedDict()
+_LOCK = threading.RLock() # Streamlit sessions run in threads
 
 
 
@@ -362,9 +371,32 @@ def final_req(BDIR:str,JSON_SCRIPT,PRODUCT:str,PREFIX:str,VARIABLE:list,D:str,YE
 
 
 
-def create_map_1d(FILEPATH:str,MONTH:str,DAY:str,DEPTH:float):
+def cache_figure(KEY:tuple,FIG):
+    """ 
+        Keep a map in memory, the least recently used ones are closed above MAX_FIGURES
+
+        Returns
+        -------
+        matplotlib figure
+            the figure already kept for KEY if another session rendered it first
+    """
+    with _LOCK:
+        if KEY in _FIGURES:
+            plt.close(FIG)
+            _FIGURES.move_to_end(KEY)
+            return _FIGURES[KEY]
+        _FIGURES[KEY] = FIG
+        while len(_FIGURES)>MAX_FIGURES:
+            plt.close(_FIGURES.popitem(last=False)[1])
+        return FIG
+
+
+
+def create_map_1d(FILEPATH:str,MONTH:str,DAY:str,DEPTH:float,PIXELS=640):
     """ 
         Create a map of 1 day of a NetCDF file
+        Only the slice of the day (and depth) is read, on the coarsest level of the pyramid still finer than the map
+        (see spatial_pyramid), figures are kept in memory (see MAX_FIGURES)
 
         Parameters
         ----------
@@ -375,15 +407,23 @@ def create_map_1d(FILEPATH:str,MONTH:str,DAY:str,DEPTH:float):
         DAY : str
             day
         DEPTH : float
-            depth
+            depth (nearest level)
+        PIXELS : int
+            width of the map in pixels
 
         Returns
         -------
         matplotlib figure
     """
-    # Open and Read the file
-    with xr.open_dataset(FILEPATH) as f:
-        DS = f
+    # Open the file, or a coarser level if the map is smaller than the grid
+    path,_ = pyr.select_level(FILEPATH,PIXELS=PIXELS)
+    key = (os.path.abspath(path),os.stat(path).st_mtime_ns,int(MONTH),int(DAY),float(DEPTH or 0.0))
+    with _LOCK:
+        if key in _FIGURES:
+            _FIGURES.move_to_end(key)
+            return _FIGURES[key]
+
+    DS = dp.open_dataset(path)
 
     ### EXTRACT FROM FILENAME
     YEAR = FILEPATH.split('__')[-1]
@@ -404,36 +444,74 @@ def create_map_1d(FILEPATH:str,MONTH:str,DAY:str,DEPTH:float):
         json_dict = json.load(f)
     VARID = VAR.split("pfx")[-1]
     VARID = VARID.split("]")[-1]
+    VARNAME = VARID
+    VARUNIT = DS[VAR].attrs.get("units","")
     if VARID in json_dict.keys():
         VARNAME = json_dict[VARID][0]
         VARUNIT = json_dict[VARID][1]
 
-    # Plot a 2D map 
-    if VAR == "analysed_sst":
-        DS.analysed_sst.sel(time=t).plot()
+    # Select the day (and depth) on the array, without reading the rest of the file
+    da = DS[VAR]
+    times = DS['time']
+    day = (times.dt.year.values==int(YEAR)) & (times.dt.month.values==int(MONTH)) & (times.dt.day.values==int(DAY))
+    fig1, ax1 = plt.subplots()
+    if not day.any():
+        ax1.set_title("time = "+t+" : no data")
+        return cache_figure(key,fig1)
+    index = {'time':int(day.argmax())}
+    if 'depth' in da.dims:
+        index['depth'] = int(abs(DS['depth'].values-float(DEPTH or 0.0)).argmin())
+    da = da.isel(index)
+
+    # Plot a 2D map
+    latname,lonname = gf.get_latlon_names(DS)
+    ax1.set_aspect('equal')
+    if (DS[latname].ndim==1) and (DS[lonname].ndim==1):
+        # regular grid
+        da = da.transpose(latname,lonname)
+        tpc = ax1.pcolormesh(DS[lonname].values,DS[latname].values,da.values,shading='auto')
     else:
-        df = DS.to_dataframe()
-        df1 = df.reset_index()
-        if DEPTH!=0.0:
-            df1 = df1.loc[(df1['time']==(t+'T12:00:00')) & (df1['depth']==DEPTH)]
-        else :
-            df1 = df1.loc[(df1['time']==(t+'T12:00:00'))]
-        
-        fig1, ax1 = plt.subplots()
-        ax1.set_aspect('equal')
-        if 'longitude' in list(df1.columns):
-            tpc = ax1.tripcolor(df1['longitude'], df1['latitude'], df1[VAR])
-        else :
-            tpc = ax1.tripcolor(df1['lon'], df1['lat'], df1[VAR])
-        fig1.colorbar(tpc).set_label(VARNAME+" in "+VARUNIT)
-        if DEPTH!="":
-            ax1.set_title("time = "+t+" / depth = "+str(DEPTH))
-        else:
-            ax1.set_title("time = "+t)
-        ax1.set_xlabel("longitude [degrees_east]")
-        ax1.set_ylabel("latitude [degrees_north]")
-        return fig1
+        # curvilinear grid
+        tpc = ax1.pcolormesh(DS[lonname].transpose(*da.dims).values,DS[latname].transpose(*da.dims).values,da.values,shading='auto')
+    fig1.colorbar(tpc).set_label(VARNAME+" in "+VARUNIT)
+    if 'depth' in index:
+        ax1.set_title("time = "+t+" / depth = "+str(float(DS['depth'].values[index['depth']])))
+    else:
+        ax1.set_title("time = "+t)
+    ax1.set_xlabel("longitude [degrees_east]")
+    ax1.set_ylabel("latitude [degrees_north]")
 
+    return cache_figure(key,fig1)
+
+
+
+
+def get_overview_level(FILEPATH:str,Z:int):
+    """ 
+        Get the coarsest overview of a GeoTIFF still finer than the pixels of a map
+
+        Parameters
+        ----------
+        FILEPATH : str
+            path to a tif file
+        Z : int
+            zoom of the map
+
+        Returns
+        -------
+        int
+            overview level, None for full resolution (or no overview)
+    """
+    with rasterio.open(str(FILEPATH)) as src:
+        factors = src.overviews(1)
+        res = abs(src.transform.a)
+    # degrees of longitude per pixel of the map (tiles of 256 pixels)
+    screen = 360/(256*2**int(Z))
+    level = None
+    for i,f in enumerate(factors):
+        if res*f <= screen:
+            level = i
+    return level
 
 
 
@@ -465,9 +543,12 @@ def create_map(FILEPATH:str,DEPTH:float,W:int,H:int,Z:int):
     if "]" in VAR:
         VAR = VAR.split("]")[-1]
 
-    # Open and Read the file
-    with rioxarray.open_rasterio(FILEPATH,mask_and_scale=True) as f: # mark nodata as NaN
-        DS = f
+    # Open and Read the file, at the resolution of the map
+    level = get_overview_level(FILEPATH,Z)
+    if level!=None:
+        DS = dp.open_rasterio(FILEPATH,mask_and_scale=True,overview_level=level) # mark nodata as NaN
+    else:
+        DS = dp.open_rasterio(FILEPATH,mask_and_scale=True) # mark nodata as NaN
     DS = DS.rename(VAR) # need a name to be processed
     DS = DS.drop_vars("spatial_ref")
 
@@ -505,15 +586,10 @@ def get_depths(FILEPATH:str,geotiff=False):
     """
     # Open and Read the file
     if geotiff==True :
-        with rioxarray.open_rasterio(FILEPATH) as f:
-            DS = f
-        DS = DS.rename('name') # need a name to be processed
+        DS = dp.open_rasterio(FILEPATH)
     else :
-        with xr.open_dataset(FILEPATH) as f:
-            DS = f
-    df = DS.to_dataframe()
-    df = df.reset_index()
-    if 'depth' in list(df.columns):
-        return df['depth'].unique().tolist()
+        DS = dp.open_dataset(FILEPATH)
+    if 'depth' in DS.coords:
+        return DS['depth'].to_index().unique().tolist()
     else:
-        return []
\ No newline at end of file
+        return []
@@ -87,6 +87,30 @@ def add_layer(BDIR:str,FILEPATH:str,vlayer=False):
 
 
 
+def to_cog(FILEPATH:str):
+    """ 
+        Convert a GeoTIFF written by QGIS to a Cloud-Optimized GeoTIFF (same options as pixel_statistics.write_layer)
+        With GDAL < 3.1 (no COG driver), overviews are added to the GeoTIFF
+
+        Parameters
+        ----------
+        FILEPATH : str
+            path to a tif file
+    """
+    if gdal.GetDriverByName("COG") != None:
+        src = gdal.Open(str(FILEPATH))
+        gdal.Translate(str(FILEPATH)+".tmp",src,format="COG",
+                       creationOptions=["COMPRESS=DEFLATE","PREDICTOR=YES","BLOCKSIZE=256","OVERVIEWS=AUTO","RESAMPLING=AVERAGE"])
+        src = None # close before replacing
+        os.replace(str(FILEPATH)+".tmp",str(FILEPATH))
+    else:
+        dst = gdal.Open(str(FILEPATH),gdal.GA_Update)
+        factors = [2**i for i in range(1,8) if max(dst.RasterXSize,dst.RasterYSize)/2**i>=256]
+        dst.BuildOverviews("AVERAGE",factors)
+        dst = None
+
+
+
 #########################
 # FUNCTIONS - INTERFACE #
 #########################
@@ -259,3 +283,14 @@ def run_qgis_analysis(BDIR:str,FILEPATH:str,STATS:list,TIMERANGE:str):
 
         # next suffix
         s += 1
+
+    # Layers as Cloud-Optimized GeoTIFFs, like the layers computed with NumPy
+    # QGIS adds ".tif" to the outputs: the new layer replaces the layer without extension (see gf.show_available_files)
+    stats = {"average":["avg"],"standard deviation":["std"],"min and max":["min","max"]}
+    for suffix in suf:
+        for stat in STATS:
+            for short in stats.get(stat,[]):
+                output = str(BDIR)+'/Layers/'+str(SERVICE)+'/'+str(NAME)+'_'+short+suffix
+                if os.path.exists(output+".tif"):
+                    to_cog(output+".tif")
+                    os.replace(output+".tif",output)
@@ -5,7 +5,6 @@
 import cftime 
 from functools import partial
 
-import xarray as xr
 import matplotlib.pyplot as plt
 from matplotlib import dates
 import matplotlib.cm as cm
@@ -13,6 +12,7 @@ import seaborn as sns
 
 
 import pandas as pd
+import numpy as np
 import os
 import json
 
@@ -21,6 +21,7 @@ from scipy.stats import t
 from statsmodels.tsa.seasonal import STL
 
 import general_function as gf
+import dataset_pool as dp
 
 
 
@@ -57,8 +58,8 @@ def moving_window(BDIR:str,FILEPATH:str,WIN:int):
         matplotlib figure
             None if the NetCDF file is hourly
     """
-    with xr.open_dataset(FILEPATH) as ds:
-        df = ds.to_dataframe()
+    ds = dp.open_dataset(FILEPATH)
+    df = ds.to_dataframe()
     df = df.reset_index()
 
     # Check if this is a hourly file
@@ -399,6 +400,8 @@ def get_corr(BDIR:str,SERVICE:str,VAR:str):
         df = pd.read_csv(path_to_file,index_col=0,sep=",") 
         all_data = pd.concat([all_data,df])
 
+    if "level_depth" in all_data.columns: # long layout, 1 row per depth level
+        all_data = all_data.drop_duplicates(subset=['Date','Latitude','Longitude','Occurrences'])
     all_data = all_data.sort_values(by=['Date'])
     all_data = all_data.reset_index()
 
@@ -616,3 +619,239 @@ def stl_test(DF:pd.DataFrame):
     res = stl.fit()
     fig = res.plot()
     return fig,res
+
+
+
+def get_MW_series(BDIR:str,SERVICE:str,VAR:str,GAP=7):
+    """ 
+        Get all moving windows of a variable as one daily series
+        Gaps up to GAP days are interpolated, longer gaps (between years not computed) stay NaN
+
+        Parameters
+        ----------
+        BDIR : str
+            path to the backup folder
+        SERVICE : str
+            name of a service
+        VAR : str
+            name of a variable with pfx and depth (without window)
+        GAP : int
+            maximum number of missing days filled by linear interpolation
+
+        Returns
+        -------
+        Series
+            daily average indexed by time, empty if no MW file found
+    """
+    path_to_results = os.path.join(str(BDIR),'Results')
+
+    # GET MW
+    all_data = pd.DataFrame()
+    filelist = gf.show_available_files_simple(path_to_results,SERVICE)
+    for file in filelist:
+        if file.endswith("MW.txt") and (file.split("__")[0] == str(VAR)):
+            path_to_file = os.path.join(path_to_results,str(SERVICE),file)
+            df = pd.read_csv(path_to_file,index_col=0,sep=",")
+            all_data = pd.concat([all_data,df])
+    if all_data.empty:
+        return pd.Series(dtype=float)
+
+    # sandardize dates, one value per day (several windows are averaged)
+    all_data['time'] = pd.to_datetime(all_data['time'], format='mixed').dt.normalize()
+    serie = all_data.groupby('time')['avg'].mean().sort_index()
+    # fill short gaps only
+    serie = serie.asfreq('D')
+    missing = serie.isna()
+    gap = missing.groupby((~missing).cumsum()).transform('sum')
+    serie = serie.interpolate(limit_area='inside').where((~missing) | (gap<=int(GAP)))
+    return serie
+
+
+
+def align_series(S1,S2):
+    """ 
+        Put 2 daily series on the same days, from the first to the last day where both have a value
+        (NaN inside are gaps)
+
+        Returns
+        -------
+        DataFrame
+            2 columns
+    """
+    if S1.empty or S2.empty:
+        return pd.DataFrame()
+    both = pd.concat([S1,S2],axis=1).asfreq('D')
+    valid = both.notna().all(axis=1)
+    if not valid.any():
+        return pd.DataFrame()
+    days = valid.index[valid]
+    return both.loc[days[0]:days[-1]]
+
+
+
+def lagged_correlation(X,Y,MAXLAG:int):
+    """ 
+        Cross-correlation of 2 series for every lag in [-MAXLAG,MAXLAG], computed with FFT
+        A positive lag means that Y follows X (X leads)
+
+        Parameters
+        ----------
+        X : array
+            first series, same length as Y, NaN for days without value (gaps are not interpolated)
+        Y : array
+            second series
+        MAXLAG : int
+            maximum lag (in days)
+
+        Returns
+        -------
+        array (int)
+            lags
+        array (float)
+            cross-correlation for each lag
+        float
+            95% significance band (Bartlett's formula)
+    """
+    x = np.asarray(X,dtype=float)
+    y = np.asarray(Y,dtype=float)
+    # days without value in X or Y add 0 to the products: only pairs of real values are correlated
+    valid = np.isfinite(x) & np.isfinite(y)
+    n = int(valid.sum())
+    maxlag = int(min(MAXLAG,len(x)-1))
+    x = np.where(valid,x-x[valid].mean(),0) if n>0 else np.zeros(len(x))
+    y = np.where(valid,y-y[valid].mean(),0) if n>0 else np.zeros(len(y))
+    sx = np.sqrt(np.dot(x,x)/max(n,1))
+    sy = np.sqrt(np.dot(y,y)/max(n,1))
+    lags = np.arange(-maxlag,maxlag+1)
+    if (n == 0) or (sx == 0) or (sy == 0):
+        return lags,np.full(len(lags),np.nan),np.nan
+
+    # zero padding to avoid circular correlation
+    nfft = 1 << int(2*len(x)-1).bit_length()
+    fx = np.fft.rfft(x,nfft)
+    fy = np.fft.rfft(y,nfft)
+    cc = np.fft.irfft(np.conj(fx)*fy,nfft)
+    ccf = np.concatenate((cc[nfft-maxlag:],cc[:maxlag+1]))/(n*sx*sy)
+
+    # autocorrelations, used for significance of autocorrelated series (MW are smoothed)
+    acx = np.fft.irfft(np.abs(fx)**2,nfft)[1:maxlag+1]/(n*sx*sx)
+    acy = np.fft.irfft(np.abs(fy)**2,nfft)[1:maxlag+1]/(n*sy*sy)
+    var = (1+2*np.sum(acx*acy))/n
+    band = 1.96*np.sqrt(max(var,1/n))
+
+    return lags,ccf,band
+
+
+
+def cross_correlation(BDIR:str,SERVICE1:str,VAR1:str,SERVICE2:str,VAR2:str,MAXLAG=60):
+    """ 
+        Lagged cross-correlation between moving windows of 2 datasets
+
+        Parameters
+        ----------
+        BDIR : str
+            path to the backup folder
+        SERVICE1 : str
+            name of a service
+        VAR1 : str
+            name of a variable
+        SERVICE2 : str
+            name of a service
+        VAR2 : str
+            name of a variable
+        MAXLAG : int
+            maximum lag (in days)
+
+        Returns
+        -------
+        DataFrame
+            columns='lag','ccf'
+        float
+            95% significance band
+        matplotlib figure
+            None if no common time range
+    """
+    s1 = get_MW_series(BDIR,SERVICE1,VAR1)
+    s2 = get_MW_series(BDIR,SERVICE2,VAR2)
+    both = align_series(s1,s2)
+    if both.notna().all(axis=1).sum()<3:
+        return pd.DataFrame(columns=['lag','ccf']),np.nan,None
+
+    lags,ccf,band = lagged_correlation(both.iloc[:,0],both.iloc[:,1],MAXLAG)
+    df = pd.DataFrame({'lag':lags,'ccf':ccf})
+
+    # plot data
+    sns.set_style("ticks")
+    fig1, ax1 = plt.subplots(figsize=(10, 4))
+    ax1.vlines(df['lag'],0,df['ccf'],color='b')
+    ax1.axhline(0,color='k',linewidth=0.5)
+    ax1.axhline(band,color='r',linestyle='--',linewidth=1,label="95% significance")
+    ax1.axhline(-band,color='r',linestyle='--',linewidth=1)
+    ax1.set_title("Cross-correlation "+str(VAR1)+" / "+str(VAR2))
+    ax1.set_xlabel("lag (days), > 0 : "+str(VAR2)+" follows "+str(VAR1))
+    ax1.set_ylabel("correlation")
+    ax1.xaxis.grid(True)
+    ax1.legend(loc='upper left')
+
+    return df,band,fig1
+
+
+
+def all_cross_correlation(BDIR:str,SERVICE:str,MAXLAG=60):
+    """ 
+        Lagged cross-correlation between moving windows of all variables of a service
+
+        Save data into :
+            - <BDIR>/<SERVICE>-XCF.csv
+
+        With data (sep=,):
+            var1, var2, lag, ccf, band, n
+
+        Parameters
+        ----------
+        BDIR : str
+            path to the backup folder
+        SERVICE : str
+            name of a service
+        MAXLAG : int
+            maximum lag (in days)
+
+        Returns
+        -------
+        DataFrame
+            strongest correlation (absolute value) and its lag for each pair of variables
+    """
+    path_to_results = os.path.join(str(BDIR),'Results')
+
+    # Get variables
+    all_vars = []
+    for file in gf.show_available_files_simple(path_to_results,SERVICE):
+        if file.endswith("MW.txt"):
+            v = file.split("__")[0]
+            if v not in all_vars:
+                all_vars.append(v)
+    series = {v:get_MW_series(BDIR,SERVICE,v) for v in all_vars}
+
+    result = {'var1':[],'var2':[],'lag':[],'ccf':[],'band':[],'n':[]}
+    for i in range(len(all_vars)):
+        for j in range(i+1,len(all_vars)):
+            both = align_series(series[all_vars[i]],series[all_vars[j]])
+            if both.notna().all(axis=1).sum()<3:
+                continue
+            lags,ccf,band = lagged_correlation(both.iloc[:,0],both.iloc[:,1],MAXLAG)
+            if np.all(np.isnan(ccf)):
+                continue
+            best = np.nanargmax(np.abs(ccf))
+            result['var1'].append(all_vars[i])
+            result['var2'].append(all_vars[j])
+            result['lag'].append(int(lags[best]))
+            result['ccf'].append(ccf[best])
+            result['band'].append(band)
+            result['n'].append(int(both.notna().all(axis=1).sum()))
+    df = pd.DataFrame(result)
+
+    # save in file
+    output_file = os.path.join(str(BDIR),str(SERVICE)+"-XCF.csv")
+    df.to_csv(output_file,sep=',')
+
+    return df
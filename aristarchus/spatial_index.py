@@ -0,0 +1,224 @@
+###########
+# IMPORTS #
+###########
+
+import os
+import pickle
+import hashlib
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+import general_function as gf
+
+
+EARTH_RADIUS = 6371.0 # km
+
+# Spatial indexes already loaded in this process, key=hash of the grid geometry
+_INDEXES = {}
+
+
+
+#####################
+# GENERAL FUNCTIONS #
+#####################
+
+
+def to_unit_vectors(LATS,LONS):
+    """ 
+        Convert coordinates to 3D unit vectors (x,y,z)
+
+        Parameters
+        ----------
+        LATS : array (float)
+            latitudes in degrees
+        LONS : array (float)
+            longitudes in degrees
+
+        Returns
+        -------
+        array (float)
+            shape (n,3)
+    """
+    lat = np.radians(np.asarray(LATS,dtype=float).ravel())
+    lon = np.radians(np.asarray(LONS,dtype=float).ravel())
+    coslat = np.cos(lat)
+    return np.column_stack((coslat*np.cos(lon),coslat*np.sin(lon),np.sin(lat)))
+
+
+def km_to_chord(DIST):
+    """ Convert a distance on the earth (km) to a chord length between unit vectors """
+    return 2*np.sin(np.asarray(DIST,dtype=float)/(2*EARTH_RADIUS))
+
+
+def chord_to_km(CHORD):
+    """ Convert a chord length between unit vectors to a distance on the earth (km) """
+    return 2*EARTH_RADIUS*np.arcsin(np.clip(np.asarray(CHORD,dtype=float)/2,0,1))
+
+
+def is_curvilinear(DS):
+    """ 
+        Check if latitude and longitude of a dataset are 2D coordinates
+
+        Parameters
+        ----------
+        DS : Dataset or DataArray
+            xarray object opened from a NetCDF file
+
+        Returns
+        -------
+        bool
+    """
+    latname,lonname = gf.get_latlon_names(DS)
+    return (DS[latname].ndim>1) or (DS[lonname].ndim>1)
+
+
+
+#################
+# SPATIAL INDEX #
+#################
+
+
+class SpatialIndex:
+    """ 
+        KD-tree on 3D unit vectors of the pixel centers of a grid (regular, curvilinear or irregular)
+
+        Parameters
+        ----------
+        LAT : array (float)
+            latitude of each pixel (1D or 2D)
+        LON : array (float)
+            longitude of each pixel, same shape as LAT
+    """
+    def __init__(self, LAT, LON):
+        lat = np.asarray(LAT,dtype=float)
+        lon = np.asarray(LON,dtype=float)
+        self.shape = lat.shape
+        self.key = grid_key(lat,lon)
+
+        # pixels with coordinates (curvilinear grids can contain fill values)
+        self.cells = np.flatnonzero(np.isfinite(lat.ravel()) & np.isfinite(lon.ravel()))
+        xyz = to_unit_vectors(lat.ravel()[self.cells],lon.ravel()[self.cells])
+        self.tree = cKDTree(xyz)
+
+        # size of each pixel = distance to the nearest other pixel (km)
+        if len(self.cells)>1:
+            d,_ = self.tree.query(xyz,k=2,workers=-1)
+            self.spacing = chord_to_km(d[:,1])
+        else:
+            self.spacing = np.full(len(self.cells),np.inf)
+
+    def query_nearest(self, LATS, LONS):
+        """ 
+            Get the nearest pixel of several points
+
+            Parameters
+            ----------
+            LATS : array (float)
+                latitude of each point
+            LONS : array (float)
+                longitude of each point
+
+            Returns
+            -------
+            array (int)
+                flat index of the nearest pixel in the grid (see unravel)
+            array (float)
+                distance to the nearest pixel (km)
+            array (float)
+                size of the nearest pixel (km)
+        """
+        d,i = self.tree.query(to_unit_vectors(LATS,LONS),k=1,workers=-1)
+        return self.cells[i],chord_to_km(d),self.spacing[i]
+
+    def query_radius(self, LATS, LONS, RADIUS:float):
+        """ 
+            Get all pixels within a radius of several points
+
+            Parameters
+            ----------
+            LATS : array (float)
+                latitude of each point
+            LONS : array (float)
+                longitude of each point
+            RADIUS : float
+                radius in km
+
+            Returns
+            -------
+            list of array (int)
+                flat indexes of the pixels in the grid, for each point
+        """
+        found = self.tree.query_ball_point(to_unit_vectors(LATS,LONS),km_to_chord(RADIUS),workers=-1)
+        return [self.cells[np.asarray(f,dtype=int)] for f in found]
+
+    def unravel(self, IDX):
+        """ Convert flat indexes to indexes of each dimension of the grid """
+        return np.unravel_index(np.asarray(IDX,dtype=int),self.shape)
+
+
+
+def grid_key(LAT,LON):
+    """ Hash of the geometry of a grid """
+    h = hashlib.sha1()
+    for a in (LAT,LON):
+        a = np.ascontiguousarray(a,dtype=float)
+        h.update(str(a.shape).encode())
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+
+
+#########################
+# FUNCTIONS - INTERFACE #
+#########################
+
+
+def get_spatial_index(DS,FILEPATH=None):
+    """ 
+        Get the spatial index of a dataset, built once per grid geometry
+
+        Save index into (if FILEPATH):
+            - <folder of FILEPATH>/.cache/<name of FILEPATH>-GRID.pkl
+
+        Parameters
+        ----------
+        DS : Dataset or DataArray
+            xarray object opened from a NetCDF file
+        FILEPATH : str
+            path to the NetCDF file, None to keep the index in memory only
+
+        Returns
+        -------
+        SpatialIndex
+    """
+    latname,lonname = gf.get_latlon_names(DS)
+    lat = DS[latname].values
+    lon = DS[lonname].values
+    if (lat.ndim==1) and (lon.ndim==1): # regular grid
+        lon,lat = np.meshgrid(lon,lat)
+    key = grid_key(lat,lon)
+
+    if key in _INDEXES:
+        return _INDEXES[key]
+
+    index = None
+    if FILEPATH!=None:
+        path = gf.get_cache_path(FILEPATH,"-GRID.pkl")
+        if os.path.exists(path):
+            try:
+                with open(path,"rb") as f:
+                    index = pickle.load(f)
+            except Exception:
+                index = None
+            if (index!=None) and (index.key!=key): # file changed
+                index = None
+        if index==None:
+            index = SpatialIndex(lat,lon)
+            with open(path,"wb") as f:
+                pickle.dump(index,f,protocol=pickle.HIGHEST_PROTOCOL)
+    else:
+        index = SpatialIndex(lat,lon)
+
+    _INDEXES[key] = index
+    return index
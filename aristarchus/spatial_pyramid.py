@@ -0,0 +1,328 @@
+###########
+# IMPORTS #
+###########
+
+import os
+import warnings
+
+import xarray as xr
+import numpy as np
+
+import general_function as gf
+import dataset_pool as dp
+
+
+# Coarser copies of each NetCDF file (block means of 2x2, 4x4, 8x8 pixels), read instead of the original
+# when a map or a statistic does not need the native resolution.
+#   - <BDIR>/NetCDF_files/<SERVICE>/.cache/<name>-x<FACTOR>.nc
+# Each level keeps the number of valid pixels of each block ("count"): means of a region computed on a level,
+# weighted by count, are the same as on the original file when the region follows the limits of the blocks.
+
+FACTORS = [2,4,8]
+
+
+
+#####################
+# GENERAL FUNCTIONS #
+#####################
+
+
+def level_path(FILEPATH:str,FACTOR:int):
+    """ Path of the level of a NetCDF file coarsened by FACTOR """
+    return gf.get_cache_path(FILEPATH,"-x"+str(int(FACTOR))+".nc")
+
+
+
+def is_valid(FILEPATH:str,FACTOR:int):
+    """ True if the level exists and was built from the current version of the NetCDF file """
+    path = level_path(FILEPATH,FACTOR)
+    if not os.path.exists(path):
+        return False
+    try:
+        return dp.open_dataset(path).attrs.get("source_mtime")==str(os.stat(str(FILEPATH)).st_mtime_ns)
+    except (OSError,ValueError):
+        return False
+
+
+
+def get_grid_dims(DS):
+    """ 
+        Get names of the spatial dimensions of a dataset (regular or curvilinear grid)
+
+        Returns
+        -------
+        str
+            dimension of rows (latitude)
+        str
+            dimension of columns (longitude)
+    """
+    latname,lonname = gf.get_latlon_names(DS)
+    return DS[latname].dims[0],DS[lonname].dims[-1]
+
+
+
+def get_resolution(DS):
+    """ 
+        Get the size of a pixel of a dataset in degrees of longitude (median step)
+
+        Parameters
+        ----------
+        DS : Dataset
+            xarray object opened from a NetCDF file
+
+        Returns
+        -------
+        float
+    """
+    _,lonname = gf.get_latlon_names(DS)
+    lon = DS[lonname].values
+    if lon.shape[-1]<2:
+        return np.inf
+    return float(np.nanmedian(np.abs(np.diff(lon,axis=-1))))
+
+
+
+def block_sum(SUMS,COUNTS,FACTOR:int):
+    """ 
+        Add sums and numbers of valid values of blocks of FACTOR x FACTOR pixels (last 2 axes)
+        Incomplete blocks on the edges are kept
+
+        Parameters
+        ----------
+        SUMS : array (float)
+            sum of valid values of each pixel, 0 if no value
+        COUNTS : array (int)
+            number of valid values of each pixel
+        FACTOR : int
+
+        Returns
+        -------
+        array (float)
+        array (int)
+    """
+    *lead,ny,nx = SUMS.shape
+    pad = [(0,0)]*len(lead)+[(0,-ny%FACTOR),(0,-nx%FACTOR)]
+    shape = tuple(lead)+((ny-1)//FACTOR+1,FACTOR,(nx-1)//FACTOR+1,FACTOR)
+    sums = np.pad(SUMS,pad).reshape(shape).sum(axis=(-3,-1))
+    counts = np.pad(COUNTS,pad).reshape(shape).sum(axis=(-3,-1),dtype=COUNTS.dtype)
+    return sums,counts
+
+
+
+def coarsen_coord(COORD,FACTOR:int):
+    """ Mean of the coordinates (1D or 2D) of each block of FACTOR pixels """
+    COORD = np.asarray(COORD,dtype=float)
+    valid = np.isfinite(COORD)
+    if COORD.ndim==1:
+        sums,counts = block_sum(np.where(valid,COORD,0)[None,:],valid[None,:].astype(np.int32),FACTOR)
+        sums,counts = sums[0],counts[0]
+    else:
+        sums,counts = block_sum(np.where(valid,COORD,0),valid.astype(np.int32),FACTOR)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning) # blocks without coordinate
+        return sums/counts
+
+
+
+def build_pyramid(FILEPATH:str,FACTORS=FACTORS,CHUNK=31):
+    """ 
+        Compute the coarser levels of a NetCDF file, reading CHUNK days at a time
+        Each level is computed from the previous one, means weighted by the number of valid pixels
+
+        Save data into :
+            - <folder of FILEPATH>/.cache/<name of FILEPATH>-x<FACTOR>.nc
+
+        Parameters
+        ----------
+        FILEPATH : str
+            path to a NetCDF file
+        FACTORS : list (int)
+            size of the blocks of each level, each factor divides the next one
+        CHUNK : int
+            number of days read at once
+
+        Returns
+        -------
+        list (str)
+            paths of the levels
+    """
+    FACTORS = sorted(int(f) for f in FACTORS)
+    for small,big in zip([1]+FACTORS[:-1],FACTORS):
+        if big%small!=0:
+            raise ValueError("Each factor must divide the next one: "+str(FACTORS))
+
+    ds = dp.open_dataset(FILEPATH)
+    mtime = str(os.stat(str(FILEPATH)).st_mtime_ns)
+
+    ### EXTRACT FROM FILENAME
+    VAR = (os.path.split(str(FILEPATH))[1]).split('__')[0].split("pfx")[-1]
+    if "]" in VAR:
+        VAR = VAR.split("]")[-1]
+
+    latname,lonname = gf.get_latlon_names(ds)
+    ydim,xdim = get_grid_dims(ds)
+    da = ds[VAR].transpose(...,ydim,xdim)
+    *lead,ny,nx = da.shape
+
+    sums,counts = {},{}
+    for f in FACTORS:
+        shape = tuple(lead)+((ny-1)//f+1,(nx-1)//f+1)
+        sums[f] = np.zeros(shape,dtype=np.float32)
+        counts[f] = np.zeros(shape,dtype=np.uint16)
+
+    # read the file by chunks of days (first dimension), the grid stays complete
+    steps = lead[0] if lead!=[] else 1
+    for start in range(0,steps,int(CHUNK)):
+        sl = slice(start,start+int(CHUNK))
+        block = (da[sl] if lead!=[] else da).values.astype(np.float64)
+        valid = np.isfinite(block)
+        s,c = np.where(valid,block,0),valid.astype(np.uint16)
+        previous = 1
+        for f in FACTORS:
+            s,c = block_sum(s,c,f//previous)
+            previous = f
+            if lead!=[]:
+                sums[f][sl],counts[f][sl] = s,c
+            else:
+                sums[f],counts[f] = s.astype(np.float32),c
+
+    created = []
+    for f in FACTORS:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning) # blocks without value
+            mean = np.where(counts[f]>0,sums[f]/counts[f],np.nan).astype(np.float32)
+        coords = {d:ds[d] for d in da.dims[:-2] if d in ds.coords}
+        coords[latname] = (ds[latname].dims,coarsen_coord(ds[latname].values,f),ds[latname].attrs)
+        coords[lonname] = (ds[lonname].dims,coarsen_coord(ds[lonname].values,f),ds[lonname].attrs)
+        level = xr.Dataset({VAR:(da.dims,mean,da.attrs),"count":(da.dims,counts[f])},coords=coords,
+                           attrs={**ds.attrs,"pyramid_factor":f,"source_mtime":mtime})
+
+        path = level_path(FILEPATH,f)
+        level.to_netcdf(path+".tmp",encoding={VAR:{"zlib":True,"complevel":4},"count":{"zlib":True,"complevel":4}})
+        dp.close(path)
+        os.replace(path+".tmp",path)
+        created.append(path)
+    return created
+
+
+
+#########################
+# FUNCTIONS - INTERFACE #
+#########################
+
+
+def select_level(FILEPATH:str,RESOLUTION=None,PIXELS=None):
+    """ 
+        Get the coarsest level of a NetCDF file still finer than a resolution
+        (the original file if no level is fine enough or built)
+
+        Parameters
+        ----------
+        FILEPATH : str
+            path to a NetCDF file
+        RESOLUTION : float
+            size of a pixel of the map in degrees of longitude
+        PIXELS : int
+            width of the map in pixels, used if RESOLUTION is None (the whole file is shown)
+
+        Returns
+        -------
+        str
+            path to the NetCDF file to read
+        int
+            factor of the level, 1 for the original file
+    """
+    ds = dp.open_dataset(FILEPATH)
+    native = get_resolution(ds)
+    if RESOLUTION==None:
+        if PIXELS==None:
+            return str(FILEPATH),1
+        _,lonname = gf.get_latlon_names(ds)
+        RESOLUTION = float(np.nanmax(ds[lonname].values)-np.nanmin(ds[lonname].values))/int(PIXELS)
+
+    for f in sorted(FACTORS,reverse=True):
+        if (native*f<=RESOLUTION) and is_valid(FILEPATH,f):
+            return level_path(FILEPATH,f),f
+    return str(FILEPATH),1
+
+
+
+def regional_mean(FILEPATH:str,LATMIN:float,LATMAX:float,LONMIN:float,LONMAX:float,RESOLUTION=None,DEPTH=None):
+    """ 
+        Get the daily mean of the variable of a NetCDF file over a region, read on the coarsest level
+        finer than RESOLUTION (weighted by the number of valid pixels of each block)
+        A block is in the region if its center is: on the edges of the region, up to half a block is added or missed,
+        the mean is exact only for regions following the limits of the blocks
+
+        Parameters
+        ----------
+        FILEPATH : str
+            path to a NetCDF file
+        LATMIN, LATMAX, LONMIN, LONMAX : float
+            limits of the region
+        RESOLUTION : float
+            size of the pixels needed in degrees of longitude, None for the original file
+        DEPTH : float
+            nearest depth level, None for the first level
+
+        Returns
+        -------
+        pandas Series
+            index=time
+    """
+    path,factor = select_level(FILEPATH,RESOLUTION)
+    ds = dp.open_dataset(path)
+
+    ### EXTRACT FROM FILENAME
+    VAR = (os.path.split(str(FILEPATH))[1]).split('__')[0].split("pfx")[-1]
+    if "]" in VAR:
+        VAR = VAR.split("]")[-1]
+
+    latname,lonname = gf.get_latlon_names(ds)
+    ydim,xdim = get_grid_dims(ds)
+    da = ds[VAR]
+    count = ds["count"] if factor>1 else da.notnull()
+    if 'depth' in da.dims:
+        index = int(np.abs(ds['depth'].values-float(DEPTH or 0.0)).argmin())
+        da,count = da.isel(depth=index),count.isel(depth=index)
+    inside = ((ds[latname]>=LATMIN) & (ds[latname]<=LATMAX) & (ds[lonname]>=LONMIN) & (ds[lonname]<=LONMAX))
+    weights = count.where(inside,0)
+    total = (da.fillna(0)*weights).sum(dim=[ydim,xdim])
+    return (total/weights.sum(dim=[ydim,xdim])).to_series().rename(VAR)
+
+
+
+def build_all(BDIR:str,FACTORS=FACTORS,WORKERS=None,CHUNK=31):
+    """ 
+        Build the levels of all NetCDF files of a backup folder which have no level or an outdated one,
+        1 file per process
+
+        Parameters
+        ----------
+        BDIR : str
+            path to the backup folder
+        FACTORS : list (int)
+            size of the blocks of each level
+        WORKERS : int
+            number of processes, None for the number of cores
+        CHUNK : int
+            number of days read at once
+
+        Returns
+        -------
+        list (str)
+            NetCDF files processed
+    """
+    files = []
+    for service,names in gf.show_available_files(BDIR,"NetCDF_files").items():
+        for name in names:
+            path = os.path.join(str(BDIR),"NetCDF_files",service,name)
+            if not all(is_valid(path,f) for f in FACTORS):
+                files.append(path)
+
+    if len(files)==1:
+        build_pyramid(files[0],FACTORS,CHUNK)
+    elif len(files)>1:
+        with gf.process_pool(min(len(files),WORKERS or os.cpu_count() or 1)) as pool:
+            list(pool.map(build_pyramid,files,[FACTORS]*len(files),[CHUNK]*len(files)))
+    return files
@@ -0,0 +1,568 @@
+###########
+# IMPORTS #
+###########
+
+import os
+import io
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, urlencode, quote, unquote
+
+import numpy as np
+import matplotlib
+import plotly.graph_objects as go
+from PIL import Image
+
+import general_function as gf
+import dataset_pool as dp
+import spatial_index as si
+import spatial_pyramid as pyr
+
+
+# Local XYZ tile server: maps show PNG/WebP tiles rendered on demand from 1 slice of a NetCDF file or a layer,
+# the size of the map depends on the viewport, not on the size of the dataset.
+#   - http://<URL_HOST>:<port>/<nc|layer>/<SERVICE>/<NAME>/<z>/<x>/<y>.<png|webp>?date=YYYY-MM-DD&depth=&vmin=&vmax=&cmap=
+#   - tiles are saved in <BDIR>/.cache/tiles/
+# The tiles are loaded by the browser, not by streamlit: by default only a browser on the same machine can reach them.
+
+TILE_SIZE = 256
+PORT = 8765 # another free port is used if busy
+DEFAULT_CMAP = "viridis"
+################ TO ADAPT ################
+HOST = "127.0.0.1" # address listened, "0.0.0.0" for browsers on other machines
+URL_HOST = "localhost" # name of this machine for the browser (ex: the address of the streamlit server)
+
+MAX_SLICES = 16 # slices kept in memory
+_SLICES = OrderedDict() # key=(path,modification time,date,depth), least recently used first
+_LOCK = threading.RLock()
+_SERVERS = {} # key=port asked, value=server (listening on this port or another one if busy)
+
+
+
+#####################
+# GENERAL FUNCTIONS #
+#####################
+
+
+def get_style(NAME:str):
+    """ 
+        Get name, unit and colormap of the variable of a file from variables.json
+        (optional 3rd value of a variable: matplotlib colormap)
+
+        Parameters
+        ----------
+        NAME : str
+            name of a NetCDF file or a layer
+
+        Returns
+        -------
+        str
+            name of the variable
+        str
+            unit
+        str
+            colormap
+    """
+    ### EXTRACT FROM FILENAME
+    VAR = NAME.split('__')[0].split("pfx")[-1]
+    if "]" in VAR:
+        VAR = VAR.split("]")[-1]
+
+    ################ TO ADAPT ################
+    with open("./variables.json","r") as f:
+        json_dict = json.load(f)
+    style = json_dict.get(VAR,[VAR,""])
+    return style[0],style[1],(style[2] if len(style)>2 else DEFAULT_CMAP)
+
+
+
+def get_path(BDIR:str,KIND:str,SERVICE:str,NAME:str):
+    """ 
+        Path of a NetCDF file (KIND="nc") or a layer (KIND="layer")
+        SERVICE and NAME come from urls: only names of files inside <BDIR>/NetCDF_files or <BDIR>/Layers are accepted
+
+        Returns
+        -------
+        str
+            raise ValueError if the path is outside the folder
+    """
+    folder = os.path.join(str(BDIR),{"nc":"NetCDF_files","layer":"Layers"}[KIND])
+    for part in (str(SERVICE),str(NAME)):
+        if (part in ["",".",".."]) or ("/" in part) or ("\\" in part):
+            raise ValueError("Invalid name: "+part)
+    path = os.path.join(folder,str(SERVICE),str(NAME))
+    root = os.path.realpath(folder)
+    if os.path.commonpath([root,os.path.realpath(path)])!=root:
+        raise ValueError("Path outside "+folder)
+    return path
+
+
+
+def get_slice(FILEPATH:str,KIND:str,DATE=None,DEPTH=None):
+    """ 
+        Read 1 day and 1 depth of a NetCDF file, or 1 depth of a layer, kept in memory for the next tiles
+
+        Parameters
+        ----------
+        FILEPATH : str
+            path to a NetCDF file or a layer
+        KIND : str
+            "nc" or "layer"
+        DATE : str
+            YYYY-MM-DD (NetCDF files), None for the first day
+        DEPTH : float
+            nearest depth level, None for the first level
+
+        Returns
+        -------
+        dict
+            lat, lon (1D or 2D), values (2D, lat first for 1D coordinates), vmin, vmax (2nd and 98th percentiles),
+            index (SpatialIndex of curvilinear grids, else None)
+    """
+    key = (os.path.abspath(str(FILEPATH)),os.stat(str(FILEPATH)).st_mtime_ns,DATE,DEPTH)
+    with _LOCK:
+        if key in _SLICES:
+            _SLICES.move_to_end(key)
+            return _SLICES[key]
+
+    if KIND == "layer":
+        da = dp.open_rasterio(FILEPATH,mask_and_scale=True)
+        band = 0
+        if ('depth' in da.coords) and (DEPTH!=None):
+            band = int(np.abs(da['depth'].values-float(DEPTH)).argmin())
+        da = da.isel(band=band)
+        latname,lonname = "y","x"
+    else:
+        ds = dp.open_dataset(FILEPATH)
+        ### EXTRACT FROM FILENAME
+        VAR = os.path.split(str(FILEPATH))[1].split('__')[0].split("pfx")[-1].split("]")[-1]
+        da = ds[VAR]
+        index = {'time':0}
+        if DATE!=None:
+            y,m,d = [int(v) for v in str(DATE).split("-")]
+            times = ds['time']
+            day = (times.dt.year.values==y) & (times.dt.month.values==m) & (times.dt.day.values==d)
+            if not day.any():
+                raise KeyError("No data on "+str(DATE))
+            index['time'] = int(day.argmax())
+        if 'depth' in da.dims:
+            index['depth'] = int(np.abs(ds['depth'].values-float(DEPTH or 0.0)).argmin())
+        da = da.isel(index)
+        latname,lonname = gf.get_latlon_names(ds)
+
+    lat = da[latname]
+    lon = da[lonname]
+    if (lat.ndim==1) and (lon.ndim==1):
+        values = da.transpose(latname,lonname).values.astype(np.float32)
+        index = None
+    else:
+        values = da.transpose(*lat.dims).values.astype(np.float32)
+        index = si.get_spatial_index(da,FILEPATH if KIND=="nc" else None)
+
+    finite = values[np.isfinite(values)]
+    vmin,vmax = (np.percentile(finite,[2,98]) if finite.size>0 else (0.0,1.0))
+    result = {"lat":np.asarray(lat.values,dtype=float),"lon":np.asarray(lon.values,dtype=float),"values":values,
+              "vmin":float(vmin),"vmax":float(vmax),"index":index}
+    with _LOCK:
+        _SLICES[key] = result
+        while len(_SLICES)>MAX_SLICES:
+            _SLICES.popitem(last=False)
+    return result
+
+
+
+def get_color_scale(FILEPATH:str,KIND:str,DATE=None,DEPTH=None):
+    """ 
+        Get the limits of the colormap of a slice, the same for all zooms
+        (2nd and 98th percentiles of the coarsest level of the pyramid for NetCDF files)
+
+        Returns
+        -------
+        float
+            vmin
+        float
+            vmax
+    """
+    if KIND == "nc":
+        FILEPATH = pyr.select_level(FILEPATH,RESOLUTION=np.inf)[0]
+    s = get_slice(FILEPATH,KIND,DATE,DEPTH)
+    return s["vmin"],s["vmax"]
+
+
+
+def tile_coordinates(Z:int,X:int,Y:int):
+    """ 
+        Get latitude and longitude of the pixels of a tile (Web Mercator)
+
+        Parameters
+        ----------
+        Z : int
+            zoom
+        X : int
+            column of the tile
+        Y : int
+            row of the tile
+
+        Returns
+        -------
+        array (float)
+            latitude of each row of pixels
+        array (float)
+            longitude of each column of pixels
+    """
+    n = 2**int(Z)
+    pixels = (np.arange(TILE_SIZE)+0.5)/TILE_SIZE
+    lon = (int(X)+pixels)/n*360-180
+    lat = np.degrees(np.arctan(np.sinh(np.pi*(1-2*(int(Y)+pixels)/n))))
+    return lat,lon
+
+
+
+def nearest_1d(COORD,POINTS):
+    """ 
+        Get the nearest pixel of a regular axis for each point
+
+        Parameters
+        ----------
+        COORD : array (float)
+            coordinates of the axis (ascending or descending)
+        POINTS : array (float)
+
+        Returns
+        -------
+        array (int)
+            index in COORD
+        array (bool)
+            False if the point is outside the axis
+    """
+    order = np.argsort(COORD)
+    c = COORD[order]
+    if len(c)==1:
+        return np.zeros(len(POINTS),dtype=int),np.ones(len(POINTS),dtype=bool)
+    pos = np.clip(np.searchsorted(c,POINTS),1,len(c)-1)
+    idx = np.where(POINTS-c[pos-1] < c[pos]-POINTS,pos-1,pos)
+    half = np.abs(np.diff(c)).mean()/2
+    inside = (POINTS>=c[0]-half) & (POINTS<=c[-1]+half)
+    return order[idx],inside
+
+
+
+def sample_tile(SLICE:dict,Z:int,X:int,Y:int):
+    """ 
+        Get the value of the nearest pixel of the slice for each pixel of a tile
+
+        Parameters
+        ----------
+        SLICE : dict
+            see get_slice
+        Z, X, Y : int
+            tile
+
+        Returns
+        -------
+        array (float)
+            shape (TILE_SIZE,TILE_SIZE), NaN outside the data
+    """
+    lat,lon = tile_coordinates(Z,X,Y)
+    if SLICE["index"]==None:
+        yi,yin = nearest_1d(SLICE["lat"],lat)
+        xi,xin = nearest_1d(SLICE["lon"],lon)
+        values = SLICE["values"][np.ix_(yi,xi)]
+        return np.where(yin[:,None] & xin[None,:],values,np.nan)
+
+    lats,lons = np.meshgrid(lat,lon,indexing="ij")
+    cells,dist,spacing = SLICE["index"].query_nearest(lats.ravel(),lons.ravel())
+    values = SLICE["values"].ravel()[cells]
+    return np.where(dist<=spacing,values,np.nan).reshape(TILE_SIZE,TILE_SIZE)
+
+
+
+def colorize(VALUES,VMIN:float,VMAX:float,CMAP:str):
+    """ 
+        Convert values to RGBA colors, NaN are transparent
+
+        Returns
+        -------
+        array (uint8)
+            shape (rows,columns,4)
+    """
+    norm = (VALUES-VMIN)/((VMAX-VMIN) or 1.0)
+    rgba = matplotlib.colormaps[CMAP](np.clip(np.nan_to_num(norm),0,1),bytes=True)
+    rgba[...,3] = np.where(np.isfinite(VALUES),255,0)
+    return rgba
+
+
+
+def render_tile(BDIR:str,KIND:str,SERVICE:str,NAME:str,Z:int,X:int,Y:int,FMT="png",DATE=None,DEPTH=None,VMIN=None,VMAX=None,CMAP=None):
+    """ 
+        Get a tile, rendered once then read from the disk cache
+
+        Save data into :
+            - <BDIR>/.cache/tiles/<hash of the file and options>/<Z>/<X>/<Y>.<FMT>
+
+        Parameters
+        ----------
+        BDIR : str
+            path to the backup folder
+        KIND : str
+            "nc" (NetCDF_files) or "layer" (Layers)
+        SERVICE : str
+            name of the service
+        NAME : str
+            name of the NetCDF file or the layer
+        Z, X, Y : int
+            tile
+        FMT : str
+            "png" or "webp"
+        DATE : str
+            YYYY-MM-DD (NetCDF files)
+        DEPTH : float
+            nearest depth level
+        VMIN, VMAX : float
+            limits of the colormap, None for the 2nd and 98th percentiles of the slice
+        CMAP : str
+            matplotlib colormap, None for variables.json
+
+        Returns
+        -------
+        bytes
+    """
+    FILEPATH = get_path(BDIR,KIND,SERVICE,NAME)
+    if CMAP==None:
+        CMAP = get_style(NAME)[2]
+    if KIND == "nc":
+        # coarsest level of the pyramid finer than the pixels of the tile (see spatial_pyramid)
+        source = pyr.select_level(FILEPATH,RESOLUTION=360/(TILE_SIZE*2**int(Z)))[0]
+    else:
+        source = FILEPATH
+    vmin,vmax = get_color_scale(FILEPATH,KIND,DATE,DEPTH)
+    vmin = vmin if VMIN==None else float(VMIN)
+    vmax = vmax if VMAX==None else float(VMAX)
+    # level read and color scale in the key: tiles rendered before building the pyramid are not reused
+    options = [KIND,SERVICE,NAME,os.stat(FILEPATH).st_mtime_ns,os.path.basename(source),os.stat(source).st_mtime_ns,
+               DATE,DEPTH,vmin,vmax,CMAP]
+    h = hashlib.sha1(json.dumps(options,default=str).encode()).hexdigest()[:16]
+    path = os.path.join(str(BDIR),".cache","tiles",h,str(int(Z)),str(int(X)),str(int(Y))+"."+FMT)
+    if os.path.exists(path):
+        with open(path,"rb") as f:
+            return f.read()
+
+    s = get_slice(source,KIND,DATE,DEPTH)
+    values = sample_tile(s,Z,X,Y)
+    rgba = colorize(values,vmin,vmax,CMAP)
+    buffer = io.BytesIO()
+    Image.fromarray(rgba,"RGBA").save(buffer,{"png":"PNG","webp":"WEBP"}[FMT])
+    data = buffer.getvalue()
+
+    os.makedirs(os.path.dirname(path),exist_ok=True)
+    with open(path+".tmp","wb") as f:
+        f.write(data)
+    os.replace(path+".tmp",path)
+    return data
+
+
+
+##########
+# SERVER #
+##########
+
+
+class TileHandler(BaseHTTPRequestHandler):
+    """ Answer GET /<nc|layer>/<SERVICE>/<NAME>/<z>/<x>/<y>.<png|webp>?date=&depth=&vmin=&vmax=&cmap= """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = unquote(url.path).strip("/").split("/")
+        try:
+            if len(parts)!=6:
+                raise ValueError("Expected /<nc|layer>/<SERVICE>/<NAME>/<z>/<x>/<y>.<png|webp>")
+            KIND,SERVICE,NAME,Z,X = parts[0],parts[1],parts[2],int(parts[-3]),int(parts[-2])
+            Y,FMT = parts[-1].split(".")
+            query = {k:v[0] for k,v in parse_qs(url.query).items()}
+            data = render_tile(self.server.bdir,KIND,SERVICE,NAME,Z,X,int(Y),FMT,
+                               DATE=query.get("date"),
+                               DEPTH=float(query["depth"]) if "depth" in query else None,
+                               VMIN=float(query["vmin"]) if "vmin" in query else None,
+                               VMAX=float(query["vmax"]) if "vmax" in query else None,
+                               CMAP=query.get("cmap"))
+        except (IndexError,ValueError,KeyError) as e:
+            self.send_error(400,str(e))
+            return
+        except FileNotFoundError:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type","image/"+FMT)
+        self.send_header("Content-Length",str(len(data)))
+        self.send_header("Cache-Control","max-age=3600")
+        self.send_header("Access-Control-Allow-Origin","*")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass # no log in the streamlit console
+
+
+
+#########################
+# FUNCTIONS - INTERFACE #
+#########################
+
+
+def start(BDIR:str,PORT=PORT):
+    """ 
+        Start the tile server in a thread of this process (once), or change its backup folder
+        If the port is busy (another application or another streamlit process), a free port is used
+
+        Parameters
+        ----------
+        BDIR : str
+            path to the backup folder
+        PORT : int
+            local port asked
+
+        Returns
+        -------
+        str
+            base url of the server
+    """
+    with _LOCK:
+        if PORT not in _SERVERS:
+            try:
+                server = ThreadingHTTPServer((HOST,int(PORT)),TileHandler)
+            except OSError: # port busy
+                server = ThreadingHTTPServer((HOST,0),TileHandler)
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever,daemon=True).start()
+            _SERVERS[PORT] = server
+        _SERVERS[PORT].bdir = str(BDIR)
+    return "http://"+URL_HOST+":"+str(get_port(PORT))
+
+
+
+def get_port(PORT=PORT):
+    """ Port listened by the server started for PORT (PORT if not started) """
+    with _LOCK:
+        if PORT in _SERVERS:
+            return _SERVERS[PORT].server_address[1]
+    return int(PORT)
+
+
+
+def tile_url(KIND:str,SERVICE:str,NAME:str,PORT=PORT,FMT="png",**PARAMS):
+    """ 
+        Get the url template of the tiles of a file (for map widgets)
+
+        Parameters
+        ----------
+        KIND : str
+            "nc" or "layer"
+        SERVICE : str
+            name of the service
+        NAME : str
+            name of the NetCDF file or the layer
+        PORT : int
+            local port asked when the server was started (see start)
+        FMT : str
+            "png" or "webp"
+        PARAMS :
+            date, depth, vmin, vmax, cmap (None are ignored)
+
+        Returns
+        -------
+        str
+            url with {z}/{x}/{y}
+    """
+    query = urlencode({k:v for k,v in PARAMS.items() if v!=None})
+    url = "http://"+URL_HOST+":"+str(get_port(PORT))+"/"+KIND+"/"+quote(str(SERVICE))+"/"+quote(str(NAME))+"/{z}/{x}/{y}."+FMT
+    return url+("?"+query if query else "")
+
+
+
+def get_tile_info(BDIR:str,KIND:str,SERVICE:str,NAME:str,DATE=None,DEPTH=None):
+    """ 
+        Get the legend and the extent of the tiles of a file
+
+        Returns
+        -------
+        dict
+            name, unit, cmap, vmin, vmax, extent (latmin,latmax,lonmin,lonmax)
+    """
+    FILEPATH = get_path(BDIR,KIND,SERVICE,NAME)
+    if KIND == "nc":
+        FILEPATH = pyr.select_level(FILEPATH,RESOLUTION=np.inf)[0]
+    s = get_slice(FILEPATH,KIND,DATE,DEPTH)
+    varname,varunit,cmap = get_style(NAME)
+    return {"name":varname,"unit":varunit,"cmap":cmap,"vmin":s["vmin"],"vmax":s["vmax"],
+            "extent":(float(np.nanmin(s["lat"])),float(np.nanmax(s["lat"])),float(np.nanmin(s["lon"])),float(np.nanmax(s["lon"])))}
+
+
+
+def seed(BDIR:str,KIND:str,SERVICE:str,NAME:str,ZOOMS:list,FMT="png",WORKERS=8,DATE=None,DEPTH=None,VMIN=None,VMAX=None,CMAP=None):
+    """ 
+        Render in advance all the tiles covering the data for several zooms
+
+        Parameters
+        ----------
+        ZOOMS : list (int)
+            zooms to render
+        WORKERS : int
+            number of threads
+        (others : see render_tile)
+
+        Returns
+        -------
+        int
+            number of tiles
+    """
+    latmin,latmax,lonmin,lonmax = get_tile_info(BDIR,KIND,SERVICE,NAME,DATE,DEPTH)["extent"]
+    tiles = []
+    for z in ZOOMS:
+        n = 2**int(z)
+        def row(LAT):
+            lat = np.radians(np.clip(LAT,-85.05,85.05))
+            return int(np.clip((1-np.log(np.tan(lat)+1/np.cos(lat))/np.pi)/2*n,0,n-1))
+        def col(LON):
+            return int(np.clip((LON+180)/360*n,0,n-1))
+        tiles += [(z,x,y) for x in range(col(lonmin),col(lonmax)+1) for y in range(row(latmax),row(latmin)+1)]
+
+    with ThreadPoolExecutor(max_workers=int(WORKERS)) as pool:
+        list(pool.map(lambda t: render_tile(BDIR,KIND,SERVICE,NAME,*t,FMT,DATE,DEPTH,VMIN,VMAX,CMAP),tiles))
+    return len(tiles)
+
+
+
+def create_tile_map(URL:str,EXTENT:tuple,W:int,H:int,Z:int,TITLE=""):
+    """ 
+        Create a map showing the tiles of URL as a raster layer
+
+        Parameters
+        ----------
+        URL : str
+            url template (see tile_url)
+        EXTENT : tuple
+            latmin, latmax, lonmin, lonmax of the data
+        W : int
+            width of the map
+        H : int
+            height of the map
+        Z : int
+            zoom of the map
+        TITLE : str
+
+        Returns
+        -------
+        plotly figure
+    """
+    lat = (EXTENT[0]+EXTENT[1])/2
+    lon = (EXTENT[2]+EXTENT[3])/2
+    fig = go.Figure(go.Scattermapbox(lat=[lat],lon=[lon],mode="markers",marker={"size":1,"opacity":0},hoverinfo="skip"))
+    fig.update_layout(mapbox_style="stamen-terrain",
+                      mapbox_layers=[{"sourcetype":"raster","source":[URL],"below":"traces","opacity":0.9}],
+                      mapbox={"center":{"lat":lat,"lon":lon},"zoom":Z},
+                      width=W,height=H,title=TITLE,margin={"l":0,"r":0,"t":30 if TITLE else 0,"b":0})
+    return fig
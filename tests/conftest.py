@@ -0,0 +1,5 @@
+import os
+import sys
+
+# modules of aristarchus are imported by name, as in the interface
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),"aristarchus"))
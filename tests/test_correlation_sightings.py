@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import correlation_sightings as corr
+
+
+def make_dataset(SEED=0,SHAPE=(12,9,11),OFFSET=1000.0):
+    """ Random values around OFFSET with gaps, regular grid """
+    rng = np.random.default_rng(SEED)
+    values = OFFSET+rng.normal(size=SHAPE)
+    values[rng.random(SHAPE)<0.2] = np.nan
+    return xr.Dataset({"v":(("time","lat","lon"),values)},
+                      coords={"time":np.arange(SHAPE[0]),"lat":np.linspace(30,34,SHAPE[1]),"lon":np.linspace(20,25,SHAPE[2])})
+
+
+def test_box_statistics_matches_brute_force():
+    ds = make_dataset()
+    cube = ds["v"].values
+    sat,offset = corr.get_summed_area_tables(ds,"v")
+
+    rng = np.random.default_rng(1)
+    indexes = [rng.integers(0,n,size=40) for n in cube.shape]
+    indexes = [np.concatenate((i,[0,n-1])) for i,n in zip(indexes,cube.shape)] # corners of the cube
+    mean,std,count = corr.box_statistics(sat,indexes,RADIUS=2,DAYS=3,OFFSET=offset)
+
+    for k,(t,y,x) in enumerate(zip(*indexes)):
+        box = cube[max(t-3,0):t+4,max(y-2,0):y+3,max(x-2,0):x+3]
+        box = box[np.isfinite(box)]
+        assert count[k]==box.size
+        np.testing.assert_allclose(mean[k],box.mean(),rtol=0,atol=1e-9)
+        np.testing.assert_allclose(std[k],box.std(),rtol=0,atol=1e-9)
+
+
+def test_box_statistics_without_value():
+    ds = make_dataset()
+    ds["v"][:,:4,:4] = np.nan
+    sat,offset = corr.get_summed_area_tables(ds,"v")
+    mean,std,count = corr.box_statistics(sat,[np.array([5]),np.array([1]),np.array([1])],RADIUS=1,DAYS=1,OFFSET=offset)
+    assert count[0]==0
+    assert np.isnan(mean[0]) and np.isnan(std[0])
+
+
+def test_stratified_sample_one_point_per_stratum():
+    cells = np.sort(np.random.default_rng(2).choice(10000,size=997,replace=False))
+    sample = corr.stratified_sample(cells,50,30,np.random.default_rng(0))
+    assert sample.shape==(30,50)
+    position = np.searchsorted(cells,sample)
+    assert (cells[position]==sample).all() # only valid pixels
+    for k in range(50):
+        stratum = (np.floor(k*len(cells)/50),np.ceil((k+1)*len(cells)/50))
+        assert ((position[:,k]>=stratum[0]) & (position[:,k]<stratum[1])).all()
+
+
+def test_stratified_sample_uniform_over_cells():
+    cells = np.arange(0,200,2)
+    sample = corr.stratified_sample(cells,10,20000,np.random.default_rng(0))
+    frequency = np.bincount(np.searchsorted(cells,sample.ravel()),minlength=len(cells))/sample.size
+    np.testing.assert_allclose(frequency,np.full(len(cells),1/len(cells)),atol=2e-3)
+
+
+def test_stratified_sample_more_points_than_cells():
+    cells = np.array([3,8,9])
+    sample = corr.stratified_sample(cells,7,5,np.random.default_rng(0))
+    assert np.isin(sample,cells).all()
+    assert (np.diff(np.searchsorted(cells,sample),axis=1)>=0).all() # strata in order
+
+
+def test_sighting_id_independent_of_the_format():
+    old = pd.DataFrame({"Date":["2020-01-05 00:00:00","2020-01-06"],"Latitude":["35.1","35.2"],
+                        "Longitude":[24.0,24.5],"Occurrences":[3,1]})
+    new = pd.DataFrame({"Date":pd.to_datetime(["2020-01-05","2020-01-06"]),"Latitude":[35.1000000001,35.2],
+                        "Longitude":["24","24.50"],"Occurrences":["3","1"]})
+    ids = corr.sighting_id(old)
+    assert (ids==corr.sighting_id(new)).all()
+    assert ids[0]!=ids[1]
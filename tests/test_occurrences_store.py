@@ -0,0 +1,61 @@
+import io
+
+import numpy as np
+import pandas as pd
+
+import occurrences_store as store
+
+
+COLUMNS = {"Latitude":"lat","Longitude":"Lon","Date":"event date"}
+
+
+def make_upload(ROWS=53):
+    """ Uploaded csv file with some invalid rows """
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({"lat":rng.uniform(30,40,ROWS).round(5),"Lon":rng.uniform(18,28,ROWS).round(5),
+                       "event date":pd.date_range("2019-12-20",periods=ROWS,freq="3D").strftime("%Y-%m-%d"),
+                       "species":rng.choice(["whale","dolphin"],ROWS)})
+    df.loc[4,"lat"] = 95 # latitude out of range
+    df.loc[9,["lat","Lon"]] = 0 # missing position
+    df.loc[17,"event date"] = "not a date"
+    return df
+
+
+def sort(DF):
+    return DF.sort_values(by=list(DF.columns)).reset_index(drop=True)
+
+
+def test_ingest_by_chunks_matches_whole_file(tmp_path):
+    upload = make_upload()
+    expected,invalid = store.validate_chunk(upload,COLUMNS,"species")
+
+    progress = []
+    meta,removed = store.ingest_csv(io.BytesIO(upload.to_csv(index=False).encode()),str(tmp_path/"obs.csv"),COLUMNS,"species",
+                                    CHUNKSIZE=7,PROGRESS=lambda f,n: progress.append((f,n)))
+    assert removed==invalid=={"latitude":1,"longitude":0,"position (0,0)":1,"date":1}
+    assert meta["rows"]==len(expected)==50
+    assert meta["years"]==sorted(expected["Year"].unique().tolist())
+    assert meta["categories"]==["dolphin","whale"]
+    assert meta["extent"]["LAT"]==[expected["Latitude"].min(),expected["Latitude"].max()]
+
+    # the store and the csv file have all the chunks
+    occ = store.read_occurrences(str(tmp_path/"obs.csv"))
+    columns = ["Latitude","Longitude","Date","Occurrences","Year"]
+    pd.testing.assert_frame_equal(sort(occ[columns]),sort(expected[columns].astype({"Year":int})),check_dtype=False)
+    saved = pd.read_csv(tmp_path/"obs.csv",index_col=0)
+    assert list(saved.index)==list(range(50))
+    assert saved["Occurrences"].tolist()==expected["Occurrences"].tolist()
+
+    # progress on the rows read, not the position of the parser
+    fractions = [f for f,_ in progress]
+    assert fractions==sorted(fractions) and fractions[0]<0.2 and fractions[-1]==1.0
+    assert progress[-1][1]==50
+
+
+def test_ingest_without_valid_row(tmp_path):
+    upload = make_upload()
+    upload["lat"] = 100
+    meta,removed = store.ingest_csv(io.BytesIO(upload.to_csv(index=False).encode()),str(tmp_path/"obs.csv"),COLUMNS,"species",CHUNKSIZE=7)
+    assert removed["latitude"]==len(upload)
+    assert meta["rows"]==0
+    assert store.read_occurrences(str(tmp_path/"obs.csv")).empty
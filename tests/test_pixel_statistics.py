@@ -0,0 +1,123 @@
+import warnings
+
+import numpy as np
+
+import pixel_statistics as ps
+
+
+def make_values(SEED=0,SHAPE=(90,3,4),OFFSET=0.0):
+    """ Random days (first axis) of a small grid with gaps, 1 pixel without value """
+    rng = np.random.default_rng(SEED)
+    values = OFFSET+rng.gamma(2.0,size=SHAPE)
+    values[rng.random(SHAPE)<0.15] = np.nan
+    values[:,0,0] = np.nan
+    return values
+
+
+def reference(VALUES):
+    """ Statistics of each pixel with NumPy on all days at once """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning) # pixel without value
+        return {"avg":np.nanmean(VALUES,axis=0),"std":np.nanstd(VALUES,axis=0),
+                "min":np.nanmin(VALUES,axis=0),"max":np.nanmax(VALUES,axis=0)}
+
+
+STATS = ["average","standard deviation","min and max"]
+
+
+def test_accumulator_chunks_match_numpy():
+    values = make_values()
+    acc = ps.PixelAccumulator(values.shape[1:])
+    for t0,t1 in [(0,1),(1,31),(31,62),(62,90)]:
+        acc.update(values[t0:t1])
+    result = acc.result(STATS)
+    for stat,expected in reference(values).items():
+        np.testing.assert_allclose(result[stat],expected,rtol=1e-12,equal_nan=True)
+    assert (acc.count==np.isfinite(values).sum(axis=0)).all()
+
+
+def test_accumulator_merge_matches_numpy():
+    # Chan merge of partial accumulators (other years, other processes), time on another axis
+    values = make_values(SEED=1,OFFSET=1e6)
+    parts = [ps.PixelAccumulator(values.shape[1:]).update(np.moveaxis(values[t0:t1],0,2),AXIS=2)
+             for t0,t1 in [(0,10),(10,11),(11,90)]]
+    acc = ps.PixelAccumulator(values.shape[1:])
+    for part in parts:
+        acc.merge(part)
+    result = acc.result(STATS)
+    expected = reference(values)
+    np.testing.assert_allclose(result["avg"],expected["avg"],rtol=1e-12,equal_nan=True)
+    np.testing.assert_allclose(result["std"],expected["std"],rtol=1e-6,equal_nan=True) # values far from 0
+    np.testing.assert_allclose(result["min"],expected["min"],equal_nan=True)
+    np.testing.assert_allclose(result["max"],expected["max"],equal_nan=True)
+
+
+def test_accumulator_empty_pixel():
+    values = make_values()
+    result = ps.PixelAccumulator(values.shape[1:]).update(values).result(STATS)
+    assert all(np.isnan(r[0,0]) for r in result.values())
+
+
+def test_histogram_percentiles_within_a_bin():
+    values = make_values(SEED=2,SHAPE=(365,3,4))
+    acc = ps.PixelAccumulator(values.shape[1:]).update(values)
+    hist = ps.PixelHistogram(acc.min,acc.max,NBINS=64)
+    for t0 in range(0,365,31):
+        hist.update(values[t0:t0+31])
+    result = hist.percentiles([1,10,50,90,99])
+    width = (acc.max-acc.min)/64
+    valid = acc.count>0
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning) # pixel without value
+        for q,estimate in result.items():
+            expected = np.nanpercentile(values,q,axis=0,method="inverted_cdf")
+            assert np.isnan(estimate[~valid]).all()
+            assert (np.abs(estimate-expected)[valid]<=width[valid]+1e-9).all()
+
+
+def test_histogram_percentiles_interpolation():
+    # 100 values 0..99 in 10 bins of width 9.9: 10 values per bin, interpolation inside the bin
+    values = np.arange(100.0)[:,None]
+    hist = ps.PixelHistogram(np.array([0.0]),np.array([99.0]),NBINS=10).update(values)
+    assert (hist.counts[:,0]==10).all()
+    result = hist.percentiles([25,50,100])
+    np.testing.assert_allclose(result[25],[2.5*9.9])
+    np.testing.assert_allclose(result[50],[5*9.9])
+    np.testing.assert_allclose(result[100],[99.0])
+
+
+def test_histogram_merge_matches_all_days():
+    values = make_values(SEED=3)
+    acc = ps.PixelAccumulator(values.shape[1:]).update(values)
+    whole = ps.PixelHistogram(acc.min,acc.max,NBINS=32).update(values)
+    parts = ps.PixelHistogram(acc.min,acc.max,NBINS=32).update(values[:40])
+    parts.merge(ps.PixelHistogram(acc.min,acc.max,NBINS=32).update(values[40:]))
+    assert (whole.counts==parts.counts).all()
+    assert (whole.counts.sum(axis=0)==np.isfinite(values).sum(axis=0)).all()
+
+
+def write_year(FOLDER,YEAR,SEED):
+    """ Daily NetCDF file of 1 year <FOLDER>/sst__<YEAR>, grid of 2 depths x 5 x 3 pixels """
+    import xarray as xr
+    import pandas as pd
+    times = pd.date_range(str(YEAR)+"-01-01",str(YEAR)+"-12-31",freq="D")
+    values = make_values(SEED=SEED,SHAPE=(len(times),2,5,3))
+    ds = xr.Dataset({"sst":(("time","depth","lat","lon"),values)},
+                    coords={"time":times,"depth":[0.5,10.0],"lat":np.linspace(30,31,5),"lon":np.linspace(20,21,3)})
+    ds.to_netcdf(str(FOLDER/("sst__"+str(YEAR))))
+    return ds
+
+
+def test_climatology_by_tiles_matches_numpy(tmp_path):
+    folder = tmp_path/"NetCDF_files"/"SERVICE"
+    folder.mkdir(parents=True)
+    years = [write_year(folder,2019,4),write_year(folder,2020,5)] # 2020: leap year
+    clim = ps.get_climatology(str(tmp_path),"SERVICE","sst",[2019,2020],"day",WORKERS=1,TILE=2)
+    assert clim.shape==(366,2,5,3)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning) # pixel without value
+        for month,day,index in [(1,1,0),(2,28,58),(2,29,59),(3,1,60),(12,31,365)]:
+            values = [ds["sst"].sel(time=ds["time"][(ds["time"].dt.month==month) & (ds["time"].dt.day==day)]).values for ds in years]
+            expected = np.nanmean(np.concatenate(values),axis=0)
+            np.testing.assert_allclose(clim[index],expected,rtol=1e-5,equal_nan=True)
@@ -0,0 +1,45 @@
+import numpy as np
+
+import seasonnal_adjustment as sa
+
+
+def brute_force_ccf(X,Y,MAXLAG):
+    """ Correlation of the pairs of values (X[t],Y[t+lag]) for each lag, centered on the days valid in both """
+    valid = np.isfinite(X) & np.isfinite(Y)
+    x = np.where(valid,X-X[valid].mean(),0)
+    y = np.where(valid,Y-Y[valid].mean(),0)
+    n = valid.sum()
+    sx,sy = np.sqrt(np.dot(x,x)/n),np.sqrt(np.dot(y,y)/n)
+    ccf = []
+    for lag in range(-MAXLAG,MAXLAG+1):
+        if lag>=0:
+            ccf.append(np.dot(x[:len(x)-lag],y[lag:]))
+        else:
+            ccf.append(np.dot(x[-lag:],y[:len(y)+lag]))
+    return np.array(ccf)/(n*sx*sy)
+
+
+def test_lagged_correlation_matches_brute_force():
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=200)
+    y = rng.normal(size=200)
+    x[[3,50,51,120]] = np.nan
+    y[[10,51,199]] = np.nan
+    lags,ccf,band = sa.lagged_correlation(x,y,30)
+    assert list(lags)==list(range(-30,31))
+    np.testing.assert_allclose(ccf,brute_force_ccf(x,y,30),atol=1e-10)
+    assert band>0
+
+
+def test_lagged_correlation_positive_lag_when_x_leads():
+    rng = np.random.default_rng(1)
+    x = rng.normal(size=300)
+    y = np.roll(x,7) # y[t] = x[t-7]: y follows x by 7 days
+    lags,ccf,_ = sa.lagged_correlation(x,y,20)
+    assert lags[np.argmax(ccf)]==7
+
+
+def test_lagged_correlation_constant_series():
+    lags,ccf,band = sa.lagged_correlation(np.ones(50),np.arange(50.0),5)
+    assert len(lags)==11
+    assert np.isnan(ccf).all() and np.isnan(band)